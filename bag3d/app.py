@@ -6,6 +6,7 @@
 import os
 import sys
 from shutil import rmtree
+from functools import partial
 from datetime import datetime
 
 import logging, logging.config
@@ -17,10 +18,14 @@ from bag3d.config import border
 from bag3d.config import batch3dfier
 from bag3d.update import bag
 from bag3d.update import ahn
+from bag3d.update import incremental
 from bag3d.batch3dfier import process
+from bag3d.batch3dfier.history import TileHistory
 from bag3d import importer
 from bag3d import exporter
 from bag3d import quality
+from bag3d.manifest import RunManifest
+from bag3d.report import RunReport
 
 from pprint import pformat
 
@@ -63,6 +68,17 @@ def app(cli_args, here, log_conf):
         logger.exception(e)
         sys.exit(1)
     
+    if cfg['config']['profile_db'] is not None:
+        db.db.enable_profiling(threshold=cfg['config']['profile_db'])
+
+    # The duration, the database and subprocess time of the stages are
+    # recorded in the run report
+    report = RunReport(cfg['config']['report'], args=args_in)
+
+    # The completed stages and tiles are recorded, so that an interrupted run
+    # can be resumed with --resume
+    manifest = RunManifest(cfg['config']['manifest'], resume=args_in['resume'])
+    
     try:
         # well, let's assume the user provided the AHN3 dir first
         ahn3_fp = cfg['input_elevation']['dataset_name'][0]
@@ -71,170 +87,269 @@ def app(cli_args, here, log_conf):
         ahn2_dir = cfg['input_elevation']['dataset_dir'][1]
 
 
-        if args_in['update_bag']:
-            logger.info("Updating BAG database")
-            # At this point an empty database should exists, restore_BAG 
-            # takes care of the rest
-            bag.restore_BAG(cfg['database'], bag_latest=args_in['bag_date'],
-                            dump=args_in['bag_dump'],
-                            doexec=args_in['no_exec'])
+        if args_in['update_bag'] and manifest.todo('update_bag'):
+            with manifest.stage('update_bag', report):
+                logger.info("Updating BAG database")
+                # At this point an empty database should exists, restore_BAG 
+                # takes care of the rest
+                bag.restore_BAG(cfg['database'], bag_latest=args_in['bag_date'],
+                                dump=args_in['bag_dump'],
+                                doexec=args_in['no_exec'])
 
 
-        if args_in['update_ahn']:
-            logger.info("Updating AHN files")
+        if args_in['update_ahn'] and manifest.todo('update_ahn'):
+            with manifest.stage('update_ahn', report):
+                logger.info("Updating AHN files")
 
-            ahn.download(path_lasinfo=cfg['path_lasinfo'],
-                         ahn3_dir=ahn3_dir, 
-                         ahn2_dir=ahn2_dir, 
-                         tile_index_file=cfg['tile_index']['elevation']['file'],
-                         ahn3_file_pat=ahn3_fp,
-                         ahn2_file_pat=ahn2_fp)
+                ahn.download(path_lasinfo=cfg['path_lasinfo'],
+                             ahn3_dir=ahn3_dir, 
+                             ahn2_dir=ahn2_dir, 
+                             tile_index_file=cfg['tile_index']['elevation']['file'],
+                             ahn3_file_pat=ahn3_fp,
+                             ahn2_file_pat=ahn2_fp)
 
 
-        if args_in['update_ahn_raster']:
-            logger.info("Updating AHN 0.5m raster files")
-            ahn.download_raster(conn, cfg, 
-                                cfg['quality']['ahn2_rast_dir'],
-                                cfg['quality']['ahn3_rast_dir'],
-                                doexec=args_in['no_exec'])
+        if args_in['update_ahn_raster'] and manifest.todo('update_ahn_raster'):
+            with manifest.stage('update_ahn_raster', report):
+                logger.info("Updating AHN 0.5m raster files")
+                ahn.download_raster(conn, cfg, 
+                                    cfg['quality']['ahn2_rast_dir'],
+                                    cfg['quality']['ahn3_rast_dir'],
+                                    doexec=args_in['no_exec'])
     
-        if args_in['import_tile_idx']:
-            logger.info("Importing BAG tile index")
-            bag.import_index(cfg['tile_index']['polygons']['file'], cfg['database']['dbname'],
-                             cfg['tile_index']['polygons']['schema'], str(cfg['database']['host']),
-                             str(cfg['database']['port']), cfg['database']['user'],
-                             cfg['database']['pw'],
-                             doexec=args_in['no_exec'])
-            # Update BAG tiles to include the lower/left boundary
-            footprints.update_tile_index(conn,
-                                         table_index=[cfg['tile_index']['polygons']['schema'],
-                                                      cfg['tile_index']['polygons']['table']],
-                                         fields_index=[cfg['tile_index']['polygons']['fields']['primary_key'],
-                                                       cfg['tile_index']['polygons']['fields']['geometry'],
-                                                       cfg['tile_index']['polygons']['fields']['unit_name']]
-                                         )
-            logger.info("Partitioning the BAG")
-            logger.debug("Creating centroids")
-            footprints.create_centroids(conn,
-                                        table_centroid=[cfg['input_polygons']['footprints']['schema'],
-                                                        'pand_centroid'],
-                                        table_footprint=[cfg['input_polygons']['footprints']['schema'],
-                                                         cfg['input_polygons']['footprints']['table']],
-                                        fields_footprint=[cfg['input_polygons']['footprints']['fields']['primary_key'],
-                                                          cfg['input_polygons']['footprints']['fields']['geometry']]
-                                        )
-            logger.debug("Creating tiles")
-            footprints.create_views(conn, schema_tiles=cfg['input_polygons']['tile_schema'],
-                                     table_index=[cfg['tile_index']['polygons']['schema'],
-                                                  cfg['tile_index']['polygons']['table']],
-                                     fields_index=[cfg['tile_index']['polygons']['fields']['primary_key'],
-                                                   cfg['tile_index']['polygons']['fields']['geometry'],
-                                                   cfg['tile_index']['polygons']['fields']['unit_name']],
-                                     table_centroid=[cfg['input_polygons']['footprints']['schema'], 'pand_centroid'],
-                                     fields_centroid=[cfg['input_polygons']['footprints']['fields']['primary_key'],
-                                                      'geom'],
-                                     table_footprint=[cfg['input_polygons']['footprints']['schema'],
-                                                      cfg['input_polygons']['footprints']['table']],
-                                     fields_footprint=[cfg['input_polygons']['footprints']['fields']['primary_key'],
-                                                       cfg['input_polygons']['footprints']['fields']['geometry'],
-                                                       cfg['input_polygons']['footprints']['fields']['uniqueid']
-                                                       ],
-                                     prefix_tiles=cfg['input_polygons']['tile_prefix'])
+        if args_in['import_tile_idx'] and manifest.todo('import_tile_idx'):
+            with manifest.stage('import_tile_idx', report):
+                with report.stage('import_tile_idx.bag_index'):
+                    logger.info("Importing BAG tile index")
+                    bag.import_index(cfg['tile_index']['polygons']['file'], cfg['database']['dbname'],
+                                     cfg['tile_index']['polygons']['schema'], str(cfg['database']['host']),
+                                     str(cfg['database']['port']), cfg['database']['user'],
+                                     cfg['database']['pw'],
+                                     doexec=args_in['no_exec'])
+                    # Update BAG tiles to include the lower/left boundary
+                    footprints.update_tile_index(conn,
+                                                 table_index=[cfg['tile_index']['polygons']['schema'],
+                                                              cfg['tile_index']['polygons']['table']],
+                                                 fields_index=[cfg['tile_index']['polygons']['fields']['primary_key'],
+                                                               cfg['tile_index']['polygons']['fields']['geometry'],
+                                                               cfg['tile_index']['polygons']['fields']['unit_name']]
+                                                 )
+                logger.info("Partitioning the BAG")
+                with report.stage('import_tile_idx.centroids'):
+                    logger.debug("Creating centroids")
+                    footprints.create_centroids(conn,
+                                                table_centroid=[cfg['input_polygons']['footprints']['schema'],
+                                                                'pand_centroid'],
+                                                table_footprint=[cfg['input_polygons']['footprints']['schema'],
+                                                                 cfg['input_polygons']['footprints']['table']],
+                                                fields_footprint=[cfg['input_polygons']['footprints']['fields']['primary_key'],
+                                                                  cfg['input_polygons']['footprints']['fields']['geometry']]
+                                                )
+                if cfg['config']['tile_partitioning'] == 'table':
+                    table_assignment = [cfg['input_polygons']['footprints']['schema'],
+                                        cfg['input_polygons']['footprints']['tile_assignment']]
+                    with report.stage('import_tile_idx.tile_assignment'):
+                        logger.debug("Assigning the footprints to the tiles")
+                        footprints.create_tile_assignment(conn,
+                                                          table_assignment=table_assignment,
+                                                          table_index=[cfg['tile_index']['polygons']['schema'],
+                                                                       cfg['tile_index']['polygons']['table']],
+                                                          fields_index=[cfg['tile_index']['polygons']['fields']['primary_key'],
+                                                                        cfg['tile_index']['polygons']['fields']['geometry'],
+                                                                        cfg['tile_index']['polygons']['fields']['unit_name']],
+                                                          table_centroid=[cfg['input_polygons']['footprints']['schema'], 'pand_centroid'],
+                                                          fields_centroid=[cfg['input_polygons']['footprints']['fields']['primary_key'],
+                                                                           'geom'])
+                else:
+                    table_assignment = None
+                with report.stage('import_tile_idx.views'):
+                    logger.debug("Creating tiles")
+                    footprints.create_views(conn, schema_tiles=cfg['input_polygons']['tile_schema'],
+                                             table_index=[cfg['tile_index']['polygons']['schema'],
+                                                          cfg['tile_index']['polygons']['table']],
+                                             fields_index=[cfg['tile_index']['polygons']['fields']['primary_key'],
+                                                           cfg['tile_index']['polygons']['fields']['geometry'],
+                                                           cfg['tile_index']['polygons']['fields']['unit_name']],
+                                             table_centroid=[cfg['input_polygons']['footprints']['schema'], 'pand_centroid'],
+                                             fields_centroid=[cfg['input_polygons']['footprints']['fields']['primary_key'],
+                                                              'geom'],
+                                             table_footprint=[cfg['input_polygons']['footprints']['schema'],
+                                                              cfg['input_polygons']['footprints']['table']],
+                                             fields_footprint=[cfg['input_polygons']['footprints']['fields']['primary_key'],
+                                                               cfg['input_polygons']['footprints']['fields']['geometry'],
+                                                               cfg['input_polygons']['footprints']['fields']['uniqueid']
+                                                               ],
+                                             prefix_tiles=cfg['input_polygons']['tile_prefix'],
+                                             table_assignment=table_assignment)
             
-            logger.info("Importing AHN tile index")
-            bag.import_index(cfg['tile_index']['elevation']['file'], cfg['database']['dbname'],
-                             cfg['tile_index']['elevation']['schema'], str(cfg['database']['host']),
-                             str(cfg['database']['port']), cfg['database']['user'],
-                             cfg['database']['pw'],
-                             doexec=args_in['no_exec'])
+                with report.stage('import_tile_idx.ahn_index'):
+                    logger.info("Importing AHN tile index")
+                    bag.import_index(cfg['tile_index']['elevation']['file'], cfg['database']['dbname'],
+                                     cfg['tile_index']['elevation']['schema'], str(cfg['database']['host']),
+                                     str(cfg['database']['port']), cfg['database']['user'],
+                                     cfg['database']['pw'],
+                                     doexec=args_in['no_exec'])
 
 
-        if args_in['add_borders']:
-            logger.info("Configuring AHN2-3 border tiles")
-            border.create_border_table(conn, cfg, 
-                                       doexec=args_in['no_exec'])
-            # border.update_file_date(conn, cfg, ahn2_dir, ahn2_fp,
-            #                         doexec=args_in['no_exec'])
+        if args_in['add_borders'] and manifest.todo('add_borders'):
+            with manifest.stage('add_borders', report):
+                logger.info("Configuring AHN2-3 border tiles")
+                border.create_border_table(conn, cfg, 
+                                           doexec=args_in['no_exec'])
+                # border.update_file_date(conn, cfg, ahn2_dir, ahn2_fp,
+                #                         doexec=args_in['no_exec'])
 
 
-        if args_in['run_3dfier']:
-            logger.info("Configuring batch3dfier")
-            clip_prefix = '_clip3dfy_'
-            logger.debug("clip_prefix is %s", clip_prefix)
-            cfg_out = batch3dfier.configure_tiles(conn, cfg, clip_prefix)
-            cfg_rest, cfg_ahn2, cfg_ahn3 = border.process(conn, cfg_out, ahn3_dir, 
-                                                          ahn2_dir, 
-                                                          export=False)
-            for c in [cfg_rest, cfg_ahn2, cfg_ahn3]:
-                # clean up previous files
-                if os.path.isdir(c['output']['staging']['dir']):
-                    rmtree(c['output']['staging']['dir'], ignore_errors=True, onerror=None)
-                    logger.debug("Deleted %s", c['output']['staging']['dir'])
-                try:
-                    os.makedirs(c['output']['staging']['dir'], exist_ok=False)
-                    logger.debug("Created %s", c['output']['staging']['dir'])
-                except Exception as e:
-                    logger.error(e)
-                    sys.exit(1)
-                
-                logger.info("Running batch3dfier")
-                res = process.run(conn, c, doexec=args_in['no_exec'])
+        if args_in['run_3dfier'] and manifest.todo('run_3dfier'):
+            with manifest.stage('run_3dfier', report):
+                logger.info("Configuring batch3dfier")
+                clip_prefix = '_clip3dfy_'
+                logger.debug("clip_prefix is %s", clip_prefix)
+                with report.stage('run_3dfier.configure'):
+                    cfg_out = batch3dfier.configure_tiles(conn, cfg, clip_prefix)
+                    if cfg['config']['incremental']:
+                        logger.info("Finding the changed BAG footprints")
+                        incremental.create_state_table(conn, cfg)
+                        incremental.find_changes(conn, cfg)
+                        affected = incremental.affected_tiles(conn, cfg)
+                        cfg_out['input_polygons']['tile_list'] = incremental.filter_tiles(
+                            cfg_out['input_polygons']['tile_list'], affected,
+                            prefix=cfg['input_polygons']['tile_prefix'])
+                        logger.info("Processing %s affected tiles",
+                                    len(cfg_out['input_polygons']['tile_list']))
+                    cfg_rest, cfg_ahn2, cfg_ahn3 = border.process(conn, cfg_out, ahn3_dir, 
+                                                                  ahn2_dir, 
+                                                                  export=False)
+                history = TileHistory(cfg['config']['history'])
+                # The tiles of the tile groups are processed by one pool of
+                # workers, and the output of every tile group is imported into
+                # its own table by one set of import workers while the rest
+                # of the tiles are processed. The
+                # tiles that were imported before the run was interrupted are
+                # skipped, the output of the tiles that were processed but not
+                # imported is imported again.
+                import_threads = importer.cap_import_threads(
+                    cfg['config']['threads'], cfg['config']['import_threads'],
+                    conn.free_connections())
+                workers = importer.ImportWorkers(conn, import_threads)
+                groups = []
+                for c in [cfg_rest, cfg_ahn2, cfg_ahn3]:
+                    group = os.path.basename(c['config']['in'])
+                    if not manifest.todo("3dfier " + group):
+                        continue
+                    done_tiles = manifest.done_tiles(group)
+                    imported_tiles = manifest.imported_tiles(group)
+                    # clean up previous files, unless they can be reused
+                    if cfg['config']['reuse_output'] or done_tiles:
+                        os.makedirs(c['output']['staging']['dir'], exist_ok=True)
+                    else:
+                        if os.path.isdir(c['output']['staging']['dir']):
+                            rmtree(c['output']['staging']['dir'], ignore_errors=True, onerror=None)
+                            logger.debug("Deleted %s", c['output']['staging']['dir'])
+                        try:
+                            os.makedirs(c['output']['staging']['dir'], exist_ok=False)
+                            logger.debug("Created %s", c['output']['staging']['dir'])
+                        except Exception as e:
+                            logger.error(e)
+                            sys.exit(1)
                 
-                restart = 0
-                while restart < 3:
-                    if res is None:
-                        break
-                    elif len(res) == 0:
-                        break
-                    elif len(res) > 0:
-                        restart += 1
-                        logger.info("Restarting 3dfier with tiles %s", res)
-                        c['input_polygons']['tile_list'] = res
-                        res = process.run(conn, c, doexec=args_in['no_exec'])
-                
-                if not os.listdir(c['output']['staging']['dir']):
-                    logger.warning("3dfier failed completely for %s, skipping import", 
-                                   c['config']['in'])
-                else:
-                    logger.info("Importing batch3dfier output into database")
-                    importer.import_csv(conn, c)
+                    if not imported_tiles:
+                        importer.drop_heights_table(conn, c)
+                    streaming = importer.StreamingImporter(
+                        conn, c, remove=cfg['config']['remove_csv'], workers=workers)
+                    for tile, out_path in done_tiles.items():
+                        streaming.submit(out_path, replace=True,
+                                         on_imported=partial(manifest.tile_imported, group, tile))
+                    if (done_tiles or imported_tiles) and c['input_polygons']['tile_list']:
+                        logger.info("Resuming %s with %s tiles already processed "
+                                    "and %s tiles already imported",
+                                    group, len(done_tiles), len(imported_tiles))
+                        c['input_polygons']['tile_list'] = [
+                            t for t in c['input_polygons']['tile_list']
+                            if t not in done_tiles and t not in imported_tiles]
+
+                    def on_tile_done(tile, out_path, group=group, streaming=streaming):
+                        manifest.tile_done(group, tile, out_path)
+                        streaming.submit(out_path,
+                                         on_imported=partial(manifest.tile_imported, group, tile))
+
+                    groups.append((group, c, streaming, on_tile_done))
             
-            logger.info("Joining 3D tables")
-            importer.unite_border_tiles(conn, cfg['output']['staging']['schema'],
-                                        cfg_ahn2['output']['staging']['bag3d_table'],
-                                        cfg_ahn3['output']['staging']['bag3d_table'])
-            importer.create_bag3d_table(conn, cfg['output']['staging']['schema'],
-                                        cfg['output']['staging']['bag3d_table'])
+                if groups:
+                    logger.info("Running batch3dfier")
+                    configs = [c for _, c, _, _ in groups]
+                    callbacks = [f for _, _, _, f in groups]
+                    with report.stage('run_3dfier.3dfier'):
+                        process.run_groups(conn, configs, doexec=args_in['no_exec'],
+                                           history=history, on_tile_done=callbacks)
+            
+                with report.stage('run_3dfier.import'):
+                    for group, c, streaming, _ in groups:
+                        nr_imported = streaming.finish()
+                        if nr_imported == 0 and not manifest.imported_tiles(group):
+                            logger.warning("3dfier failed completely for %s, skipping import", 
+                                           c['config']['in'])
+                        else:
+                            logger.info("Imported batch3dfier output of %s into database", group)
+                            importer.create_bag3d_relations(conn, c)
+                        manifest.stage_done("3dfier " + group)
+                    workers.close()
+            
+                history.close()
+
+                logger.info("Joining 3D tables")
+                with report.stage('run_3dfier.union'):
+                    importer.unite_border_tiles(conn, cfg['output']['staging']['schema'],
+                                                cfg_ahn2['output']['staging']['bag3d_table'],
+                                                cfg_ahn3['output']['staging']['bag3d_table'])
+                    importer.create_bag3d_table(conn, cfg['output']['staging']['schema'],
+                                                cfg['output']['staging']['bag3d_table'],
+                                                unlogged=cfg['config']['fast_load'],
+                                                nr_threads=cfg['config']['threads'] if cfg['config']['fast_load'] else 1)
             
-            logger.info("Cleaning up")
-            importer.drop_border_view(conn, cfg['output']['staging']['schema'])
-            for c in [cfg_rest, cfg_ahn2, cfg_ahn3]:
-                importer.drop_border_table(conn, c)
+                logger.info("Cleaning up")
+                importer.drop_border_view(conn, cfg['output']['staging']['schema'])
+                for c in [cfg_rest, cfg_ahn2, cfg_ahn3]:
+                    importer.drop_border_table(conn, c)
 
-        if args_in['export']:
-            # TODO: split migration into a separate module/step
-            logger.info("Migrating the 3D BAG to production")
-            exporter.migrate(conn, cfg)
-            logger.info("Exporting 3D BAG")
-            exporter.csv(conn, cfg, cfg['output']['production']['dir'])
-            exporter.gpkg(conn, cfg, cfg['output']['production']['dir'], args_in['no_exec'])
-            exporter.postgis(conn, cfg, cfg['output']['production']['dir'], args_in['no_exec'])
+        if args_in['export'] and manifest.todo('export'):
+            with manifest.stage('export', report):
+                # TODO: split migration into a separate module/step
+                with report.stage('export.migrate'):
+                    if cfg['config']['incremental'] and incremental.production_exists(conn, cfg):
+                        logger.info("Updating the changed footprints in production")
+                        incremental.upsert(conn, cfg)
+                    else:
+                        logger.info("Migrating the 3D BAG to production")
+                        exporter.migrate(conn, cfg)
+                    if cfg['config']['incremental']:
+                        incremental.create_state_table(conn, cfg)
+                        incremental.update_state(conn, cfg)
+                logger.info("Exporting 3D BAG")
+                with report.stage('export.csv'):
+                    exporter.csv(conn, cfg, cfg['output']['production']['dir'])
+                with report.stage('export.gpkg'):
+                    exporter.gpkg(conn, cfg, cfg['output']['production']['dir'], args_in['no_exec'])
+                with report.stage('export.postgis'):
+                    exporter.postgis(conn, cfg, cfg['output']['production']['dir'], args_in['no_exec'])
 
-        if args_in['grant_access']:
-            bag.grant_access(conn, args_in['grant_access'],
-                             cfg['input_polygons']['tile_schema'],
-                             cfg['tile_index']['polygons']['schema'],
-                             cfg['output']['production']['schema'])
+        if args_in['grant_access'] and manifest.todo('grant_access'):
+            with manifest.stage('grant_access', report):
+                bag.grant_access(conn, args_in['grant_access'],
+                                 cfg['input_polygons']['tile_schema'],
+                                 cfg['tile_index']['polygons']['schema'],
+                                 cfg['output']['production']['schema'])
 
-        if args_in['quality']:
-            # TODO: quality check needs to run on the staging schema, not the production, because it supposed to
-            # verify the quality BEFORE it goes to production
-            logger.info("Checking 3D BAG quality")
+        if args_in['quality'] and manifest.todo('quality'):
+            with manifest.stage('quality', report):
+                # TODO: quality check needs to run on the staging schema, not the production, because it supposed to
+                # verify the quality BEFORE it goes to production
+                logger.info("Checking 3D BAG quality")
 #             cfg_quality = quality.create_quality_views(conn, cfg)
-            quality.create_quality_table(conn)
-            counts = quality.get_counts(conn, cfg)
-            building_per_tile = quality.buildings_per_tile(conn, cfg)
-            quality.update_quality_table(conn, counts, building_per_tile)
+                quality.create_quality_table(conn)
+                counts = quality.get_counts(conn, cfg)
+                building_per_tile = quality.buildings_per_tile(conn, cfg)
+                quality.update_quality_table(conn, counts, building_per_tile)
 
 
         # Clean up
@@ -273,5 +388,9 @@ def app(cli_args, here, log_conf):
     except Exception as e:
         logger.exception(e)
     finally:
+        if db.db.profiler is not None:
+            db.db.profiler.log_summary()
+            report.attach('query_profile', db.db.profiler.summary())
+        report.close()
         conn.close()
         logging.shutdown()
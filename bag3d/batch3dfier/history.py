@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""Processing history of the tiles and progress reporting"""
+
+import sqlite3
+import threading
+import time
+import logging
+from datetime import timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class TileHistory(object):
+    """A local SQLite store of the 3dfier runs per tile
+
+    Every processed tile is recorded with its wall time, CPU time, peak RSS,
+    the bytes read and written, the size and number of points of its LAZ
+    files, the number of footprints in the output and the exit status of
+    3dfier. The runtimes of the successful runs are used for ordering the
+    tiles and for estimating the remaining time of a batch, their memory
+    use for predicting the memory use of the tiles.
+
+    The store can be shared by the worker threads.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite database, it is created if does not exist
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS tile_runs (
+                id integer PRIMARY KEY,
+                tile_group text,
+                tile text,
+                started real,
+                wall_time real,
+                cpu_time real,
+                peak_rss integer,
+                pc_size integer,
+                point_count integer,
+                footprint_count integer,
+                exit_status integer,
+                read_bytes integer,
+                write_bytes integer
+            );
+            """)
+            # The history of the earlier versions has no I/O columns
+            columns = [r[1] for r in self.conn.execute("PRAGMA table_info(tile_runs);")]
+            for c in ('read_bytes', 'write_bytes'):
+                if c not in columns:
+                    self.conn.execute("ALTER TABLE tile_runs ADD COLUMN %s integer;" % c)
+            self.conn.execute("""
+            CREATE INDEX IF NOT EXISTS tile_runs_tile_idx
+            ON tile_runs (tile_group, tile);
+            """)
+        logger.debug("Opened tile history %s", path)
+
+    def record(self, tile_group, tile, stats):
+        """Record a 3dfier run
+
+        Parameters
+        ----------
+        tile_group : str
+            The tile group, eg. 'rest', 'border_ahn2'
+        tile : str
+            Name of the tile
+        stats : dict
+            The 'stats' returned by :py:func:`bag3d.config.batch3dfier.call_3dfier`
+        """
+        row = (tile_group, tile, time.time(),
+               stats.get('wall_time'), stats.get('cpu_time'),
+               stats.get('peak_rss'), stats.get('pc_size'),
+               stats.get('point_count'), stats.get('footprint_count'),
+               stats.get('returncode'), stats.get('read_bytes'),
+               stats.get('write_bytes'))
+        with self.lock, self.conn:
+            self.conn.execute("""
+            INSERT INTO tile_runs (tile_group, tile, started, wall_time,
+                cpu_time, peak_rss, pc_size, point_count, footprint_count,
+                exit_status, read_bytes, write_bytes)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+            """, row)
+
+    def runtimes(self, tile_group):
+        """The average wall time of the successful runs per tile
+
+        Returns
+        -------
+        dict
+            {tile: wall time in seconds}
+        """
+        with self.lock:
+            r = self.conn.execute("""
+            SELECT tile, avg(wall_time)
+            FROM tile_runs
+            WHERE tile_group = ? AND exit_status = 0 AND wall_time IS NOT NULL
+            GROUP BY tile;
+            """, (tile_group,)).fetchall()
+        return dict(r)
+
+    def memory_use(self, limit=1000):
+        """The LAZ size and peak RSS of the latest successful runs
+
+        Returns
+        -------
+        list of tuple
+            (LAZ size in bytes, peak RSS in bytes), see
+            :py:meth:`bag3d.batch3dfier.scheduler.MemoryGate.observe`
+        """
+        with self.lock:
+            return self.conn.execute("""
+            SELECT pc_size, peak_rss
+            FROM tile_runs
+            WHERE exit_status = 0 AND pc_size > 0 AND peak_rss > 0
+            ORDER BY started DESC
+            LIMIT ?;
+            """, (limit,)).fetchall()
+
+    def close(self):
+        """Close the database"""
+        with self.lock:
+            self.conn.close()
+
+
+class ProgressReporter(object):
+    """Log the progress and the estimated time of arrival of a batch
+
+    The remaining time is the sum of the estimated runtimes of the tiles
+    that are not done yet, divided by the number of threads. Tiles without
+    an estimate count with the mean runtime of the finished tiles.
+
+    Parameters
+    ----------
+    tiles : list of str
+        The tiles in the batch
+    estimates : dict
+        {tile: estimated runtime in seconds}, see
+        :py:func:`bag3d.batch3dfier.scheduler.estimate_runtimes`
+    nr_threads : int
+        Number of worker threads
+    """
+
+    def __init__(self, tiles, estimates, nr_threads):
+        self.tiles = list(tiles)
+        self.estimates = estimates
+        self.nr_threads = nr_threads
+        self.finished = {}
+
+    def eta(self):
+        """Estimated remaining time in seconds, None if cannot estimate"""
+        done_times = [t for t in self.finished.values() if t is not None]
+        known = [e for e in self.estimates.values() if e is not None]
+        if done_times:
+            mean = sum(done_times) / len(done_times)
+        elif known:
+            mean = sum(known) / len(known)
+        else:
+            return None
+        remaining = 0.0
+        for tile in self.tiles:
+            if tile not in self.finished:
+                e = self.estimates.get(tile)
+                remaining += e if e is not None else mean
+        return remaining / self.nr_threads
+
+    def done(self, tile, wall_time=None):
+        """Register a finished tile and log the progress"""
+        self.finished[tile] = wall_time
+        eta = self.eta()
+        logger.info("%s/%s tiles done, ETA %s", len(self.finished),
+                    len(self.tiles),
+                    timedelta(seconds=int(eta)) if eta is not None else "unknown")
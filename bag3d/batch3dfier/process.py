@@ -4,130 +4,412 @@
 """The batch3dfier application."""
 
 import os
-import queue
+import time
 import threading
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import psutil
 
 from bag3d.config import batch3dfier
+from bag3d.batch3dfier import scheduler
+from bag3d.batch3dfier.history import ProgressReporter
+from bag3d.batch3dfier.status import RunStatus, StatusServer
 
 logger = logging.getLogger(__name__)
 
 
-def run(conn, config, doexec=True):
+def terminate_children():
+    """Terminate the child processes (3dfier) of the current process"""
+    for child in psutil.Process().children(recursive=True):
+        try:
+            child.terminate()
+            logger.debug("Terminated process %s", child.pid)
+        except psutil.NoSuchProcess:
+            pass
+
+
+class TileGroup(object):
+    """The tiles of a tile group (eg. rest, border_ahn2) and their results
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    config : dict
+        bag3d configuration of a tile group
+    doexec : bool
+        Passed to :py:func:`bag3d.update.bag.run_subprocess`
+    history : :py:class:`bag3d.batch3dfier.history.TileHistory`
+        If provided, the tile runs are recorded in it
+    on_tile_done : callable
+        If provided, it is called with the name and the output path of every
+        successfully processed tile as soon as the tile is done
     """
+
+    def __init__(self, conn, config, doexec=True, history=None,
+                 on_tile_done=None):
+        self.config = config
+        self.doexec = doexec
+        self.history = history
+        self.on_tile_done = on_tile_done
+        self.tiles = config['input_polygons']['tile_list']
+        self.cfg_dir = os.path.dirname(config['config']['in'])
+        pc_name_map = batch3dfier.pc_name_dict(config['input_elevation']['dataset_dir'],
+                                               config['input_elevation']['dataset_name'])
+        self.pc_file_idx = batch3dfier.pc_file_index(pc_name_map,
+                                                     cache=config['config'].get('pc_index_cache'))
+        self.tile_group = re.search(r"bag3d_cfg_(\w+).yml", config['config']['in']).group(1)
+        self.pc_tile_map = batch3dfier.find_pc_tiles_all(
+            conn,
+            table_index_pc=config['tile_index']['elevation'],
+            fields_index_pc=config['tile_index']['elevation']['fields'],
+            idx_identical=config['tile_index']['identical'],
+            tiles_footprint=self.tiles,
+            table_index_footprint=config['tile_index']['polygons'],
+            fields_index_footprint=config['tile_index']['polygons']['fields'],
+            extent_ewkb=config['extent_ewkb'],
+            prefix_tile_footprint=config['input_polygons']['tile_prefix'])
+        self.sizes = {tile: scheduler.pc_size(batch3dfier.pc_files(pc_tiles, self.pc_file_idx)[0])
+                      for tile, pc_tiles in self.pc_tile_map.items()}
+        self.runtimes = history.runtimes(self.tile_group) if history else {}
+        self.yml_template = batch3dfier.yaml_template(
+            dbname=conn.dbname, host=conn.host, port=conn.port, user=conn.user,
+            pw=conn.password, schema_tiles=config['input_polygons']['user_schema'],
+            uniqueid=config['input_polygons']['footprints']['fields']['uniqueid'])
+        self.config_mode = config['config'].get('config_mode', 'file')
+        self.batch_size = config['config'].get('batch_size', 1)
+        if config['tile_out'] and self.batch_size > 1:
+            logger.warning("Cannot batch the tiles with tile_out set, using batch size 1")
+            self.batch_size = 1
+        self.failures = {}
+        self.out_paths = []
+
+    def batches(self, tiles):
+        """Batch the tiles in the given order, see :py:func:`bag3d.batch3dfier.scheduler.batch_tiles`"""
+        return scheduler.batch_tiles(tiles, self.pc_tile_map, self.batch_size)
+
+    def process(self, conn, batch, mem_gate, on_start=None):
+        """Run 3dfier on a batch of tiles
+
+        The queries of the batch run on connections that are checked out from
+        the pool of conn, if it has one. on_start is called when 3dfier starts on the batch, see
+        :py:func:`bag3d.config.batch3dfier.call_3dfier`.
+
+        Returns
+        -------
+        list of dict
+            The result of :py:func:`bag3d.config.batch3dfier.call_3dfier` per tile
+        """
+        logger.debug("Processing %s" % batch)
+        if len(batch) == 1:
+            tile = batch[0]
+            pc_tiles = self.pc_tile_map.get(tile, {})
+        else:
+            tile = batch
+            pc_tiles = {}
+            for t in batch:
+                pc_tiles.update(self.pc_tile_map.get(t, {}))
+        config = self.config
+        res = batch3dfier.call_3dfier(
+            db=conn,
+            tile=tile,
+            schema_tiles=config['input_polygons']['user_schema'],
+            table_index_pc=config['tile_index']['elevation'],
+            fields_index_pc=config['tile_index']['elevation']['fields'],
+            idx_identical=config['tile_index']['identical'],
+            table_index_footprint=config['tile_index']['polygons'],
+            fields_index_footprint=config['tile_index']['polygons']['fields'],
+            uniqueid=config['input_polygons']['footprints']['fields']['uniqueid'],
+            extent_ewkb=config['extent_ewkb'],
+            clip_prefix=config['clip_prefix'],
+            prefix_tile_footprint=config['input_polygons']['tile_prefix'],
+            yml_dir=self.cfg_dir,
+            tile_out=config['tile_out'],
+            output_format='CSV-BUILDINGS-MULTIPLE',
+            output_dir=config['output']['staging']['dir'],
+            path_3dfier=config['path_3dfier'],
+            thread=threading.current_thread().name,
+            pc_file_index=self.pc_file_idx,
+            tile_group=self.tile_group,
+            doexec=self.doexec,
+            mem_gate=mem_gate,
+            pc_tiles=pc_tiles,
+            yml_template=self.yml_template,
+            config_mode=self.config_mode,
+            fingerprint=config['config'].get('reuse_output', False),
+            sample_interval=config['config'].get('sample_interval', 1.0),
+            on_start=on_start)
+        return res if len(batch) > 1 else [res]
+
+    def collect(self, batch, results):
+        """Record the results of a batch
+
+        Returns
+        -------
+        list of tuple
+            (tile, wall time) of the tiles in the batch
+        """
+        done = []
+        for tile, t in zip(batch, results):
+            stats = t.get('stats', {})
+            if t['tile_skipped'] is not None:
+                self.failures[tile] = scheduler.classify_failure(stats)
+            else:
+                self.failures.pop(tile, None)
+                self.out_paths.append(t['out_path'])
+                if self.on_tile_done:
+                    self.on_tile_done(tile, t['out_path'])
+            if self.history:
+                self.history.record(self.tile_group, tile, stats)
+            done.append((tile, stats.get('wall_time')))
+        return done
+
+    def finish(self, conn):
+        """Drop the temporary views and report the failed tiles
+
+        Returns
+        -------
+        set of str
+            The tiles that failed
+        """
+        config = self.config
+        # Drop temporary views that reference the clipped extent
+        try:
+            to_drop = [tile for tile in self.tiles if
+                       config['clip_prefix'] in tile or
+                       config['tile_out'] in tile]
+            if to_drop:
+                batch3dfier.drop_2Dtiles(
+                    conn,
+                    config['input_polygons']['user_schema'],
+                    views_to_drop=to_drop)
+        except TypeError:
+            logger.debug("No views to drop")
+        # Reporting
+        tiles = set(self.tiles)
+        tiles_skipped = set(self.failures)
+        logger.info("Total number of tiles processed in %s: %s", self.tile_group,
+                     str(len(tiles.difference(tiles_skipped))))
+        logger.info("Tiles skipped in %s: %s", self.tile_group, self.failures)
+        return tiles_skipped
+
+
+def run(conn, config, doexec=True, history=None, on_tile_done=None):
+    """Run 3dfier on the tiles in input_polygons:tile_list
+
+    Runs a single tile group with :py:func:`run_groups`.
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection. The workers use a connection pool created from it.
+    config : dict
+        bag3d configuration of a tile group
+    doexec : bool
+        Passed to :py:func:`bag3d.update.bag.run_subprocess`
+    history : :py:class:`bag3d.batch3dfier.history.TileHistory`
+        If provided, the tile runs are recorded in it, and the runtimes from
+        the previous runs are used for ordering the tiles and estimating the
+        remaining time
+    on_tile_done : callable
+        If provided, it is called with the name and the output path of every
+        successfully processed tile as soon as the tile is done, eg. for
+        queueing the output for :py:meth:`bag3d.importer.StreamingImporter.submit`
+
     Returns
     -------
     list of str
         The tiles that failed
     """
-    if config['input_polygons']['tile_list'] is None:
-        logger.error("tile_list in %s is empty, exiting function", config['config']['in'])
-        return None
-    else:
-        tiles = config['input_polygons']['tile_list']
-    cfg_dir = os.path.dirname(config['config']['in'])
-    pc_name_map = batch3dfier.pc_name_dict(config['input_elevation']['dataset_dir'], 
-                                           config['input_elevation']['dataset_name'])
-    pc_file_idx = batch3dfier.pc_file_index(pc_name_map)
-    tile_group = re.search(r"bag3d_cfg_(\w+).yml", config['config']['in']).group(1)
-
-    exitFlag = 0
-    tiles_skipped = []
-    out_paths = []
-
-    class myThread (threading.Thread):
-
-        def __init__(self, threadID, name, q):
-            threading.Thread.__init__(self)
-            self.threadID = threadID
-            self.name = name
-            self.q = q
-
-        def run(self):
-            process_data(self.name, self.q)
-            
-    def process_data(threadName, q):
-        while not exitFlag:
-            queueLock.acquire()
-            if not workQueue.empty():
-                tile = q.get()
-                queueLock.release()
-                logger.debug("Processing %s" % tile)
-                t = batch3dfier.call_3dfier(
-                    db=conn,
-                    tile=tile,
-                    schema_tiles=config['input_polygons']['user_schema'],
-                    table_index_pc=config['tile_index']['elevation'],
-                    fields_index_pc=config['tile_index']['elevation']['fields'],
-                    idx_identical=config['tile_index']['identical'],
-                    table_index_footprint=config['tile_index']['polygons'],
-                    fields_index_footprint=config['tile_index']['polygons']['fields'],
-                    uniqueid=config['input_polygons']['footprints']['fields']['uniqueid'],
-                    extent_ewkb=config['extent_ewkb'],
-                    clip_prefix=config['clip_prefix'],
-                    prefix_tile_footprint=config['input_polygons']['tile_prefix'],
-                    yml_dir=cfg_dir,
-                    tile_out=config['tile_out'],
-                    output_format='CSV-BUILDINGS-MULTIPLE',
-                    output_dir=config['output']['staging']['dir'],
-                    path_3dfier=config['path_3dfier'],
-                    thread=threadName,
-                    pc_file_index=pc_file_idx,
-                    tile_group=tile_group,
-                    doexec=doexec)
-                if t['tile_skipped'] is not None:
-                    tiles_skipped.append(t['tile_skipped'])
-                else:
-                    out_paths.append(t['out_path'])
-            else:
-                queueLock.release()
-
-    # Prep
-    threadList = ["Thread-" + str(t + 1) for t in range(config['config']['threads'])]
-    queueLock = threading.Lock()
-    workQueue = queue.Queue(0)
-    threads = []
-    threadID = 1
-    # Create new threads
-    for tName in threadList:
-        thread = myThread(threadID, tName, workQueue)
-        thread.start()
-        threads.append(thread)
-        threadID += 1
-    # Fill the queue
-    queueLock.acquire()
-    for tile in tiles:
-        workQueue.put(tile)
-    queueLock.release()
-    # Wait for queue to empty
-    while not workQueue.empty():
-        pass
-    # Notify threads it's time to exit
-    exitFlag = 1
-    # Wait for all threads to complete
-    for t in threads:
-        t.join()
-
-    # Drop temporary views that reference the clipped extent
-    try:
-        to_drop = [tile for tile in tiles if 
-                   config['clip_prefix'] in tile or 
-                   config['tile_out'] in tile]
-        if to_drop:
-            batch3dfier.drop_2Dtiles(
-                conn,
-                config['input_polygons']['user_schema'],
-                views_to_drop=to_drop)
-    except TypeError:
-        logger.debug("No views to drop")
-    # Reporting
-    tiles = set(tiles)
-    tiles_skipped = set(tiles_skipped)
-    logger.info("Total number of tiles processed: %s",
-                 str(len(tiles.difference(tiles_skipped))))
-    logger.info("Tiles skipped: %s", tiles_skipped)
-    
-    return tiles_skipped
+    return run_groups(conn, [config], doexec=doexec, history=history,
+                      on_tile_done=[on_tile_done])[0]
+
+
+def run_groups(conn, configs, doexec=True, history=None, on_tile_done=None):
+    """Run 3dfier on the tiles of several tile groups with one pool of workers
+
+    The tiles of all the tile groups are ordered together and processed by a
+    single pool of config:threads worker threads, so the small tile groups
+    (the AHN2-3 border tiles) do not leave the workers idle while the last
+    tiles of a group finish. A new tile is only handed to the pool when a
+    worker is free, thus the main thread blocks until a tile is done instead
+    of polling the queue.
+    Additionally, a worker only starts 3dfier when the predicted memory use
+    of the tile fits into the free memory (see
+    :py:class:`bag3d.batch3dfier.scheduler.MemoryGate`), keeping
+    config:mem_reserve bytes free.
+    The tiles are ordered by config:tile_order, see
+    :py:func:`bag3d.batch3dfier.scheduler.order_tiles`.
+    The 3dfier config is rendered once for the tile group and only the tile
+    specific fields are filled in per tile. It is passed to 3dfier as set in
+    config:config_mode, see :py:func:`bag3d.config.batch3dfier.config_file`.
+    With config:reuse_output the tiles whose inputs have not changed since
+    their last successful run are not processed again, their output is
+    reused, see :py:func:`bag3d.config.batch3dfier.tile_fingerprint`.
+    If config:batch_size is larger than 1, the tiles that share point cloud
+    files are processed in batches by a single 3dfier process, see
+    :py:func:`bag3d.batch3dfier.scheduler.batch_tiles`.
+    The failed tiles are retried one by one as set in config:retries and
+    config:retry_backoff, see :py:class:`bag3d.batch3dfier.scheduler.RetryPolicy`.
+    The number of queued, running, done and failed tiles and the throughput
+    are written to config:status_file and served on config:status_port if
+    they are set, see :py:class:`bag3d.batch3dfier.status.RunStatus`.
+    On KeyboardInterrupt the tiles that are not started yet are cancelled and
+    the running 3dfier processes are terminated.
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection. The workers use a connection pool created from it.
+    configs : list of dict
+        bag3d configuration of every tile group. The config:threads,
+        config:tile_order, config:mem_reserve, config:retries,
+        config:retry_backoff, config:status_file and config:status_port of
+        the first one are used.
+    doexec : bool
+        Passed to :py:func:`bag3d.update.bag.run_subprocess`
+    history : :py:class:`bag3d.batch3dfier.history.TileHistory`
+        If provided, the tile runs are recorded in it, and the runtimes from
+        the previous runs are used for ordering the tiles and estimating the
+        remaining time
+    on_tile_done : list of callable
+        If provided, the callable of a tile group is called with the name and
+        the output path of every successfully processed tile of the group as
+        soon as the tile is done, eg. for queueing the output for
+        :py:meth:`bag3d.importer.StreamingImporter.submit`
+
+    Returns
+    -------
+    list
+        The set of tiles that failed per tile group, or None if the
+        tile_list of the tile group is empty
+    """
+    on_tile_done = on_tile_done or [None] * len(configs)
+    groups = {}
+    for i, config in enumerate(configs):
+        if config['input_polygons']['tile_list'] is None:
+            logger.error("tile_list in %s is empty, skipping it", config['config']['in'])
+        else:
+            groups[i] = TileGroup(conn, config, doexec=doexec, history=history,
+                                  on_tile_done=on_tile_done[i])
+    if not groups:
+        return [None] * len(configs)
+    config = configs[0]
+    nr_threads = config['config']['threads']
+
+    # The tiles are identified by (group, tile) across the tile groups
+    keys = [(i, tile) for i, g in groups.items() for tile in g.tiles]
+    sizes = {(i, tile): size for i, g in groups.items()
+             for tile, size in g.sizes.items()}
+    runtimes = {(i, tile): rt for i, g in groups.items()
+                for tile, rt in g.runtimes.items()}
+    keys = scheduler.order_tiles(keys, sizes, runtimes=runtimes,
+                                 strategy=config['config'].get('tile_order', 'lpt'))
+    position = {key: n for n, key in enumerate(keys)}
+    batches = []
+    for i, g in groups.items():
+        ordered = [tile for (j, tile) in keys if j == i]
+        batches.extend((i, batch) for batch in g.batches(ordered))
+    batches.sort(key=lambda b: position[(b[0], b[1][0])])
+
+    progress = ProgressReporter(keys,
+                                scheduler.estimate_runtimes(keys, sizes, runtimes),
+                                nr_threads)
+    mem_gate = scheduler.MemoryGate(
+        reserve=config['config'].get('mem_reserve', 1024**3))
+    if history:
+        # The memory use of the tiles in the previous runs
+        for size, peak_rss in history.memory_use():
+            mem_gate.observe(size, peak_rss)
+
+    # The workers check out a connection for their queries, but they do not
+    # hold it while 3dfier runs, because 3dfier connects to the database too
+    conn.create_pool(1, nr_threads)
+
+    def process_tile(i, batch):
+        key = (i, tuple(batch))
+
+        def on_start():
+            # The batch is running when the memory gate admitted it
+            started.add(key)
+            status.start(len(batch))
+
+        return groups[i].process(conn, batch, mem_gate, on_start=on_start)
+
+    def collect(futures):
+        for future in futures:
+            i, batch = running.pop(future)
+            key = (i, tuple(batch))
+            was_started = key in started
+            started.discard(key)
+            try:
+                results = future.result()
+            except Exception:
+                logger.exception("Processing tile %s failed", batch)
+                for tile in batch:
+                    groups[i].failures[tile] = scheduler.CRASH
+                    progress.done((i, tile))
+                    status.finish(failed=True, started=was_started)
+                continue
+            for tile, wall_time in groups[i].collect(batch, results):
+                progress.done((i, tile), wall_time)
+                status.finish(wall_time, failed=tile in groups[i].failures,
+                              started=was_started)
+
+    def dispatch(batches, limit):
+        for i, batch in batches:
+            # Hand over a tile only when a worker is free
+            if len(running) >= limit:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                collect(done)
+            running[executor.submit(process_tile, i, batch)] = (i, batch)
+        done, _ = wait(running)
+        collect(done)
+
+    policy = scheduler.RetryPolicy(retries=config['config'].get('retries', 3),
+                                   backoff=config['config'].get('retry_backoff', 30.0))
+    status = RunStatus(len(keys), path=config['config'].get('status_file'))
+    server = None
+    if config['config'].get('status_port'):
+        try:
+            server = StatusServer(status, config['config']['status_port']).start()
+        except OSError as e:
+            logger.error("Cannot serve the run status: %s", e)
+    running = {}
+    started = set()
+    with ThreadPoolExecutor(max_workers=nr_threads,
+                            thread_name_prefix="Thread") as executor:
+        try:
+            dispatch(batches, nr_threads)
+            attempt = 1
+            while True:
+                # The failed tiles are retried without repeating the setup
+                failures = {(i, tile): f for i, g in groups.items()
+                            for tile, f in g.failures.items()}
+                retry = sorted(policy.retryable(failures, attempt), key=position.get)
+                if not retry:
+                    break
+                failures = {key: failures[key] for key in retry}
+                limit = policy.threads(nr_threads, failures, attempt)
+                delay = policy.delay(attempt)
+                logger.info("Retrying %s failed tiles in %s s with %s threads, retry %s",
+                            len(retry), delay, limit, attempt)
+                logger.debug("Retrying tiles %s", failures)
+                status.retry(len(retry))
+                time.sleep(delay)
+                dispatch([(i, [tile]) for i, tile in retry], limit)
+                attempt += 1
+        except KeyboardInterrupt:
+            logger.warning("Interrupted, cancelling %s running tiles", len(running))
+            for future in running:
+                future.cancel()
+            terminate_children()
+            raise
+        finally:
+            if server:
+                server.stop()
+
+    return [groups[i].finish(conn) if i in groups else None
+            for i in range(len(configs))]
@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+
+"""Ordering and admission control of the concurrent 3dfier processes"""
+
+import os
+import struct
+import threading
+import logging
+from random import shuffle
+from collections import deque
+from contextlib import contextmanager
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+
+def pc_size(pc_path):
+    """Total size of the point cloud files in bytes
+
+    Parameters
+    ----------
+    pc_path : list of str
+        Paths to the point cloud files
+
+    Returns
+    -------
+    int
+        Total size in bytes, missing files count as 0
+    """
+    size = 0
+    for p in pc_path:
+        try:
+            size += os.path.getsize(p)
+        except OSError:
+            logger.debug("Cannot get the size of %s", p)
+    return size
+
+
+class MemoryGate(object):
+    """Admit a 3dfier process only if its predicted memory use fits in the free memory
+
+    The memory use of a tile is predicted from the size of its LAZ files,
+    multiplied by the largest peak RSS / LAZ size ratio that was observed
+    on the tiles that are the most similar in LAZ size. Until there are any
+    observations, the default ratio is used.
+
+    A tile is admitted if (1) no other tile is running, or (2) the sum of
+    the predicted memory of the running tiles and the tile fits into the
+    budget, and the predicted memory of the tile is available right now.
+
+    Parameters
+    ----------
+    reserve : int
+        Memory in bytes that is kept free for the rest of the system
+    budget : int
+        Memory in bytes that the 3dfier processes can use together. If None,
+        the budget is computed on every check as the available memory plus
+        the memory of the child processes (the running 3dfier), minus the
+        reserve, so it follows the load of the machine during the run.
+    ratio : float
+        The default peak RSS / LAZ size ratio
+    nr_similar : int
+        The number of observations to use for the prediction
+    poll : float
+        Seconds between re-checking the available memory while waiting
+    """
+
+    def __init__(self, reserve=1024**3, budget=None, ratio=10.0, nr_similar=5,
+                 poll=5.0):
+        self.reserve = reserve
+        self.budget = budget
+        self.ratio = ratio
+        self.nr_similar = nr_similar
+        self.poll = poll
+        self.committed = 0
+        self.running = 0
+        self.observations = deque(maxlen=1000)
+        self.cond = threading.Condition()
+
+    def predict(self, size):
+        """Predict the peak memory use of a tile
+
+        Parameters
+        ----------
+        size : int
+            Total size of the LAZ files of the tile in bytes
+
+        Returns
+        -------
+        int
+            Predicted peak RSS in bytes
+        """
+        with self.cond:
+            obs = list(self.observations)
+        if not obs:
+            return int(size * self.ratio)
+        similar = sorted(obs, key=lambda o: abs(o[0] - size))[:self.nr_similar]
+        return int(size * max(rss / s for s, rss in similar))
+
+    def observe(self, size, peak_rss):
+        """Record the peak memory use of a finished tile"""
+        if size and peak_rss:
+            with self.cond:
+                self.observations.append((size, peak_rss))
+
+    def current_budget(self, available=None):
+        """The memory in bytes that the 3dfier processes can use together now"""
+        if self.budget is not None:
+            return self.budget
+        if available is None:
+            available = psutil.virtual_memory().available
+        used = 0
+        for p in psutil.Process().children(recursive=True):
+            try:
+                used += p.memory_info().rss
+            except (psutil.NoSuchProcess, psutil.ZombieProcess, psutil.AccessDenied):
+                pass
+        return available + used - self.reserve
+
+    def fits(self, predicted):
+        """Can a tile with the predicted memory use start now?"""
+        if self.running == 0:
+            return True
+        available = psutil.virtual_memory().available
+        if self.committed + predicted > self.current_budget(available):
+            return False
+        return predicted <= available - self.reserve
+
+    @contextmanager
+    def admit(self, tile, size):
+        """Block until the tile fits into memory, then hold its share of the budget
+
+        Parameters
+        ----------
+        tile : str
+            Name of the tile, for logging
+        size : int
+            Total size of the LAZ files of the tile in bytes
+        """
+        predicted = self.predict(size)
+        with self.cond:
+            if not self.fits(predicted):
+                logger.debug("Tile %s waits for %s MB memory", tile,
+                             predicted // 1024**2)
+                while not self.fits(predicted):
+                    self.cond.wait(self.poll)
+            self.committed += predicted
+            self.running += 1
+        try:
+            yield predicted
+        finally:
+            with self.cond:
+                self.committed -= predicted
+                self.running -= 1
+                self.cond.notify_all()
+
+
+def estimate_runtimes(tiles, sizes, runtimes=None):
+    """Estimate the processing time of the tiles
+
+    The processing time is the runtime of the tile from a previous run if
+    available. Otherwise it is estimated from the size of the LAZ files of
+    the tile, using the seconds per byte of the tiles with known runtime.
+
+    Parameters
+    ----------
+    tiles : list of str
+        Tile names
+    sizes : dict
+        {tile: LAZ size in bytes}
+    runtimes : dict
+        {tile: runtime in seconds} from previous runs
+
+    Returns
+    -------
+    dict
+        {tile: runtime in seconds}, None if cannot estimate
+    """
+    runtimes = runtimes or {}
+    known = [t for t in runtimes if sizes.get(t)]
+    if known:
+        sec_per_byte = sum(runtimes[t] for t in known) / sum(sizes[t] for t in known)
+    else:
+        sec_per_byte = None
+    estimates = {}
+    for tile in tiles:
+        if tile in runtimes:
+            estimates[tile] = runtimes[tile]
+        elif sec_per_byte is not None and tile in sizes:
+            estimates[tile] = sizes[tile] * sec_per_byte
+        else:
+            estimates[tile] = None
+    return estimates
+
+
+def order_tiles(tiles, sizes, runtimes=None, strategy='lpt'):
+    """Order the tiles for processing
+
+    With the 'lpt' (longest-processing-time-first) strategy the tiles with
+    the longest expected processing time are started first, so that the
+    large tiles do not end up running alone at the end of a batch. The
+    processing time is estimated with :py:func:`estimate_runtimes`. If no
+    runtimes are known at all, the tiles are simply ordered by their LAZ size.
+
+    Parameters
+    ----------
+    tiles : list of str
+        Tile names
+    sizes : dict
+        {tile: LAZ size in bytes}
+    runtimes : dict
+        {tile: runtime in seconds} from previous runs
+    strategy : str
+        'lpt', 'random' or 'none' to keep the input order
+
+    Returns
+    -------
+    list of str
+        The ordered tiles
+    """
+    tiles = list(tiles)
+    if strategy == 'none':
+        return tiles
+    elif strategy == 'random':
+        shuffle(tiles)
+        return tiles
+    elif strategy != 'lpt':
+        raise ValueError("Unknown tile ordering strategy %s" % strategy)
+    if not runtimes:
+        return sorted(tiles, key=lambda t: sizes.get(t, 0), reverse=True)
+    estimates = estimate_runtimes(tiles, sizes, runtimes)
+    known = [e for e in estimates.values() if e is not None]
+    mean = sum(known) / len(known) if known else 0
+
+    def cost(tile):
+        e = estimates[tile]
+        return e if e is not None else mean
+    return sorted(tiles, key=cost, reverse=True)
+
+
+def batch_tiles(tiles, pc_tiles, batch_size=1):
+    """Group the tiles that share point cloud files into batches
+
+    Every batch is seeded by the next unbatched tile in the order of the
+    tiles, and filled up with the unbatched tiles that share the most point
+    cloud files with the seed. Only the tiles with the same AHN version(s)
+    are batched together, and the tiles without point cloud files are not
+    batched.
+
+    Parameters
+    ----------
+    tiles : list of str
+        The ordered tile names
+    pc_tiles : dict
+        {tile: {point cloud tile: AHN version}}, see
+        :py:func:`bag3d.config.batch3dfier.find_pc_tiles_all`
+    batch_size : int
+        Maximum number of tiles in a batch
+
+    Returns
+    -------
+    list of list of str
+        The batches in the order of their seed
+    """
+    if batch_size <= 1:
+        return [[tile] for tile in tiles]
+    by_pc = {}
+    for tile in tiles:
+        for pc in pc_tiles.get(tile, {}):
+            by_pc.setdefault(pc, []).append(tile)
+    batched = set()
+    batches = []
+    for tile in tiles:
+        if tile in batched:
+            continue
+        batched.add(tile)
+        seed = pc_tiles.get(tile, {})
+        versions = set(seed.values())
+        shared = {}
+        for pc in seed:
+            for other in by_pc[pc]:
+                if other not in batched and \
+                        set(pc_tiles[other].values()) == versions:
+                    shared[other] = shared.get(other, 0) + 1
+        # stable sort keeps the tile order among the equally good candidates
+        members = sorted(shared, key=lambda t: shared[t], reverse=True)
+        members = members[:batch_size - 1]
+        batched.update(members)
+        batches.append([tile] + members)
+    return batches
+
+
+MISSING_INPUT = 'missing_input'
+OOM = 'oom'
+CRASH = 'crash'
+
+_MISSING_PATTERNS = ("no such file", "cannot open", "does not exist",
+                     "unable to open")
+_OOM_PATTERNS = ("bad_alloc", "out of memory", "cannot allocate memory")
+
+
+def classify_failure(stats):
+    """Classify the failure of a tile from its exit code and STDERR
+
+    Parameters
+    ----------
+    stats : dict
+        The 'stats' of a failed tile, see
+        :py:func:`bag3d.config.batch3dfier.call_3dfier`
+
+    Returns
+    -------
+    str
+        MISSING_INPUT if the point cloud or another input file is missing,
+        OOM if 3dfier ran out of memory or was killed by the OOM killer
+        (SIGKILL), CRASH otherwise. Only OOM and CRASH are worth retrying.
+    """
+    if stats.get('missing_input'):
+        return MISSING_INPUT
+    err = (stats.get('stderr') or stats.get('error') or "").lower()
+    returncode = stats.get('returncode')
+    if returncode in (-9, 137) or any(p in err for p in _OOM_PATTERNS):
+        return OOM
+    if any(p in err for p in _MISSING_PATTERNS):
+        return MISSING_INPUT
+    return CRASH
+
+
+class RetryPolicy(object):
+    """When and how the failed tiles are retried
+
+    Tiles with missing input are never retried. The other failed tiles are
+    retried at most `retries` times, after waiting `backoff` seconds that
+    doubles with every retry. If a tile ran out of memory, the number of
+    concurrent 3dfier processes is halved with every retry.
+
+    Parameters
+    ----------
+    retries : int
+        Maximum number of retries of a tile
+    backoff : float
+        Seconds to wait before the first retry
+    """
+
+    def __init__(self, retries=3, backoff=30.0):
+        self.retries = retries
+        self.backoff = backoff
+
+    def retryable(self, failures, attempt):
+        """The failed tiles to retry in the given retry
+
+        Parameters
+        ----------
+        failures : dict
+            {tile: failure class}, see :py:func:`classify_failure`
+        attempt : int
+            The number of the retry, starting at 1
+
+        Returns
+        -------
+        list
+            The tiles to retry
+        """
+        if attempt > self.retries:
+            return []
+        return [t for t, f in failures.items() if f != MISSING_INPUT]
+
+    def delay(self, attempt):
+        """Seconds to wait before the retry"""
+        return self.backoff * 2 ** (attempt - 1)
+
+    def threads(self, nr_threads, failures, attempt):
+        """Number of concurrent 3dfier processes in the retry"""
+        if OOM in failures.values():
+            return max(1, nr_threads >> attempt)
+        return nr_threads
+
+
+def las_point_count(path):
+    """Read the number of points from the header of a LAS/LAZ file
+
+    Parameters
+    ----------
+    path : str
+        Path to the LAS/LAZ file
+
+    Returns
+    -------
+    int
+        Number of point records, 0 if the header cannot be read
+    """
+    try:
+        with open(path, "rb") as f_in:
+            header = f_in.read(255)
+    except OSError:
+        logger.debug("Cannot read %s", path)
+        return 0
+    if len(header) < 111 or header[:4] != b"LASF":
+        return 0
+    minor = header[25]
+    header_size = struct.unpack_from("<H", header, 94)[0]
+    count = struct.unpack_from("<I", header, 107)[0]
+    if minor >= 4 and header_size >= 375 and len(header) >= 255:
+        # LAS 1.4 stores the legacy count as 0 for more than 2^32 points
+        count = struct.unpack_from("<Q", header, 247)[0] or count
+    return count
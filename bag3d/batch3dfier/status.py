@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+"""Live status of a batch3dfier run, as a JSON file and a Prometheus endpoint"""
+
+import os
+import json
+import time
+import threading
+import logging
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+logger = logging.getLogger(__name__)
+
+
+class RunStatus(object):
+    """Live counters of the tiles of a run
+
+    The tiles are either queued, running, done or failed. A tile is running
+    while 3dfier runs on it, a tile that waits for memory is still queued. A
+    failed tile that is retried is queued again. Besides the counters the
+    number of failures including the retried ones, the throughput in tiles
+    per hour and the average wall time of the last finished tiles are kept.
+    If `path` is provided, the status is written to it as JSON after every
+    change, atomically, so it can be read at any time.
+
+    Parameters
+    ----------
+    total : int
+        Number of tiles in the run
+    path : str
+        Path to the status file
+    window : int
+        Number of the last finished tiles for averaging the wall time
+    """
+
+    def __init__(self, total, path=None, window=50):
+        self.path = path
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.last_change = self.started
+        self.queued = total
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.failed_total = 0
+        self.wall_times = deque(maxlen=window)
+        self.write()
+
+    def start(self, n=1):
+        """3dfier started on n tiles"""
+        with self.lock:
+            self.queued -= n
+            self.running += n
+            self._changed()
+
+    def finish(self, wall_time=None, failed=False, started=True):
+        """A tile finished
+
+        Parameters
+        ----------
+        wall_time : float
+            Wall time of the tile in seconds
+        failed : bool
+        started : bool
+            False if 3dfier did not run on the tile, eg. its output was
+            reused, then the tile goes from queued to done or failed
+        """
+        with self.lock:
+            if started:
+                self.running -= 1
+            else:
+                self.queued -= 1
+            if failed:
+                self.failed += 1
+                self.failed_total += 1
+            else:
+                self.done += 1
+                if wall_time is not None:
+                    self.wall_times.append(wall_time)
+            self._changed()
+
+    def retry(self, n=1):
+        """n failed tiles are queued again"""
+        with self.lock:
+            self.failed -= n
+            self.queued += n
+            self._changed()
+
+    def _changed(self):
+        self.last_change = time.time()
+        self._write()
+
+    def snapshot(self):
+        """The current status
+
+        Returns
+        -------
+        dict
+        """
+        with self.lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        now = time.time()
+        hours = (now - self.started) / 3600
+        return {'queued': self.queued,
+                'running': self.running,
+                'done': self.done,
+                'failed': self.failed,
+                'failed_total': self.failed_total,
+                'tiles_per_hour': self.done / hours if hours > 0 else 0.0,
+                'avg_tile_seconds': (sum(self.wall_times) / len(self.wall_times)
+                                     if self.wall_times else None),
+                'started': self.started,
+                'last_change': self.last_change,
+                'updated': now}
+
+    def write(self):
+        """Write the status file"""
+        with self.lock:
+            self._write()
+
+    def _write(self):
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f_out:
+                json.dump(self._snapshot(), f_out)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.debug("Cannot write the status file %s: %s", self.path, e)
+
+    def prometheus(self):
+        """The status in the Prometheus text exposition format
+
+        Returns
+        -------
+        str
+        """
+        s = self.snapshot()
+        metrics = [
+            ('bag3d_tiles_queued', 'gauge', "Tiles waiting for a worker or for memory", s['queued']),
+            ('bag3d_tiles_running', 'gauge', "Tiles being processed", s['running']),
+            ('bag3d_tiles_done_total', 'counter', "Tiles processed successfully", s['done']),
+            ('bag3d_tiles_failed', 'gauge', "Tiles that failed and are not retried (yet)",
+             s['failed']),
+            ('bag3d_tiles_failed_total', 'counter',
+             "Tile failures, a retried tile counts once per failure", s['failed_total']),
+            ('bag3d_tiles_per_hour', 'gauge', "Tiles processed per hour", s['tiles_per_hour']),
+            ('bag3d_tile_seconds_avg', 'gauge',
+             "Average wall time of the last finished tiles", s['avg_tile_seconds']),
+            ('bag3d_last_change_timestamp_seconds', 'gauge',
+             "Time of the last change of the counters", s['last_change']),
+        ]
+        lines = []
+        for name, kind, help_text, value in metrics:
+            if value is None:
+                continue
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            lines.append("%s %s" % (name, value))
+        return "\n".join(lines) + "\n"
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StatusServer(object):
+    """Serve a :py:class:`RunStatus` over HTTP in a background thread
+
+    GET /metrics returns the status in the Prometheus text format, any other
+    path returns it as JSON.
+
+    Parameters
+    ----------
+    status : :py:class:`RunStatus`
+    port : int
+        Port to listen on
+    host : str
+        Address to listen on, only local by default
+    """
+
+    def __init__(self, status, port, host="127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") == "/metrics":
+                    body = status.prometheus().encode()
+                    ctype = "text/plain; version=0.0.4"
+                else:
+                    body = json.dumps(status.snapshot()).encode()
+                    ctype = "application/json"
+                self.send_response(200)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self.server = _HTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+        logger.info("Serving the run status on http://%s:%s/metrics",
+                    *self.server.server_address[:2])
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
@@ -5,6 +5,7 @@
 from sys import exit
 import os.path
 from shutil import rmtree
+from datetime import datetime
 import argparse
 import logging
 
@@ -36,6 +37,110 @@ def parse_console_args(args):
         help="The number of threads to run.",
         default=3,
         type=int)
+    parser.add_argument(
+        "--mem-reserve",
+        dest="mem_reserve",
+        help="Memory in GB that is kept free when starting new 3dfier processes.",
+        default=1.0,
+        type=float)
+    parser.add_argument(
+        "--tile-order",
+        dest="tile_order",
+        choices=['lpt', 'random', 'none'],
+        default='lpt',
+        help="The order of processing the tiles. 'lpt' starts the tiles with the longest expected processing time first.")
+    parser.add_argument(
+        "--history",
+        dest="history",
+        type=str,
+        help="SQLite database for the tile processing history. Defaults to bag3d_history.sqlite next to the configuration file.")
+    parser.add_argument(
+        "--batch-size",
+        dest="batch_size",
+        help="The maximum number of tiles that share point cloud files to process with a single 3dfier process.",
+        default=1,
+        type=int)
+    parser.add_argument(
+        "--import-threads",
+        dest="import_threads",
+        help="The number of CSV files to import into the database at the same time. Defaults to --threads, but it is lowered to fit in the free database connections.",
+        type=int)
+    parser.add_argument(
+        "--remove-csv",
+        dest="remove_csv",
+        action="store_true",
+        help="Delete the CSV output of 3dfier once it is imported into the database.")
+    parser.add_argument(
+        "--fast-load",
+        dest="fast_load",
+        action="store_true",
+        help="Load the 3dfier output into UNLOGGED staging tables and build their indexes in parallel. The production table is logged.")
+    parser.add_argument(
+        "--incremental",
+        dest="incremental",
+        action="store_true",
+        help="Only process the tiles with new, changed or deleted BAG footprints since the last export, and only update their footprints in production.")
+    parser.add_argument(
+        "--reuse-output",
+        dest="reuse_output",
+        action="store_true",
+        help="Keep the 3dfier output of the previous run and reuse it for the tiles whose footprints, point cloud files and configuration have not changed. Has no effect with --remove-csv.")
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="Resume the previous run, skipping its completed stages and tiles. The run is recorded in bag3d_manifest.json next to the configuration file.")
+    parser.add_argument(
+        "--retries",
+        dest="retries",
+        default=3,
+        type=int,
+        help="Maximum number of times a tile is retried after 3dfier crashed or ran out of memory. Tiles with missing input are not retried.")
+    parser.add_argument(
+        "--retry-backoff",
+        dest="retry_backoff",
+        default=30.0,
+        type=float,
+        help="Seconds to wait before the first retry, doubled for every further retry.")
+    parser.add_argument(
+        "--sample-interval",
+        dest="sample_interval",
+        default=1.0,
+        type=float,
+        help="Seconds between sampling the memory, CPU and I/O use of the 3dfier processes.")
+    parser.add_argument(
+        "--status-file",
+        dest="status_file",
+        type=str,
+        help="Path to a JSON file with the live status of the 3dfier run, updated after every tile.")
+    parser.add_argument(
+        "--status-port",
+        dest="status_port",
+        type=int,
+        help="Serve the live status of the 3dfier run in the Prometheus text format on http://127.0.0.1:<port>/metrics.")
+    parser.add_argument(
+        "--report",
+        dest="report",
+        type=str,
+        help="Path to the JSON run report with the wall, database and subprocess time of every stage. Defaults to bag3d_report_<time>.json next to the configuration file.")
+    parser.add_argument(
+        "--profile-db",
+        dest="profile_db",
+        type=float,
+        metavar="SECONDS",
+        help="Profile the database queries per call site, and log the EXPLAIN (ANALYZE, BUFFERS) of the queries that are slower than SECONDS. The slow queries are executed once more for this, in a transaction that is rolled back.")
+    parser.add_argument(
+        "--tile-partitioning",
+        dest="tile_partitioning",
+        choices=['view', 'table'],
+        default='view',
+        help="How the tile views select their footprints with --import-tile-idx. 'view' joins the footprint centroids with the tile polygon in every view, 'table' assigns the footprints to the tiles once into an indexed table and the views select from it by the tile name.")
+    parser.add_argument(
+        "--3dfier-config",
+        dest="config_mode",
+        choices=['memfd', 'tmpfs', 'file'],
+        default='file',
+        help="How to pass the configuration to 3dfier. 'file' (default) writes a file next to the configuration file, 'memfd' uses an in-memory file, 'tmpfs' a file in /dev/shm.")
     parser.add_argument(
         "--update-bag",
         dest='update_bag',
@@ -104,6 +209,7 @@ def parse_console_args(args):
     parser.set_defaults(update_bag=False)
     parser.set_defaults(bag_dump=None)
     parser.set_defaults(bag_date=None)
+    parser.set_defaults(history=None)
     parser.set_defaults(update_ahn=False)
     parser.set_defaults(update_ahn_raster=False)
     parser.set_defaults(import_tile_idx=False)
@@ -124,6 +230,25 @@ def parse_console_args(args):
         raise FileNotFoundError('Configuration file %s not found' % args_in['cfg_file'])
     args_in['cfg_dir'] = os.path.dirname(args_in['cfg_file'])
     args_in['threads'] = args.threads
+    args_in['mem_reserve'] = args.mem_reserve
+    args_in['tile_order'] = args.tile_order
+    args_in['history'] = args.history
+    args_in['config_mode'] = args.config_mode
+    args_in['batch_size'] = args.batch_size
+    args_in['import_threads'] = args.import_threads
+    args_in['remove_csv'] = args.remove_csv
+    args_in['fast_load'] = args.fast_load
+    args_in['incremental'] = args.incremental
+    args_in['reuse_output'] = args.reuse_output
+    args_in['resume'] = args.resume
+    args_in['retries'] = args.retries
+    args_in['retry_backoff'] = args.retry_backoff
+    args_in['sample_interval'] = args.sample_interval
+    args_in['status_file'] = args.status_file
+    args_in['status_port'] = args.status_port
+    args_in['report'] = args.report
+    args_in['profile_db'] = args.profile_db
+    args_in['tile_partitioning'] = args.tile_partitioning
     args_in['get_bag'] = args.get_bag
     args_in['update_bag'] = args.update_bag
     args_in['bag_dump'] = args.bag_dump
@@ -247,6 +372,36 @@ def parse_config(args_in, schema):
     cfg['config']['out_border_ahn2'] = os.path.join(ahn2_dir, "bag3d_cfg_border_ahn2.yml")
     cfg['config']['out_border_ahn3'] = os.path.join(ahn3_dir, "bag3d_cfg_border_ahn3.yml")
     cfg['config']['threads'] = int(args_in['threads'])
+    cfg['config']['mem_reserve'] = int(args_in['mem_reserve'] * 1024**3)
+    cfg['config']['tile_order'] = args_in['tile_order']
+    cfg['config']['config_mode'] = args_in['config_mode']
+    cfg['config']['batch_size'] = args_in['batch_size']
+    cfg['config']['import_threads'] = args_in['import_threads'] or cfg['config']['threads']
+    cfg['config']['remove_csv'] = args_in['remove_csv']
+    cfg['config']['fast_load'] = args_in['fast_load']
+    cfg['config']['incremental'] = args_in['incremental']
+    cfg['config']['reuse_output'] = args_in['reuse_output']
+    cfg['config']['retries'] = args_in['retries']
+    cfg['config']['retry_backoff'] = args_in['retry_backoff']
+    cfg['config']['sample_interval'] = args_in['sample_interval']
+    if args_in['status_file']:
+        cfg['config']['status_file'] = os.path.abspath(args_in['status_file'])
+    else:
+        cfg['config']['status_file'] = None
+    cfg['config']['status_port'] = args_in['status_port']
+    cfg['config']['profile_db'] = args_in['profile_db']
+    cfg['config']['tile_partitioning'] = args_in['tile_partitioning']
+    if args_in['report']:
+        cfg['config']['report'] = os.path.abspath(args_in['report'])
+    else:
+        cfg['config']['report'] = os.path.join(
+            rootdir, "bag3d_report_" + datetime.utcnow().strftime("%Y%m%dT%H%M%S") + ".json")
+    if args_in['history']:
+        cfg['config']['history'] = os.path.abspath(args_in['history'])
+    else:
+        cfg['config']['history'] = os.path.join(rootdir, "bag3d_history.sqlite")
+    cfg['config']['pc_index_cache'] = os.path.join(rootdir, "bag3d_pc_index.json")
+    cfg['config']['manifest'] = os.path.join(rootdir, "bag3d_manifest.json")
 
     #-- Get config file parameters
     # database connection
@@ -268,6 +423,10 @@ def parse_config(args_in, schema):
             tile_list, list), "Please provide input for tile_list as a list: [...]"
         cfg['input_polygons']['tile_list'] = tile_list
         cfg['input_polygons']['extent_file'] = None
+    # the table of the tile assignment of the footprints with
+    # --tile-partitioning table, in the schema of the footprints
+    cfg['input_polygons']['footprints']['tile_assignment'] = \
+        cfg['input_polygons']['footprints']['table'] + "_tile"
     # 'user_schema' is used for the '_clip3dfy_' and '_union' views, thus
     # only use 'user_schema' if 'extent' is provided
     USER_SCHEMA = cfg_stream['input_polygons']['user_schema']
@@ -2,24 +2,32 @@
 
 """Configure batch3dfier with the input data."""
 
+import os
 import os.path
 from os import remove
 import re
+import json
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 from pprint import pformat
-import time
 import logging
-from random import shuffle
 
 from shapely.geometry import shape
 from shapely import geos
+import psycopg2
 from psycopg2 import sql
 import fiona
 import psutil
 
 from bag3d.update import bag
+from bag3d.batch3dfier import scheduler
+from bag3d.config.db import StatementBatch, DDL_CHUNK_SIZE
 
 logger = logging.getLogger(__name__)
+logger_perf = logging.getLogger('performance')
 
 def call_3dfier(db, tile, schema_tiles,
                 table_index_pc, fields_index_pc, idx_identical,
@@ -28,8 +36,10 @@ def call_3dfier(db, tile, schema_tiles,
                 yml_dir, tile_out, output_format, output_dir,
                 path_3dfier, thread,
                 pc_file_index, tile_group,
-                doexec=True):
-    """Call 3dfier with the YAML config created by yamlr().
+                doexec=True, mem_gate=None, pc_tiles=None,
+                yml_template=None, config_mode='file', fingerprint=False,
+                sample_interval=1.0, on_start=None):
+    """Call 3dfier with the YAML config created by render_yaml().
 
     Note
     ----
@@ -38,9 +48,11 @@ def call_3dfier(db, tile, schema_tiles,
     Parameters
     ----------
     db : :py:class:`bag3d.config.db.db`
-        Open connection
-    tile : str
-        Name of of the 2D tile.
+        Open connection. If it has a pool, a connection is checked out for
+        the queries only, and not held while 3dfier runs.
+    tile : str or list of str
+        Name of of the 2D tile. If a list, the tiles are processed as a batch
+        with one 3dfier process and the output is split per tile.
     schema_tiles : str
         Schema of the footprint tiles.
     thread : str
@@ -52,6 +64,29 @@ def call_3dfier(db, tile, schema_tiles,
     prefix_tile_footprint : str or None
         Prefix prepended to the footprint tile view names. If None, the views are named as
         the values in fields_index_fooptrint['unit_name'].
+    mem_gate : :py:class:`bag3d.batch3dfier.scheduler.MemoryGate` or None
+        If provided, 3dfier is only started when the memory gate admits the tile.
+    pc_tiles : dict or None
+        The point cloud tiles of the tile (or all tiles of the batch) as in the values of
+        :py:func:`find_pc_tiles_all`. If None, they are queried with
+        :py:func:`find_pc_tiles`.
+    yml_template : str or None
+        The pre-rendered config of the tile group from :py:func:`yaml_template`.
+        If None, it is rendered for the tile.
+    config_mode : str
+        How to pass the config to 3dfier, see :py:func:`config_file`.
+    fingerprint : bool
+        If True, the output of the tile is reused if the fingerprint of its
+        inputs (see :py:func:`tile_fingerprint`) matches the fingerprint that
+        is stored next to the output. After a successful run, the fingerprint
+        is stored.
+    sample_interval : float
+        Seconds between the resource use samples of 3dfier, see
+        :py:class:`bag3d.update.bag.ResourceSampler`
+    on_start : callable or None
+        Called without arguments right before 3dfier starts, that is after
+        the memory gate admitted the tile. It is not called if 3dfier is not
+        run, eg. the output is reused or the point cloud is missing.
 
     Returns
     -------
@@ -61,37 +96,50 @@ def call_3dfier(db, tile, schema_tiles,
             was found in 'dataset_dir' (YAML)
         out_path : str
             Output path of 3dfier
+        stats : dict
+            pc_size, point_count, and if 3dfier was run wall_time, cpu_time,
+            peak_rss, read_bytes, write_bytes, returncode and footprint_count
+            of the tile. If the tile
+            failed, missing_input, stderr or error describe the failure, see
+            :py:func:`bag3d.batch3dfier.scheduler.classify_failure`.
+
+        For a batch of tiles, a list of such dicts. The wall_time and cpu_time
+        of the batch are shared among the tiles by their footprint_count.
     """
-    # perf = report_procs()
-    # if perf:
-    #     logger_perf.debug("%s - %s - %s" % (tile_group, tile, perf))
-    start = time.process_time()
-    tiles = find_pc_tiles(db, table_index_pc, fields_index_pc, idx_identical,
-                             table_index_footprint, fields_index_footprint,
-                             extent_ewkb, tile_footprint=tile,
-                             prefix_tile_footprint=prefix_tile_footprint)
-    p = [pc_file_index[tile] for tile in pc_file_index.keys() & tiles.keys()]
-    ahn_version = set([tiles[v] for v in pc_file_index.keys() & tiles.keys()])
-    pc_path = list(chain.from_iterable(p))
+    if isinstance(tile, (list, tuple)):
+        batch = list(tile)
+    else:
+        batch = [tile]
+    if len(batch) > 1 and (tile_out or "csv" not in output_format.lower()):
+        raise ValueError("A batch of tiles needs CSV output and no tile_out")
+    if pc_tiles is None:
+        tiles = {}
+        with db.checkout() as conn:
+            for t in batch:
+                tiles.update(find_pc_tiles(conn, table_index_pc, fields_index_pc,
+                                           idx_identical, table_index_footprint,
+                                           fields_index_footprint, extent_ewkb,
+                                           tile_footprint=t,
+                                           prefix_tile_footprint=prefix_tile_footprint))
+    else:
+        tiles = pc_tiles
+    pc_path, ahn_version = pc_files(tiles, pc_file_index)
+    stats = {'pc_size': scheduler.pc_size(pc_path),
+             'point_count': sum(scheduler.las_point_count(f) for f in pc_path)}
+    name = batch[0] if len(batch) == 1 else batch[0] + "_batch"
     # prepare output file name
     if not tile_out:
-        tile_out = tile.replace(clip_prefix, '', 1)
+        tile_out = batch[0].replace(clip_prefix, '', 1)
     if pc_path:
-        # Needs a YAML per thread so one doesn't overwrite it while the other
-        # uses it
-        yml_name = tile + ".yml"
-        yml_path = os.path.join(yml_dir, yml_name)
-        config = yamlr(dbname=db.dbname, host=db.host, port=db.port, user=db.user,
-                       pw=db.password, schema_tiles=schema_tiles,
-                       bag_tile=tile, pc_path=pc_path, uniqueid=uniqueid,
-                       ahn_version=ahn_version)
-        # Write temporary config file
+        if yml_template is None:
+            yml_template = yaml_template(dbname=db.dbname, host=db.host,
+                                         port=db.port, user=db.user,
+                                         pw=db.password,
+                                         schema_tiles=schema_tiles,
+                                         uniqueid=uniqueid)
+        config = render_yaml(yml_template, bag_tile=batch, pc_path=pc_path,
+                             ahn_version=ahn_version)
         logger.debug(config)
-        try:
-            with open(yml_path, "w") as text_file:
-                text_file.write(config)
-        except BaseException as e:
-            logger.exception("Error: cannot write %s", yml_path)
         # Prep output file name
         if "obj" in output_format.lower():
             o = tile_out + ".obj"
@@ -101,34 +149,259 @@ def call_3dfier(db, tile, schema_tiles,
             output_path = os.path.join(output_dir, o)
         else:
             output_path = os.path.join(output_dir, tile_out)
+        if len(batch) > 1:
+            # The output of the batch is split into the CSV of the tiles
+            out_paths = {t: os.path.join(output_dir,
+                                         t.replace(clip_prefix, '', 1) + ".csv")
+                         for t in batch}
+            output_path = os.path.join(output_dir, tile_out + ".batch")
+        tile_paths = out_paths if len(batch) > 1 else {tile: output_path}
         # Run 3dfier
-        command = [path_3dfier, yml_path, "--stat_RMSE", "--CSV-BUILDINGS-MULTIPLE", 
-                   output_path]
         try:
-            logger.debug(" ".join(command))
-            success = bag.run_subprocess(command, shell=True, doexec=doexec, monitor=True, tile_id=tile)
-            if success:
+            reused = False
+            if fingerprint:
+                with db.checkout() as conn:
+                    fps = {t: tile_fingerprint(conn, schema_tiles, t, pc_path, yml_template)
+                           for t in batch}
+                reused = all(read_fingerprint(tile_paths[t]) == fps[t] for t in batch)
+            if reused:
+                logger.info("Tile %s is unchanged, reusing its output", name)
+                stats['reused'] = True
+                success = True
+            else:
+                # A stale fingerprint must not outlive a failed run
+                for t in batch:
+                    remove_fingerprint(tile_paths[t])
+                # Needs a config per thread so one doesn't overwrite it while the
+                # other uses it
+                with config_file(config, name, yml_dir, mode=config_mode) as (yml_path, fds):
+                    command = [path_3dfier, yml_path, "--stat_RMSE",
+                               "--CSV-BUILDINGS-MULTIPLE", output_path]
+                    logger.debug(" ".join(command))
+                    if mem_gate:
+                        with mem_gate.admit(name, stats['pc_size']):
+                            if on_start:
+                                on_start()
+                            success = bag.run_subprocess(command, shell=True,
+                                                         doexec=doexec, monitor=True,
+                                                         tile_id=name, stats=stats,
+                                                         pass_fds=fds,
+                                                         sample_interval=sample_interval)
+                        mem_gate.observe(stats['pc_size'], stats.get('peak_rss'))
+                    else:
+                        if on_start:
+                            on_start()
+                        success = bag.run_subprocess(command, shell=True, doexec=doexec,
+                                                     monitor=True, tile_id=name,
+                                                     stats=stats, pass_fds=fds,
+                                                     sample_interval=sample_interval)
+            if success and len(batch) > 1:
+                if reused:
+                    counts = {t: count_csv_rows(out_paths[t]) or 0 for t in batch}
+                else:
+                    with db.checkout() as conn:
+                        tile_ids = get_tile_ids(conn, schema_tiles, batch, uniqueid)
+                    counts = split_csv(output_path, tile_ids, out_paths,
+                                       default=batch[0])
+                    remove(output_path)
+                tile_skipped = None
+            elif success:
                 tile_skipped = None
+                stats['footprint_count'] = count_csv_rows(output_path)
             else:
                 tile_skipped = tile
                 output_path = None
-            try:
-                remove(yml_path)
-            except Exception as e:
-                logger.error(e)
+            if success and fingerprint and not reused:
+                for t in batch:
+                    write_fingerprint(tile_paths[t], fps[t])
         except BaseException as e:
-            logger.exception("Cannot run 3dfier on tile %s", tile)
+            logger.exception("Cannot run 3dfier on tile %s", name)
+            stats['error'] = repr(e)
             tile_skipped = tile
             output_path = None
     else:
         logger.debug("Pointcloud file(s) %s not available. Skipping tile.",
                      str(tiles.keys()))
+        stats['missing_input'] = True
         tile_skipped = tile
         output_path = None
-    # end = time.process_time()
-    # proc_time = (end - start) / 60
-    # logger_perf.debug("%s - %s - process_time: %s" % (tile_group, tile, proc_time))
-    return {'tile_skipped': tile_skipped, 'out_path': output_path}
+    if len(batch) == 1:
+        log_tile_stats(tile_group, tile, stats)
+        return {'tile_skipped': tile_skipped, 'out_path': output_path, 'stats': stats}
+    # Share the time of the batch among the tiles by their number of footprints
+    results = []
+    for t in batch:
+        tile_stats = dict(stats, batch_size=len(batch))
+        if tile_skipped is None:
+            total = sum(counts.values())
+            share = counts[t] / total if total else 1 / len(batch)
+            for k in ('wall_time', 'cpu_time'):
+                if tile_stats.get(k) is not None:
+                    tile_stats[k] = tile_stats[k] * share
+            tile_stats['footprint_count'] = counts[t]
+            results.append({'tile_skipped': None, 'out_path': out_paths[t],
+                            'stats': tile_stats})
+        else:
+            results.append({'tile_skipped': t, 'out_path': None,
+                            'stats': tile_stats})
+        log_tile_stats(tile_group, t, tile_stats)
+    return results
+
+
+def log_tile_stats(tile_group, tile, stats):
+    """Log the summary of a tile to the 'performance' logger as a JSON record"""
+    record = {'event': 'tile', 'tile_group': tile_group, 'tile': tile}
+    record.update((k, v) for k, v in stats.items() if k != 'stderr')
+    logger_perf.debug(json.dumps(record, default=str))
+
+
+def tile_fingerprint(db, schema_tiles, tile, pc_path, yml_template):
+    """Fingerprint of the inputs of a tile
+
+    The fingerprint is the SHA-256 of the content of the footprint tile view,
+    the paths, sizes and modification times of the point cloud files, and
+    the 3dfier config template.
+
+    Parameters
+    ----------
+    db : :py:class:`bag3d.config.db.db`
+        Open connection
+    schema_tiles : str
+        Schema of the footprint tile views
+    tile : str
+        Name of the footprint tile view
+    pc_path : list of str
+        Paths to the point cloud files of the tile
+    yml_template : str
+        The config template from :py:func:`yaml_template`
+
+    Returns
+    -------
+    str
+        Hex digest
+    """
+    query = sql.SQL("""
+    SELECT md5(coalesce(string_agg(t::text, ';' ORDER BY t::text), ''))
+    FROM {schema}.{view} t;
+    """).format(schema=sql.Identifier(schema_tiles), view=sql.Identifier(tile))
+    logger.debug(db.print_query(query))
+    h = hashlib.sha256()
+    h.update(db.getQuery(query)[0][0].encode())
+    for p in sorted(pc_path):
+        st = os.stat(p)
+        h.update(("%s;%s;%s\n" % (p, st.st_size, st.st_mtime_ns)).encode())
+    h.update(yml_template.encode())
+    return h.hexdigest()
+
+
+def read_fingerprint(output_path):
+    """The fingerprint stored next to the output, None if there is no output or fingerprint"""
+    if not os.path.exists(output_path):
+        return None
+    try:
+        with open(output_path + ".fingerprint", "r") as f_in:
+            return f_in.read().strip()
+    except OSError:
+        return None
+
+
+def write_fingerprint(output_path, fingerprint):
+    """Store the fingerprint next to the output"""
+    with open(output_path + ".fingerprint", "w") as f_out:
+        f_out.write(fingerprint)
+
+
+def remove_fingerprint(output_path):
+    """Delete the fingerprint next to the output if exists"""
+    try:
+        remove(output_path + ".fingerprint")
+    except FileNotFoundError:
+        pass
+
+
+def get_tile_ids(db, schema_tiles, tiles, uniqueid):
+    """Map the footprint IDs to the footprint tiles with a single query
+
+    Parameters
+    ----------
+    db : :py:class:`bag3d.config.db.db`
+        Open connection
+    schema_tiles : str
+        Schema of the footprint tile views
+    tiles : list of str
+        Names of the footprint tile views
+    uniqueid : str
+        The ID field of the footprints
+
+    Returns
+    -------
+    dict
+        {footprint ID: tile}
+    """
+    query = sql.SQL(" UNION ALL ").join(
+        sql.SQL("SELECT {uniqueid}::text, {tile} FROM {schema}.{view}").format(
+            uniqueid=sql.Identifier(uniqueid),
+            tile=sql.Literal(tile),
+            schema=sql.Identifier(schema_tiles),
+            view=sql.Identifier(tile))
+        for tile in tiles)
+    logger.debug(db.print_query(query))
+    return dict(db.getQuery(query))
+
+
+def split_csv(path, tile_ids, out_paths, default):
+    """Split a CSV-BUILDINGS-MULTIPLE output of a batch of tiles per tile
+
+    Every output file gets the header of the input.
+
+    Parameters
+    ----------
+    path : str
+        The CSV of the batch
+    tile_ids : dict
+        {footprint ID: tile}, see :py:func:`get_tile_ids`
+    out_paths : dict
+        {tile: output path}
+    default : str
+        The tile of the rows with an unknown footprint ID
+
+    Returns
+    -------
+    dict
+        {tile: number of rows written}
+    """
+    counts = {t: 0 for t in out_paths}
+    files = {}
+    unknown = 0
+    try:
+        with open(path, "r") as f_in:
+            header = next(f_in, "")
+            for t, p in out_paths.items():
+                files[t] = open(p, "w")
+                files[t].write(header)
+            for line in f_in:
+                t = tile_ids.get(line.split(",", 1)[0].strip('"'))
+                if t is None:
+                    t = default
+                    unknown += 1
+                files[t].write(line)
+                counts[t] += 1
+    finally:
+        for f in files.values():
+            f.close()
+    if unknown:
+        logger.warning("%s footprints in %s are not in any tile of the batch, "
+                       "assigned to %s", unknown, path, default)
+    return counts
+
+
+def count_csv_rows(path):
+    """Count the data rows (without header) in a CSV file, None if cannot read"""
+    try:
+        with open(path, "rb") as f_in:
+            return max(sum(1 for line in f_in) - 1, 0)
+    except OSError:
+        return None
 
 
 def yamlr(dbname, host, port, user, pw, schema_tiles,
@@ -145,40 +418,47 @@ def yamlr(dbname, host, port, user, pw, schema_tiles,
     str
         the YAML config file for 3dfier
     """
+    template = yaml_template(dbname=dbname, host=host, port=port, user=user,
+                             pw=pw, schema_tiles=schema_tiles, uniqueid=uniqueid)
+    return render_yaml(template, bag_tile=bag_tile, pc_path=pc_path,
+                       ahn_version=ahn_version)
 
-    pc_dataset = ""
-    if len(pc_path) > 1:
-        for p in pc_path:
-            pc_dataset += "- " + p + "\n" + "      "
-    else:
-        pc_dataset += "- " + pc_path[0]
 
+def _escape(value):
+    """Escape the braces for str.format()"""
+    return str(value).replace("{", "{{").replace("}", "}}")
+
+
+def yaml_template(dbname, host, port, user, pw, schema_tiles, uniqueid):
+    """Pre-render the YAML config file for 3dfier for a tile group.
+
+    The values that are the same for every tile are filled in, the
+    {bag_tile}, {pc_path} and {las_building} fields are left for
+    :py:func:`render_yaml`.
+
+    Returns
+    -------
+    str
+        the YAML config template for 3dfier
+    """
     # !!! Do not correct the indentation of the config template, otherwise it
     # results in 'YAML::TypedBadConversion<std::__cxx11::basic_string<char, std::char_traits<char>, std::allocator<char> > >'
     # because every line is indented as here
     if pw:
-        d = 'PG:dbname={dbname} host={host} port={port} user={user} password={pw} schemas={schema_tiles} tables={bag_tile}'
-        dns = d.format(dbname=dbname,
-               host=host,
-               port=port,
-               user=user,
-               pw=pw,
-               schema_tiles=schema_tiles,
-               bag_tile=bag_tile)
+        d = 'PG:dbname={dbname} host={host} port={port} user={user} password={pw} schemas={schema_tiles} tables={{bag_tile}}'
+        dns = d.format(dbname=_escape(dbname),
+               host=_escape(host),
+               port=_escape(port),
+               user=_escape(user),
+               pw=_escape(pw),
+               schema_tiles=_escape(schema_tiles))
     else:
-        d = 'PG:dbname={dbname} host={host} port={port} user={user} schemas={schema_tiles} tables={bag_tile}'
-        dns = d.format(dbname=dbname,
-               host=host,
-               port=port,
-               user=user,
-               schema_tiles=schema_tiles,
-               bag_tile=bag_tile)
-    if ahn_version == set([2]):
-        lasb = [1]
-    elif ahn_version == set([3]):
-        lasb = [6]
-    elif ahn_version == set([2,3]):
-        lasb = [1,6]
+        d = 'PG:dbname={dbname} host={host} port={port} user={user} schemas={schema_tiles} tables={{bag_tile}}'
+        dns = d.format(dbname=_escape(dbname),
+               host=_escape(host),
+               port=_escape(port),
+               user=_escape(user),
+               schema_tiles=_escape(schema_tiles))
 
     config = """
 input_polygons:
@@ -191,14 +471,14 @@ lifting_options:
   Building:
     roof:
       height: percentile-95
-      use_LAS_classes: {las_building}
+      use_LAS_classes: {{las_building}}
     ground:
       height: percentile-10
       use_LAS_classes: [2]
 
 input_elevation:
   - datasets:
-      {pc_path}
+      {{pc_path}}
     omit_LAS_classes:
     thinning: 0
 
@@ -207,12 +487,96 @@ options:
   radius_vertex_elevation: 0.5
   threshold_jump_edges: 0.5
         """.format(dns=dns,
-                   uniqueid=uniqueid,
-                   pc_path=pc_dataset,
-                   las_building=lasb)
+                   uniqueid=_escape(uniqueid))
     return config
 
 
+def render_yaml(template, bag_tile, pc_path, ahn_version):
+    """Fill in the tile specific fields of a config from :py:func:`yaml_template`.
+
+    Parameters
+    ----------
+    bag_tile : str or list of str
+        The footprint tile(s). Multiple tiles are read as the layers of a
+        single dataset.
+    ahn_version : set
+        Version of the latest available AHN point cloud for the current tile
+
+    Returns
+    -------
+    str
+        the YAML config file for 3dfier
+    """
+    pc_dataset = ""
+    if len(pc_path) > 1:
+        for p in pc_path:
+            pc_dataset += "- " + p + "\n" + "      "
+    else:
+        pc_dataset += "- " + pc_path[0]
+
+    if ahn_version == set([2]):
+        lasb = [1]
+    elif ahn_version == set([3]):
+        lasb = [6]
+    elif ahn_version == set([2,3]):
+        lasb = [1,6]
+
+    if not isinstance(bag_tile, str):
+        bag_tile = ",".join(bag_tile)
+    return template.format(bag_tile=bag_tile,
+                           pc_path=pc_dataset,
+                           las_building=lasb)
+
+
+@contextmanager
+def config_file(config, tile, yml_dir, mode='file'):
+    """Make the 3dfier config available on a path for the duration of the context.
+
+    Parameters
+    ----------
+    config : str
+        The YAML config
+    tile : str
+        Name of the tile, used for naming the file
+    yml_dir : str
+        Directory of the config files in 'file' mode
+    mode : str
+        'memfd' keeps the config in an anonymous in-memory file that is
+        passed to 3dfier as /dev/fd/N, 'tmpfs' writes it into /dev/shm, 'file'
+        writes it into yml_dir. If memfd is not supported, 'tmpfs' is used.
+
+    Yields
+    ------
+    tuple
+        (path, file descriptors that need to be passed to the subprocess)
+    """
+    if mode == 'memfd' and hasattr(os, 'memfd_create') and os.path.isdir('/dev/fd'):
+        fd = os.memfd_create(tile)
+        try:
+            os.write(fd, config.encode())
+            yield "/dev/fd/%s" % fd, (fd,)
+        finally:
+            os.close(fd)
+        return
+    elif mode in ('memfd', 'tmpfs'):
+        d = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        fd, yml_path = tempfile.mkstemp(prefix=tile + "_", suffix=".yml", dir=d)
+        os.close(fd)
+    elif mode == 'file':
+        yml_path = os.path.join(yml_dir, tile + ".yml")
+    else:
+        raise ValueError("Unknown 3dfier config mode %s" % mode)
+    try:
+        with open(yml_path, "w") as text_file:
+            text_file.write(config)
+        yield yml_path, ()
+    finally:
+        try:
+            remove(yml_path)
+        except OSError as e:
+            logger.error(e)
+
+
 def pc_name_dict(pc_dir, dataset_name):
     """Map dataset_dir to dataset_name
     
@@ -238,7 +602,58 @@ def pc_name_dict(pc_dir, dataset_name):
     return pc_name_map
 
 
-def pc_file_index(pc_name_map):
+def scan_pc_dir(pc_dir, name):
+    """Index the point cloud files in a directory
+    
+    Parameters
+    ----------
+    pc_dir : str
+        Path to the directory
+    name : str
+        File name pattern, such as in 'input_elevation: dataset_name'
+    
+    Returns
+    -------
+    dict
+        {pc_tile_name: [path/to/pc_file]}
+    """
+    idx = {}
+    l = name[:name.find('{')]
+    r = name[name.find('}')+1:]
+    reg = '(?<=' + l + ').*(?=' + r + ')'
+    t_pat = re.compile(reg, re.IGNORECASE)
+    with os.scandir(pc_dir) as it:
+        for entry in it:
+            if entry.is_file():
+                pc_tile = t_pat.search(entry.name)
+                if pc_tile:
+                    tile = pc_tile.group(0).lower()
+                    idx[tile] = [entry.path]
+    return idx
+
+
+def read_pc_index_cache(cache):
+    """Read the point cloud file index cache, empty if cannot read"""
+    try:
+        with open(cache, "r") as f_in:
+            return json.load(f_in)
+    except (OSError, ValueError):
+        logger.debug("Cannot read point cloud index cache %s", cache)
+        return {}
+
+
+def write_pc_index_cache(cache, content):
+    """Write the point cloud file index cache atomically"""
+    tmp = cache + ".tmp"
+    try:
+        with open(tmp, "w") as f_out:
+            json.dump(content, f_out)
+        os.replace(tmp, cache)
+    except OSError:
+        logger.exception("Cannot write point cloud index cache %s", cache)
+
+
+def pc_file_index(pc_name_map, cache=None):
     """Create an index table of the pointcloud files in the given directories
     
     Maps the location of the point cloud files to the point cloud tile IDs/names.
@@ -263,6 +678,16 @@ def pc_file_index(pc_name_map):
     3dfier doesn't consider vertically split point clouds.
     See `Issue #61 <https://github.com/tudelft3d/3dfier/issues/61>`_
     
+    The directories are scanned in parallel. If a cache file is provided,
+    only those directories are scanned whose modification time or file
+    name pattern changed since the index was cached.
+    
+    Parameters
+    ----------
+    pc_name_map : dict
+        As returned by :py:func:`pc_name_dict`
+    cache : str
+        Path to a JSON file for caching the index of the directories
     
     Returns
     -------
@@ -277,21 +702,27 @@ def pc_file_index(pc_name_map):
         return(d[1]['priority'])
     d_sort = sorted(pc_name_map.items(), key=get_priority)
     
-    for elem in d_sort:
-        idx = {}
-        name = elem[1]['name']
-        l = name[:name.find('{')]
-        r = name[name.find('}')+1:]
-        reg = '(?<=' + l + ').*(?=' + r + ')'
-        t_pat = re.compile(reg, re.IGNORECASE)
-        for item in os.listdir(elem[0]):
-            path = os.path.join(elem[0], item)
-            if os.path.isfile(path):
-                pc_tile = t_pat.search(item)
-                if pc_tile:
-                    tile = pc_tile.group(0).lower()
-                    idx[tile] = [path]
-        f_idx[elem[0]] = idx
+    cached = read_pc_index_cache(cache) if cache else {}
+    to_scan = {}
+    for pc_dir, d in d_sort:
+        mtime = os.stat(pc_dir).st_mtime_ns
+        c = cached.get(pc_dir)
+        if c and c['name'] == d['name'] and c['mtime'] == mtime:
+            f_idx[pc_dir] = c['index']
+        else:
+            to_scan[pc_dir] = (d['name'], mtime)
+    if to_scan:
+        logger.debug("Scanning point cloud directories %s", list(to_scan.keys()))
+        with ThreadPoolExecutor(max_workers=len(to_scan)) as executor:
+            scans = {pc_dir: executor.submit(scan_pc_dir, pc_dir, name)
+                     for pc_dir, (name, mtime) in to_scan.items()}
+        for pc_dir, future in scans.items():
+            f_idx[pc_dir] = future.result()
+            cached[pc_dir] = {'name': to_scan[pc_dir][0],
+                              'mtime': to_scan[pc_dir][1],
+                              'index': f_idx[pc_dir]}
+        if cache:
+            write_pc_index_cache(cache, cached)
     # d_sort is [('/some/path', {'name': 'a_{tile}.laz', 'priority': 0}), ...]
     for d in reversed(d_sort):
         dirname = d[0]
@@ -313,6 +744,147 @@ def pc_file_index(pc_name_map):
     return file_index
 
 
+def pc_files(pc_tiles, pc_file_index):
+    """Select the point cloud files of the point cloud tiles
+    
+    Parameters
+    ----------
+    pc_tiles : dict
+        {AHN tile name: AHN version} as returned by :py:func:`find_pc_tiles`
+    pc_file_index : dict
+        As returned by :py:func:`pc_file_index`
+    
+    Returns
+    -------
+    tuple
+        (list of point cloud file paths, set of AHN versions)
+    """
+    available = pc_file_index.keys() & pc_tiles.keys()
+    p = [pc_file_index[t] for t in available]
+    ahn_version = set([pc_tiles[t] for t in available])
+    return list(chain.from_iterable(p)), ahn_version
+
+
+def find_pc_tiles_all(conn, table_index_pc, fields_index_pc, idx_identical,
+                      tiles_footprint, table_index_footprint=None,
+                      fields_index_footprint=None, extent_ewkb=None,
+                      prefix_tile_footprint=None):
+    """Find the point cloud tiles of all footprint tiles with a single query.
+    
+    The bulk equivalent of :py:func:`find_pc_tiles`.
+    
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    tiles_footprint : list of str
+        Names of the footprint tile views
+    prefix_tile_footprint : str or None
+        Prefix prepended to the footprint tile view names. If None, the views are named as
+        the values in fields_index_fooptrint['unit_name'].
+    
+    Returns
+    -------
+    dict
+        Contains the footprint tile view name as key, and the dict of
+        {AHN tile name: AHN version} of the tile as value.
+        Eg. {'t_37hn1': {'37hn1': 3, '37hz1': 2}}
+    """
+    schema_pc_q = sql.Identifier(table_index_pc['schema'])
+    table_pc_q = sql.Identifier(table_index_pc['table'])
+    field_pc_unit_q = sql.Identifier(fields_index_pc['unit_name'])
+    field_pc_geom_q = sql.Identifier(fields_index_pc['geometry'])
+    
+    if not tiles_footprint:
+        return {}
+    # footprint unit name -> footprint view name
+    units = {}
+    for tile in tiles_footprint:
+        if prefix_tile_footprint:
+            units[tile.replace(prefix_tile_footprint, '', 1)] = tile
+        else:
+            units[tile] = tile
+    units_q = sql.Literal(list(units.keys()))
+    
+    if extent_ewkb:
+        # every tile is clipped to the extent, thus they need the same point clouds
+        query = sql.SQL("""
+        SELECT
+            NULL
+            ,{table_pc}.{field_pc_unit}
+            ,{table_pc}.ahn_version
+        FROM
+            {schema_pc}.{table_pc}
+        WHERE st_intersects({table_pc}.{field_pc_geom}, {ewkb}::geometry);
+        """).format(table_pc=table_pc_q,
+                    field_pc_unit=field_pc_unit_q,
+                    field_pc_geom=field_pc_geom_q,
+                    schema_pc=schema_pc_q,
+                    ewkb=sql.Literal(extent_ewkb))
+    elif idx_identical:
+        # because the footprint and elevation tile IDs are identical
+        query = sql.SQL("""
+        SELECT
+            {table_pc}.{field_pc_unit}
+            ,{table_pc}.{field_pc_unit}
+            ,{table_pc}.ahn_version
+        FROM
+            {schema_pc}.{table_pc}
+        WHERE {table_pc}.{field_pc_unit} = ANY({units});
+        """).format(table_pc=table_pc_q,
+                    field_pc_unit=field_pc_unit_q,
+                    schema_pc=schema_pc_q,
+                    units=units_q)
+    else:
+        schema_ftpr_q = sql.Identifier(table_index_footprint['schema'])
+        table_ftpr_q = sql.Identifier(table_index_footprint['table'])
+        field_ftpr_geom_q = sql.Identifier(fields_index_footprint['geometry'])
+        field_ftpr_unit_q = sql.Identifier(fields_index_footprint['unit_name'])
+        query = sql.SQL("""
+        SELECT
+            {table_ftpr}.{field_ftpr_unit}
+            ,{table_pc}.{field_pc_unit}
+            ,{table_pc}.ahn_version
+        FROM
+            {schema_pc}.{table_pc},
+            {schema_ftpr}.{table_ftpr}
+        WHERE
+            {table_ftpr}.{field_ftpr_unit} = ANY({units})
+            AND st_intersects(
+                {table_pc}.{field_pc_geom},
+                {table_ftpr}.{field_ftpr_geom}
+            );
+        """).format(table_pc=table_pc_q,
+                    field_pc_unit=field_pc_unit_q,
+                    schema_pc=schema_pc_q,
+                    schema_ftpr=schema_ftpr_q,
+                    table_ftpr=table_ftpr_q,
+                    field_ftpr_unit=field_ftpr_unit_q,
+                    units=units_q,
+                    field_pc_geom=field_pc_geom_q,
+                    field_ftpr_geom=field_ftpr_geom_q)
+    logger.debug(conn.print_query(query))
+    resultset = conn.getQuery(query)
+    
+    pc_tiles = {tile: {} for tile in tiles_footprint}
+    for unit, pc_tile, version in resultset:
+        if extent_ewkb:
+            views = tiles_footprint
+        else:
+            views = [units[unit]]
+        tile_id = pc_tile.lower()
+        if not version:
+            logger.warning("Tile %s ahn_version is NULL", tile_id)
+            continue
+        for view in views:
+            if tile_id not in pc_tiles[view]:
+                pc_tiles[view][tile_id] = int(version)
+            else:
+                logger.error("tile ID %s is duplicate", tile_id)
+    logger.debug("Found the point cloud tiles of %s tiles", len(pc_tiles))
+    return pc_tiles
+
+
 def find_pc_tiles(conn, table_index_pc, fields_index_pc, idx_identical,
                   table_index_footprint=None, fields_index_footprint=None,
                   extent_ewkb=None, tile_footprint=None,
@@ -506,7 +1078,6 @@ def get_2Dtiles(db, table_index, fields_index, ewkb):
                             field_idx_geom=field_idx_geom_q,
                             ewkb=ewkb_q)
     resultset = db.getQuery(query)
-    shuffle(resultset)
     tiles = [tile[0] for tile in resultset]
     logger.debug("Nr. of tiles in clip extent: " + str(len(tiles)))
     return tiles
@@ -584,7 +1155,7 @@ def get_2Dtile_views(db, schema_tiles, tiles):
 
 
 def clip_2Dtiles(db, user_schema, schema_tiles, tiles, poly, clip_prefix,
-                 fields_view):
+                 fields_view, batch=None):
     """Creates views for the clipped tiles.
 
     Parameters
@@ -596,27 +1167,33 @@ def clip_2Dtiles(db, user_schema, schema_tiles, tiles, poly, clip_prefix,
     tiles : list
     poly : Shapely polygon
     clip_prefix : str
+    batch : :py:class:`bag3d.config.db.StatementBatch`
+        If provided, the views are added to the batch and created when the
+        batch is sent. Otherwise they are created right away, in chunks of
+        DDL_CHUNK_SIZE views per transaction.
 
     Returns
     -------
     list
         Name of the views of the clipped tiles.
     """
-    user_schema = sql.Identifier(user_schema)
+    user_schema_q = sql.Identifier(user_schema)
     schema_tiles = sql.Identifier(schema_tiles)
     tiles_clipped = []
 
     fields_all = fields_view['all']
     field_geom_q = sql.Identifier(fields_view['geometry'])
+    wkb = sql.Literal(poly.wkb_hex)
 
-    #FIXME: append all queries into a single string
+    own_batch = batch is None
+    if own_batch:
+        batch = StatementBatch(db, chunk_size=DDL_CHUNK_SIZE)
     for tile in tiles:
         t = clip_prefix + tile
         tiles_clipped.append(t)
         view = sql.Identifier(t)
         tile_view = sql.Identifier(tile)
         fields_q = parse_sql_select_fields(tile, fields_all)
-        wkb = sql.Literal(poly.wkb_hex)
         query = sql.SQL("""
             CREATE OR REPLACE VIEW {user_schema}.{view} AS
                 SELECT
@@ -625,31 +1202,24 @@ def clip_2Dtiles(db, user_schema, schema_tiles, tiles, poly, clip_prefix,
                     {schema_tiles}.{tile_view}
                 WHERE
                     st_within({tile_view}.{geom}, {wkb}::geometry)"""
-                        ).format(user_schema=user_schema,
+                        ).format(user_schema=user_schema_q,
                                  schema_tiles=schema_tiles,
                                  view=view,
                                  fields=fields_q,
                                  tile_view=tile_view,
                                  geom=field_geom_q,
                                  wkb=wkb)
-        db.sendQuery(query)
-    try:
-        db.conn.commit()
-        print(
-            str(
-                len(tiles_clipped)) +
-            " views with prefix '{}' are created in schema {}.".format(
-                clip_prefix,
-                user_schema))
-    except BaseException:
-        print("Cannot create view {user_schema}.{clip_prefix}{tile}".format(
-            schema_tiles=schema_tiles, clip_prefix=clip_prefix))
-        db.conn.rollback()
+        batch.add(query)
+    if own_batch:
+        batch.send()
+    logger.info("%s views with prefix '%s' are created in schema %s",
+                len(tiles_clipped), clip_prefix, user_schema)
 
     return(tiles_clipped)
 
 
-def union_2Dtiles(db, user_schema, tiles_clipped, clip_prefix, fields_view):
+def union_2Dtiles(db, user_schema, tiles_clipped, clip_prefix, fields_view,
+                  batch=None):
     """Union the clipped tiles into a single view.
 
     Parameters
@@ -659,6 +1229,10 @@ def union_2Dtiles(db, user_schema, tiles_clipped, clip_prefix, fields_view):
     user_schema : str
     tiles_clipped : list
     clip_prefix : str
+    batch : :py:class:`bag3d.config.db.StatementBatch`
+        If provided, the view is added to the batch, eg. after the clipped
+        views, and created when the batch is sent. Otherwise it is created
+        right away.
 
     Returns
     -------
@@ -668,42 +1242,28 @@ def union_2Dtiles(db, user_schema, tiles_clipped, clip_prefix, fields_view):
     # Check if there are enough tiles to unite
     assert len(tiles_clipped) > 1, "Need at least 2 tiles for union"
 
-    user_schema = sql.Identifier(user_schema)
+    user_schema_q = sql.Identifier(user_schema)
     u = "{clip_prefix}union".format(clip_prefix=clip_prefix)
     union_view = sql.Identifier(u)
-    sql_query = sql.SQL("CREATE OR REPLACE VIEW {user_schema}.{view} AS ").format(
-        user_schema=user_schema, view=union_view)
 
     fields_all = fields_view['all']
 
-    for tile in tiles_clipped[:-1]:
+    selects = []
+    for tile in tiles_clipped:
         view = sql.Identifier(tile)
         fields_q = parse_sql_select_fields(tile, fields_all)
-        sql_subquery = sql.SQL("""SELECT {fields}
-                               FROM {user_schema}.{view}
-                               UNION ALL """).format(fields=fields_q,
-                                                     user_schema=user_schema,
-                                                     view=view)
-        sql_query = sql_query + sql_subquery
-    # The last statement
-    tile = tiles_clipped[-1]
-    view = sql.Identifier(tile)
-    fields_q = parse_sql_select_fields(tile, fields_all)
-    sql_subquery = sql.SQL("""SELECT {fields}
-                           FROM {user_schema}.{view};
-                           """).format(fields=fields_q,
-                                       user_schema=user_schema,
-                                       view=view)
-    sql_query = sql_query + sql_subquery
-    logger.debug(db.print_query(sql_query))
-    db.sendQuery(sql_query)
-    try:
-        db.conn.commit()
-        print("View {} created in schema {}.".format(u, user_schema))
-    except BaseException:
-        print("Cannot create view {}.{}".format(user_schema, u))
-        db.conn.rollback()
-        return(False)
+        selects.append(sql.SQL("""SELECT {fields}
+                               FROM {user_schema}.{view}""").format(
+            fields=fields_q, user_schema=user_schema_q, view=view))
+    sql_query = sql.SQL("CREATE OR REPLACE VIEW {user_schema}.{view} AS {selects}").format(
+        user_schema=user_schema_q, view=union_view,
+        selects=sql.SQL("\n UNION ALL ").join(selects))
+    if batch is None:
+        logger.debug(db.print_query(sql_query))
+        db.sendQuery(sql_query)
+    else:
+        batch.add(sql_query)
+    logger.info("View %s created in schema %s", u, user_schema)
     return u
 
 
@@ -779,6 +1339,7 @@ def drop_2Dtiles(db, user_schema, views_to_drop):
     Note
     ----
     Used for dropping the views created by clip_2Dtiles() and union_2Dtiles().
+    The views are dropped in chunks of DDL_CHUNK_SIZE views per transaction.
 
     Parameters
     ----------
@@ -792,21 +1353,16 @@ def drop_2Dtiles(db, user_schema, views_to_drop):
     bool
         True on success, False on failure
     """
-    user_schema = sql.Identifier(user_schema)
-
-    for view in views_to_drop:
-        view = sql.Identifier(view)
-        queries = sql.Composed('')
-        query = sql.SQL("DROP VIEW IF EXISTS {user_schema}.{view} CASCADE;").format(
-            user_schema=user_schema, view=view)
-        queries += query
-    logger.debug(db.print_query(queries))
+    user_schema_q = sql.Identifier(user_schema)
     try:
-        db.sendQuery(queries)
-        logger.debug("Dropped {} in schema {}.".format(views_to_drop, user_schema))
+        with db.batch(chunk_size=DDL_CHUNK_SIZE) as batch:
+            for view in views_to_drop:
+                batch.add(sql.SQL("DROP VIEW IF EXISTS {user_schema}.{view} CASCADE").format(
+                    user_schema=user_schema_q, view=sql.Identifier(view)))
+        logger.debug("Dropped %s in schema %s.", views_to_drop, user_schema)
         return True
-    except BaseException as e:
-        logger.exception("Cannot drop views ", views_to_drop)
+    except psycopg2.Error:
+        logger.exception("Cannot drop views %s", views_to_drop)
         return False
 
 
@@ -854,22 +1410,26 @@ def configure_tiles(conn, config, clip_prefix):
         view_fields = get_view_fields(conn, 
                                       config["input_polygons"]["tile_schema"], 
                                       tile_views)
-        # clip 2D tiles to extent
-        tiles_clipped = clip_2Dtiles(conn, 
-                                     config["input_polygons"]['user_schema'], 
-                                     config["input_polygons"]['tile_schema'], 
-                                     tile_views, poly, clip_prefix, view_fields)
-        # if the area of the extent is less than that of a tile, union the tiles is the
-        # extent spans over many
         tile_area = get_2Dtile_area(conn, config['tile_index']['polygons'])
-        if len(tiles_clipped) > 1 and poly.area < tile_area:
-            union_view = union_2Dtiles(conn, 
-                                       config["input_polygons"]['user_schema'], 
-                                       tiles_clipped, clip_prefix, view_fields)
-            config["tile_out"] = "output_batch3dfier"
-            config["input_polygons"]["tile_list"] = [union_view]
-        else:
-            config["input_polygons"]["tile_list"] = tiles_clipped
+        # The clipped views and their union are created together
+        with conn.batch(chunk_size=DDL_CHUNK_SIZE) as batch:
+            # clip 2D tiles to extent
+            tiles_clipped = clip_2Dtiles(conn, 
+                                         config["input_polygons"]['user_schema'], 
+                                         config["input_polygons"]['tile_schema'], 
+                                         tile_views, poly, clip_prefix, view_fields,
+                                         batch=batch)
+            # if the area of the extent is less than that of a tile, union the tiles is the
+            # extent spans over many
+            if len(tiles_clipped) > 1 and poly.area < tile_area:
+                union_view = union_2Dtiles(conn, 
+                                           config["input_polygons"]['user_schema'], 
+                                           tiles_clipped, clip_prefix, view_fields,
+                                           batch=batch)
+                config["tile_out"] = "output_batch3dfier"
+                config["input_polygons"]["tile_list"] = [union_view]
+            else:
+                config["input_polygons"]["tile_list"] = tiles_clipped
     elif config["input_polygons"]["tile_list"]:
         if 'all' in config["input_polygons"]["tile_list"]:
             poly = config['tile_index']['polygons']
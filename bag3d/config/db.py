@@ -3,24 +3,299 @@
 """Database connection class."""
 
 #from subprocess import run
+import sys
+import json
+import bisect
+import threading
 import logging
 import re
+from time import perf_counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import psycopg2
 from psycopg2 import sql
 from psycopg2 import extras
+from psycopg2 import pool
+
+from bag3d import report
 
 logger = logging.getLogger(__name__)
+logger_perf = logging.getLogger('performance')
+
+# Statements that can be explained, see the PostgreSQL documentation of EXPLAIN
+_EXPLAINABLE = ('select', 'with', 'insert', 'update', 'delete', 'values')
+# The query of CREATE TABLE ... AS and CREATE MATERIALIZED VIEW ... AS
+_CREATE_AS = re.compile(
+    r"create\s+(?:(?:global|local)\s+)?(?:(?:temp|temporary|unlogged)\s+)?"
+    r"(?:table|materialized\s+view)\s+(?:if\s+not\s+exists\s+)?.+?\s+as\s+"
+    r"((?:\(|select\b|with\b|values\b|table\b).*?)"
+    r"(?:\s+with\s+(?:no\s+)?data)?$", re.IGNORECASE | re.DOTALL)
+
+
+def split_statements(query):
+    """Split a query into its statements
+
+    The query is split on the semicolons that are not in a string, a quoted
+    identifier, a dollar-quoted string or a comment.
+
+    Parameters
+    ----------
+    query : str
+
+    Returns
+    -------
+    list of str
+        The statements without the semicolon, the empty ones are left out
+    """
+    statements = []
+    start = 0
+    i = 0
+    n = len(query)
+    while i < n:
+        c = query[i]
+        if c in ("'", '"'):
+            end = query.find(c, i + 1)
+            i = n if end < 0 else end + 1
+        elif query.startswith('--', i):
+            end = query.find('\n', i)
+            i = n if end < 0 else end + 1
+        elif query.startswith('/*', i):
+            end = query.find('*/', i + 2)
+            i = n if end < 0 else end + 2
+        elif c == '$':
+            m = re.match(r"\$[A-Za-z_]*\$", query[i:])
+            if m:
+                end = query.find(m.group(0), i + len(m.group(0)))
+                i = n if end < 0 else end + len(m.group(0))
+            else:
+                i += 1
+        elif c == ';':
+            statements.append(query[start:i])
+            i += 1
+            start = i
+        else:
+            i += 1
+    statements.append(query[start:])
+    return [st.strip() for st in statements if st.strip()]
+
+
+def explainable(statement):
+    """The part of a statement that can be explained without side effects
+
+    The query of a CREATE TABLE ... AS is explained instead of the
+    statement, because the table exists already after the statement ran.
+
+    Parameters
+    ----------
+    statement : str
+        A single statement
+
+    Returns
+    -------
+    str
+        The statement to EXPLAIN, None if it cannot be explained (eg. DDL)
+    """
+    m = _CREATE_AS.match(statement)
+    if m:
+        return m.group(1)
+    if statement.lower().startswith(_EXPLAINABLE):
+        return statement
+    return None
+
+
+class QueryProfiler(object):
+    """Time the queries per call site and explain the slow ones
+
+    The duration of every query is recorded in a histogram of the call site,
+    which is the module, function and line that called the :py:class:`db`
+    method. The first `max_explain` queries of a call site that are slower
+    than `threshold` seconds are explained with EXPLAIN (ANALYZE, BUFFERS),
+    see :py:meth:`db.explain`, and the plans are logged to the 'performance'
+    logger. This runs those statements again, thus profiling is meant for
+    finding the slow queries, not for production runs.
+
+    Parameters
+    ----------
+    threshold : float
+        Explain the statements that are slower than this, in seconds. If
+        None, no statements are explained.
+    max_explain : int
+        Maximum number of explained statements per call site
+    buckets : sequence of float
+        Upper bounds of the histogram buckets in seconds
+    """
+
+    def __init__(self, threshold=60.0, max_explain=1,
+                 buckets=(0.01, 0.1, 1.0, 10.0, 60.0, 600.0)):
+        self.threshold = threshold
+        self.max_explain = max_explain
+        self.buckets = list(buckets)
+        self.sites = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def call_site():
+        """The module, function and line outside of this module that sent the query"""
+        f = sys._getframe(1)
+        while f is not None and f.f_code.co_filename == __file__:
+            f = f.f_back
+        if f is None:
+            return "unknown"
+        return "%s:%s:%s" % (f.f_globals.get('__name__'), f.f_code.co_name,
+                             f.f_lineno)
+
+    def observe(self, conn, query, seconds):
+        """Record the duration of a query, explain it if it is slow
+
+        Parameters
+        ----------
+        conn : :py:class:`db`
+            The connection that sent the query
+        query : str or psycopg2.sql.Composable
+        seconds : float
+            Duration of the query
+        """
+        site = self.call_site()
+        with self.lock:
+            s = self.sites.setdefault(site, {'count': 0, 'total': 0.0,
+                                             'max': 0.0, 'explained': 0,
+                                             'histogram': [0] * (len(self.buckets) + 1)})
+            s['count'] += 1
+            s['total'] += seconds
+            s['max'] = max(s['max'], seconds)
+            s['histogram'][bisect.bisect_left(self.buckets, seconds)] += 1
+            explain = (self.threshold is not None and seconds > self.threshold
+                       and s['explained'] < self.max_explain)
+            if explain:
+                s['explained'] += 1
+        if explain:
+            plans = conn.explain(query)
+            if plans:
+                logger_perf.debug(json.dumps({'event': 'explain', 'site': site,
+                                              'seconds': seconds,
+                                              'plans': plans}))
+                logger.info("Explained the query of %s that took %.1f s",
+                            site, seconds)
+
+    def summary(self):
+        """The query statistics per call site
+
+        Returns
+        -------
+        dict
+            {call site: {'count', 'total', 'max', 'explained', 'histogram'}},
+            the histogram is the number of queries per bucket, the last bucket
+            is for the queries slower than the largest bucket
+        """
+        with self.lock:
+            return {site: dict(s, histogram=list(s['histogram']))
+                    for site, s in self.sites.items()}
+
+    def log_summary(self):
+        """Log the call sites by their total query time"""
+        summary = self.summary()
+        logger_perf.debug(json.dumps({'event': 'query_profile',
+                                      'buckets': self.buckets,
+                                      'sites': summary}))
+        for site, s in sorted(summary.items(), key=lambda i: i[1]['total'],
+                              reverse=True)[:10]:
+            logger.info("%s: %s queries, %.1f s total, %.1f s max", site,
+                        s['count'], s['total'], s['max'])
+
+
+# Maximum number of views that are created or dropped in one transaction
+DDL_CHUNK_SIZE = 500
+
+
+class StatementBatch(object):
+    """Gather statements and send them with as few round trips as possible
+
+    The statements are sent in one transaction, or if chunk_size is set, in
+    transactions of chunk_size statements. Chunking keeps the number of
+    locks of a transaction bounded, eg. when creating or dropping thousands
+    of views.
+
+    Parameters
+    ----------
+    conn : :py:class:`db`
+        Open connection
+    chunk_size : int or None
+        Maximum number of statements per transaction, None for a single
+        transaction
+    """
+
+    def __init__(self, conn, chunk_size=None):
+        self.conn = conn
+        self.chunk_size = chunk_size
+        self.statements = []
+
+    def __len__(self):
+        return len(self.statements)
+
+    def add(self, statement):
+        """Add a statement
+
+        Parameters
+        ----------
+        statement : str or psycopg2.sql.Composable
+            A single statement without the terminating semicolon
+        """
+        if isinstance(statement, str):
+            statement = sql.SQL(statement)
+        self.statements.append(statement)
+
+    def send(self):
+        """Send the statements and empty the batch
+
+        Returns
+        -------
+        int
+            Number of transactions
+        """
+        size = self.chunk_size or len(self.statements)
+        nr = 0
+        for i in range(0, len(self.statements), size):
+            chunk = self.statements[i:i + size]
+            query = sql.SQL(";\n").join(chunk) + sql.SQL(";")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(self.conn.print_query(query))
+            self.conn.sendQuery(query)
+            nr += 1
+        logger.debug("Sent %s statements in %s transactions",
+                     len(self.statements), nr)
+        self.statements = []
+        return nr
+
 
 class db(object):
-    """A database connection class """
+    """A database connection class
+    
+    The connection must not be shared between threads. For concurrent access
+    create a connection pool with :py:meth:`create_pool` and let every thread
+    :py:meth:`checkout` its own connection.
+    
+    The queries of all instances are profiled with :py:attr:`profiler` if
+    it is set, see :py:meth:`enable_profiling`.
+    
+    Parameters
+    ----------
+    conn : psycopg2 connection
+        Use an already open connection instead of opening a new one
+    """
+    
+    profiler = None
 
-    def __init__(self, dbname, host, port, user, password=None):
+    def __init__(self, dbname, host, port, user, password=None, conn=None):
         self.dbname = dbname
         self.host = host
         self.port = port
         self.user = user
         self.password = password
+        self.pool = None
+        if conn is not None:
+            self.conn = conn
+            return
         try:
             self.conn = psycopg2.connect(
                 dbname=dbname, host=host, port=port, user=user,
@@ -31,6 +306,54 @@ class db(object):
             logger.exception("I'm unable to connect to the database")
             raise
 
+    def create_pool(self, minconn, maxconn):
+        """Create a thread-safe connection pool with the same connection parameters
+        
+        If a pool exists already with at least maxconn connections, it is
+        kept, otherwise it is replaced.
+        
+        Parameters
+        ----------
+        minconn : int
+            Number of connections to open right away
+        maxconn : int
+            Maximum number of connections
+        """
+        if self.pool is not None:
+            if self.pool.maxconn >= maxconn:
+                return
+            self.pool.closeall()
+        try:
+            self.pool = pool.ThreadedConnectionPool(
+                minconn, maxconn, dbname=self.dbname, host=self.host,
+                port=self.port, user=self.user, password=self.password)
+            logger.debug("Created connection pool with %s connections", maxconn)
+        except BaseException:
+            logger.exception("I'm unable to create a connection pool")
+            raise
+
+    @contextmanager
+    def checkout(self):
+        """Check out a connection from the pool
+        
+        If there is no pool, the connection itself is used.
+        
+        Yields
+        ------
+        :py:class:`bag3d.config.db.db`
+            A db instance for the pooled connection, that is returned to the
+            pool at the end of the with block
+        """
+        if self.pool is None:
+            yield self
+            return
+        c = self.pool.getconn()
+        try:
+            yield db(self.dbname, self.host, self.port, self.user,
+                     password=self.password, conn=c)
+        finally:
+            self.pool.putconn(c, close=bool(c.closed))
+
     def sendQuery(self, query):
         """Send a query to the DB when no results need to return (e.g. CREATE)
 
@@ -44,9 +367,63 @@ class db(object):
         nothing
 
         """
+        start = perf_counter()
         with self.conn:
             with self.conn.cursor() as cur:
                 cur.execute(query)
+                rows = cur.rowcount
+        self._observe(query, perf_counter() - start, rows)
+
+    @contextmanager
+    def batch(self, chunk_size=None):
+        """Gather the statements of the with block and send them at its end
+        
+        See :py:class:`StatementBatch`. Nothing is sent if the with block
+        raises an exception.
+        
+        Yields
+        ------
+        :py:class:`StatementBatch`
+        """
+        b = StatementBatch(self, chunk_size=chunk_size)
+        yield b
+        b.send()
+
+    def send_parallel(self, queries, nr_threads):
+        """Send independent queries at the same time, each on its own connection
+
+        Used for building several indexes on a table at once. The queries
+        are sent one after the other if nr_threads is 1.
+
+        Parameters
+        ----------
+        queries : list of str
+        nr_threads : int
+            Maximum number of queries that run at the same time
+
+        Raises
+        ------
+        BaseException
+            The first exception that is raised by a query
+        """
+        nr_threads = min(nr_threads, len(queries))
+        if nr_threads <= 1:
+            for query in queries:
+                self.sendQuery(query)
+            return
+        workers = db(self.dbname, self.host, self.port, self.user,
+                     password=self.password, conn=self.conn)
+        workers.create_pool(nr_threads, nr_threads)
+
+        def send(query):
+            with workers.checkout() as c:
+                c.sendQuery(query)
+        try:
+            with ThreadPoolExecutor(max_workers=nr_threads,
+                                    thread_name_prefix="Query") as executor:
+                list(executor.map(send, queries))
+        finally:
+            workers.pool.closeall()
 
     def getQuery(self, query):
         """DB query where the results need to return (e.g. SELECT)
@@ -62,10 +439,13 @@ class db(object):
         psycopg2 resultset
 
         """
+        start = perf_counter()
         with self.conn:
             with self.conn.cursor() as cur:
                 cur.execute(query)
-                return cur.fetchall()
+                res = cur.fetchall()
+        self._observe(query, perf_counter() - start, len(res))
+        return res
 
     def get_dict(self, query):
         """DB query where the results need to return as a dictionary
@@ -79,10 +459,73 @@ class db(object):
         -------
         psycopg2 resultset
         """
+        start = perf_counter()
         with self.conn:
             with self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
                 cur.execute(query)
-                return cur.fetchall()
+                res = cur.fetchall()
+        self._observe(query, perf_counter() - start, len(res))
+        return res
+
+    def _observe(self, query, seconds, rows):
+        report.record_db(seconds, rows)
+        if self.profiler is not None:
+            self.profiler.observe(self, query, seconds)
+
+    @classmethod
+    def enable_profiling(cls, threshold=60.0, max_explain=1):
+        """Profile the queries of every instance, see :py:class:`QueryProfiler`
+
+        Returns
+        -------
+        :py:class:`QueryProfiler`
+        """
+        cls.profiler = QueryProfiler(threshold=threshold, max_explain=max_explain)
+        logger.info("Profiling the queries, explaining the ones slower than %s s",
+                    threshold)
+        return cls.profiler
+
+    def explain(self, query):
+        """EXPLAIN (ANALYZE, BUFFERS) the statements of a query that has run
+
+        The query is split into its statements and every statement that
+        EXPLAIN accepts is explained in its own transaction, which is rolled
+        back. Of a CREATE TABLE ... AS only its query is explained, because
+        the table exists already. Other statements (eg. DROP, CREATE INDEX)
+        are skipped. Nothing is explained on a connection in autocommit
+        mode, because the changes could not be rolled back.
+
+        Parameters
+        ----------
+        query : str or psycopg2.sql.Composable
+
+        Returns
+        -------
+        list of dict
+            {'statement': the beginning of the statement,
+            'plan': the lines of the plan} per explained statement, None if
+            no statement can be explained
+        """
+        if self.conn.autocommit:
+            return None
+        if not isinstance(query, str):
+            query = query.as_string(self.conn)
+        plans = []
+        for statement in split_statements(query):
+            target = explainable(statement)
+            if target is None:
+                logger.debug("Cannot explain %s", statement[:80])
+                continue
+            try:
+                with self.conn.cursor() as cur:
+                    cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + target)
+                    plans.append({'statement': statement[:200],
+                                  'plan': [r[0] for r in cur.fetchall()]})
+            except psycopg2.Error as e:
+                logger.debug("Cannot explain %s: %s", statement[:80], e)
+            finally:
+                self.conn.rollback()
+        return plans or None
     
     def print_query(self, query):
         """Format a SQL query for printing by replacing newlines and tab-spaces"""
@@ -106,21 +549,45 @@ class db(object):
         -------
         nothing
         """
-        self.conn.set_isolation_level(
-            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
         schema = psycopg2.sql.Identifier(schema)
         table = psycopg2.sql.Identifier(table)
         query = psycopg2.sql.SQL("""
         VACUUM ANALYZE {schema}.{table};
         """).format(schema=schema, table=table)
-        self.sendQuery(query)
+        with self._autocommit():
+            self.sendQuery(query)
     
     def vacuum_full(self):
         """Vacuum analyze the whole database"""
-        self.conn.set_isolation_level(
-            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
         query = psycopg2.sql.SQL("VACUUM ANALYZE;")
-        self.sendQuery(query)
+        with self._autocommit():
+            self.sendQuery(query)
+    
+    @contextmanager
+    def _autocommit(self):
+        """Switch the connection to autocommit, which VACUUM requires, and
+        back to its previous mode afterwards"""
+        previous = self.conn.autocommit
+        self.conn.autocommit = True
+        try:
+            yield
+        finally:
+            self.conn.autocommit = previous
+    
+    def free_connections(self):
+        """The number of connections that can be opened to the database
+        
+        The connections that are reserved for superusers and the open client
+        connections of any user are not free.
+        """
+        query = """
+        SELECT current_setting('max_connections')::int
+               - current_setting('superuser_reserved_connections')::int
+               - count(*)
+        FROM pg_stat_activity
+        WHERE datname IS NOT NULL;
+        """
+        return self.getQuery(query)[0][0]
     
     def check_postgis(self):
         """Create the PostGIS extension if not exitst"""
@@ -134,7 +601,10 @@ class db(object):
         yield [c[0] for c in cols]
 
     def close(self):
-        """Close connection"""
+        """Close connection and the connection pool"""
+        if self.pool is not None:
+            self.pool.closeall()
+            self.pool = None
         self.conn.close()
         logger.debug("Closed database successfully")
 
@@ -8,6 +8,8 @@ database. These tiles are then used by batch3dfier.
 import logging
 from psycopg2 import sql
 
+from bag3d.config.db import StatementBatch, DDL_CHUNK_SIZE
+
 logger = logging.getLogger(__name__)
 
 
@@ -157,9 +159,102 @@ def create_centroids(db, table_centroid, table_footprint, fields_footprint):
     db.vacuum(schema_ctr, table_ctr)
 
 
+def create_tile_assignment(db, table_assignment, table_index, fields_index,
+                           table_centroid, fields_centroid):
+    """Creates a table that assigns the footprints to the tiles.
+
+    A footprint belongs to a tile if its centroid is inside the tile polygon
+    or on its lower/left boundary (see update_tile_index()). The assignment
+    is computed once and indexed on the tile, so that the tile views
+    created by create_views() with table_assignment select the footprints
+    of a tile with an index scan instead of a spatial join. If the table
+    exists, its content is replaced.
+
+    Parameters
+    ----------
+    db : :py:class:`bag3d.config.db.db`
+    table_assignment : list of str
+        [schema, table] for the new relation that contains the assignment.
+    table_index : list of str
+        [schema, table] of the tile index.
+    fields_index : list of str
+        [ID, geometry, unit] field names of the ID, geometry, tile unit name fields in table_index.
+    table_centroid : list of str
+        [schema, table] of the footprint centroids.
+    fields_centroid : list of str
+        [ID, geometry] field names of the ID geometry fields in table_centroid.
+
+    Returns
+    -------
+    nothing
+        nothing
+    """
+    schema_asg_q = sql.Identifier(table_assignment[0])
+    table_asg = table_assignment[1]
+    table_asg_q = sql.Identifier(table_asg)
+    schema_idx_q = sql.Identifier(table_index[0])
+    table_idx_q = sql.Identifier(table_index[1])
+    field_idx_geom_q = sql.Identifier(fields_index[1])
+    field_idx_unit_q = sql.Identifier(fields_index[2])
+    schema_ctr_q = sql.Identifier(table_centroid[0])
+    table_ctr_q = sql.Identifier(table_centroid[1])
+    field_ctr_id_q = sql.Identifier(fields_centroid[0])
+    field_ctr_geom_q = sql.Identifier(fields_centroid[1])
+
+    select = sql.SQL("""
+        SELECT
+            {table_ctr}.{field_ctr_id},
+            {table_idx}.{field_idx}
+        FROM
+            {schema_ctr}.{table_ctr},
+            {schema_idx}.{table_idx}
+        WHERE
+            st_containsproperly(
+                {table_idx}.{field_idx_geom},
+                {table_ctr}.{field_ctr_geom}
+            )
+            OR st_contains(
+                {table_idx}.geom_border,
+                {table_ctr}.{field_ctr_geom}
+            )""").format(schema_ctr=schema_ctr_q,
+                         table_ctr=table_ctr_q,
+                         field_ctr_id=field_ctr_id_q,
+                         field_ctr_geom=field_ctr_geom_q,
+                         schema_idx=schema_idx_q,
+                         table_idx=table_idx_q,
+                         field_idx=field_idx_unit_q,
+                         field_idx_geom=field_idx_geom_q)
+    sql_query = sql.SQL("""
+    CREATE TABLE IF NOT EXISTS {schema_asg}.{table_asg} AS
+    {select}
+    WITH NO DATA;
+    
+    TRUNCATE {schema_asg}.{table_asg};
+    
+    INSERT INTO {schema_asg}.{table_asg}
+    {select};
+    
+    CREATE
+        INDEX IF NOT EXISTS {tile_idx} ON
+        {schema_asg}.{table_asg} ({field_idx});
+    CREATE
+        INDEX IF NOT EXISTS {id_idx} ON
+        {schema_asg}.{table_asg} ({field_ctr_id});
+    """).format(schema_asg=schema_asg_q,
+                table_asg=table_asg_q,
+                select=select,
+                field_idx=field_idx_unit_q,
+                field_ctr_id=field_ctr_id_q,
+                tile_idx=sql.Identifier(table_asg + '_tile_idx'),
+                id_idx=sql.Identifier(table_asg + '_id_idx'))
+    logger.debug(db.print_query(sql_query))
+    db.sendQuery(sql_query)
+    db.vacuum(table_assignment[0], table_asg)
+
+
 def create_views(db, schema_tiles, table_index, fields_index, table_centroid,
                  fields_centroid, table_footprint, fields_footprint,
-                 prefix_tiles='t_'):
+                 prefix_tiles='t_', table_assignment=None):
     """Creates PostgreSQL Views for the footprint tiles.
 
     Parameters
@@ -192,6 +287,15 @@ def create_views(db, schema_tiles, table_index, fields_index, table_centroid,
     prefix_tiles : str or None
         Prefix to prepend to the view names. If None, the views are named as
         the values in fields_index.
+    table_assignment : list of str or None
+        [schema, table] of the tile assignment created by
+        create_tile_assignment(). If provided, the views select the footprints
+        of the tile from the assignment by the tile name, instead of joining
+        the centroids with the tile polygon.
+
+    Note
+    ----
+    The views are created in chunks of DDL_CHUNK_SIZE views per transaction.
 
     Returns
     -------
@@ -244,14 +348,40 @@ def create_views(db, schema_tiles, table_index, fields_index, table_centroid,
     if not prefix_tiles:
         prefix_tiles = ""
     assert isinstance(prefix_tiles, str)
-    # Create a BAG tile with equivalent area of an AHN tile
-    queries = sql.Composed('')
+    # Create a BAG tile with equivalent area of an AHN tile. The views are
+    # created in chunks, each chunk in one transaction.
+    batch = StatementBatch(db, chunk_size=DDL_CHUNK_SIZE)
     for tile in tiles:
         # !!! the 't_' prefix is hard-coded in config.call3dfier() !!!
         n = prefix_tiles + str(tile)
         view = sql.Identifier(n)
 
         tile = sql.Literal(tile)
+        if table_assignment:
+            query = sql.SQL("""
+    CREATE OR REPLACE VIEW {schema_tiles}.{view} AS
+    SELECT
+        {fields_poly},
+        {table_asg}.{field_idx}
+    FROM
+        {schema_poly}.{table_poly}
+    INNER JOIN {schema_asg}.{table_asg} ON
+        {table_poly}.{field_poly_id} = {table_asg}.{field_ctr_id}
+    WHERE
+        {table_asg}.{field_idx} = {tile}""").format(schema_tiles=schema_tiles_q,
+              view=view,
+              fields_poly=sql_fields_footprint,
+              schema_poly=schema_poly_q,
+              table_poly=table_poly_q,
+              field_poly_id=field_poly_id_q,
+              schema_asg=sql.Identifier(table_assignment[0]),
+              table_asg=sql.Identifier(table_assignment[1]),
+              field_ctr_id=field_ctr_id_q,
+              field_idx=field_idx_unit_q,
+              tile=tile
+              )
+            batch.add(query)
+            continue
         query = sql.SQL("""
     CREATE OR REPLACE VIEW {schema_tiles}.{view} AS
     SELECT
@@ -273,7 +403,7 @@ def create_views(db, schema_tiles, table_index, fields_index, table_centroid,
                 {table_idx}.geom_border,
                 {table_ctr}.{field_ctr_geom}
             )
-    );""").format(schema_tiles=schema_tiles_q,
+    )""").format(schema_tiles=schema_tiles_q,
               view=view,
               fields_poly=sql_fields_footprint,
               schema_poly=schema_poly_q,
@@ -289,9 +419,8 @@ def create_views(db, schema_tiles, table_index, fields_index, table_centroid,
               field_idx_geom=field_idx_geom_q,
               field_ctr_geom=field_ctr_geom_q
               )
-        queries += query
-    logger.debug(db.print_query(queries))
-    db.sendQuery(queries)
+        batch.add(query)
+    batch.send()
 
     logger.debug("%s Views created in schema '%s'." % (len(tiles), schema_tiles))
 
@@ -300,12 +429,15 @@ def create_views(db, schema_tiles, table_index, fields_index, table_centroid,
 
 
 def partition(db, schema_tiles, table_index, fields_index, table_footprint,
-              fields_footprint, prefix_tiles):
+              fields_footprint, prefix_tiles, mode='view',
+              table_assignment=None):
     """Partitions geometries in a 2D footprint table into tiles.
 
     Adds a geometry column to table_index.
     Creates a new table <table_footprint>_centroid in the schema of table_footprint.
     Creates a View for each tile in table_index, generating names from fields_index[2].
+    With mode 'table', creates the table table_assignment of the tile
+    assignment and the Views select from it.
 
     Parameters
     ----------
@@ -330,6 +462,11 @@ def partition(db, schema_tiles, table_index, fields_index, table_footprint,
     prefix_tiles : str, None
         Prefix to prepend to the view names. If None, the views are named as
         the values in fields_index[2].
+    mode : str
+        'view' for spatial join Views, 'table' for Views on the tile
+        assignment table, see create_tile_assignment().
+    table_assignment : list of str or None
+        [schema, table] of the tile assignment, required with mode 'table'.
 
     Returns
     -------
@@ -346,6 +483,13 @@ def partition(db, schema_tiles, table_index, fields_index, table_footprint,
 
     create_centroids(db, table_centroid, table_footprint, fields_footprint)
 
+    if mode == 'table':
+        assert table_assignment, "Provide table_assignment for mode 'table'"
+        create_tile_assignment(db, table_assignment, table_index, fields_index,
+                               table_centroid, fields_centroid)
+    else:
+        table_assignment = None
+
     create_views(db, schema_tiles, table_index, fields_index, table_centroid,
                  fields_centroid, table_footprint, fields_footprint,
-                 prefix_tiles)
+                 prefix_tiles, table_assignment=table_assignment)
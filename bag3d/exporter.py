@@ -14,7 +14,11 @@ from bag3d.update import bag
 logger = logging.getLogger(__name__)
 
 def migrate(conn, config):
-    """Migrate the 3D BAG from the staging area to production"""
+    """Migrate the 3D BAG from the staging area to production
+    
+    The production table is always a logged table, also when the staging
+    tables are UNLOGGED in fast-load mode.
+    """
     staging_schema = sql.Identifier(config["output"]["staging"]["schema"])
     staging_table = sql.Identifier(config["output"]["staging"]["bag3d_table"])
     prod_schema = sql.Identifier(config["output"]["production"]["schema"])
@@ -60,38 +64,41 @@ def migrate(conn, config):
     logger.debug(conn.print_query(query))
     conn.sendQuery(query)
 
-    idx = sql.Identifier(config["output"]["production"]["bag3d_table"] + "_gid_pk_idx")
-    query = sql.SQL("""
-    ALTER TABLE {schema}.{bag3d} ADD PRIMARY KEY (gid);
-    """).format(idx=idx, bag3d=prod_table, schema=prod_schema)
-    logger.debug(conn.print_query(query))
-    conn.sendQuery(query)
-
-    idx = sql.Identifier(config["output"]["production"]["bag3d_table"] + "_identificatie_idx")
-    query = sql.SQL("""
-    CREATE INDEX {idx} ON {schema}.{bag3d} ({uniqueid});
-    """).format(idx=idx, bag3d=prod_table, schema=prod_schema, uniqueid=uniqueid_q)
-    logger.debug(conn.print_query(query))
-    conn.sendQuery(query)
-
-    idx = sql.Identifier(config["output"]["production"]["bag3d_table"] + "_tile_id_idx")
-    query = sql.SQL("""
-    CREATE INDEX {idx} ON {schema}.{bag3d} (tile_id);
-    """).format(idx=idx, bag3d=prod_table, schema=prod_schema)
-    logger.debug(conn.print_query(query))
-    conn.sendQuery(query)
-
-    idx = sql.Identifier(config["output"]["production"]["bag3d_table"] + "_valid_idx")
-    query = sql.SQL("""
-    CREATE INDEX {idx} ON {schema}.{bag3d} (height_valid);
-    """).format(idx=idx, bag3d=prod_table, schema=prod_schema)
-    logger.debug(conn.print_query(query))
-    conn.sendQuery(query)
+    # The indexes are built at the same time in fast-load mode. The primary
+    # key is built as a unique index, so that it can be built together with
+    # the other indexes
+    pkey = sql.Identifier(config["output"]["production"]["bag3d_table"] + "_pkey")
+    queries = [
+        sql.SQL("""
+        CREATE UNIQUE INDEX {idx} ON {schema}.{bag3d} (gid);
+        """).format(idx=pkey, bag3d=prod_table, schema=prod_schema),
+        sql.SQL("""
+        CREATE INDEX {idx} ON {schema}.{bag3d} ({uniqueid});
+        """).format(idx=sql.Identifier(config["output"]["production"]["bag3d_table"] + "_identificatie_idx"),
+                    bag3d=prod_table, schema=prod_schema, uniqueid=uniqueid_q),
+        sql.SQL("""
+        CREATE INDEX {idx} ON {schema}.{bag3d} (tile_id);
+        """).format(idx=sql.Identifier(config["output"]["production"]["bag3d_table"] + "_tile_id_idx"),
+                    bag3d=prod_table, schema=prod_schema),
+        sql.SQL("""
+        CREATE INDEX {idx} ON {schema}.{bag3d} (height_valid);
+        """).format(idx=sql.Identifier(config["output"]["production"]["bag3d_table"] + "_valid_idx"),
+                    bag3d=prod_table, schema=prod_schema),
+        sql.SQL("""
+        CREATE INDEX {idx} ON {schema}.{bag3d} USING GIST (geovlak);
+        """).format(idx=sql.Identifier(config["output"]["production"]["bag3d_table"] + "_geovlak_idx"),
+                    bag3d=prod_table, schema=prod_schema)]
+    for query in queries:
+        logger.debug(conn.print_query(query))
+    if config['config'].get('fast_load', False):
+        nr_threads = config['config']['threads']
+    else:
+        nr_threads = 1
+    conn.send_parallel(queries, nr_threads)
 
-    idx = sql.Identifier(config["output"]["production"]["bag3d_table"] + "_geovlak_idx")
     query = sql.SQL("""
-    CREATE INDEX {idx} ON {schema}.{bag3d} USING GIST (geovlak);
-    """).format(idx=idx, bag3d=prod_table, schema=prod_schema)
+    ALTER TABLE {schema}.{bag3d} ADD PRIMARY KEY USING INDEX {idx};
+    """).format(idx=pkey, bag3d=prod_table, schema=prod_schema)
     logger.debug(conn.print_query(query))
     conn.sendQuery(query)
 
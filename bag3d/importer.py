@@ -3,20 +3,26 @@
 """Import batch3dfier output into the database"""
 
 import os
-from subprocess import run
-from shutil import which
-from sys import exit
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import psycopg2
 from psycopg2 import sql
 import logging
 
 from bag3d.update import bag
+from bag3d.config import db
+from bag3d import report
 
 logger = logging.getLogger(__name__)
 
 
-def create_heights_table(conn, schema, table):
+def unlogged_q(unlogged):
+    """The UNLOGGED keyword for CREATE TABLE if unlogged is True"""
+    return sql.SQL("UNLOGGED " if unlogged else "")
+
+
+def create_heights_table(conn, schema, table, unlogged=False):
     """Create a postgres table that can store the content of 3dfier's CSV-BUILDINGS-MULTIPLE output
     
     Note
@@ -32,6 +38,8 @@ def create_heights_table(conn, schema, table):
         Name of the schema where to create the table
     table : string
         Name of the new table
+    unlogged : bool
+        Create an UNLOGGED table, which is faster to load but not crash-safe
     
     Raises
     ------
@@ -49,7 +57,7 @@ def create_heights_table(conn, schema, table):
     CREATE SCHEMA IF NOT EXISTS {schema};
     """).format(schema=schema_q)
     query = sql.SQL("""
-    CREATE TABLE IF NOT EXISTS {schema}.{table} (
+    CREATE {unlogged}TABLE IF NOT EXISTS {schema}.{table} (
         id varchar(16),
         "ground-0.00" real,
         "ground-0.10" real,
@@ -76,7 +84,7 @@ def create_heights_table(conn, schema, table):
         ahn_version smallint,
         tile_id text
         );
-    """).format(schema=schema_q, table=table_q)
+    """).format(schema=schema_q, table=table_q, unlogged=unlogged_q(unlogged))
     logger.debug(conn.print_query(query))
     try:
         conn.sendQuery(query_s)
@@ -87,14 +95,105 @@ def create_heights_table(conn, schema, table):
         return False
 
 
-def csv2db(conn, cfg, out_paths):
-    """Create a table with multiple height info per BAG building footprint
+class HeightsCSV(object):
+    """A read-only file-like object over a CSV-BUILDINGS-MULTIPLE file for COPY
+
+    The header is skipped and the ahn_file_date, ahn_version and tile_id
+    fields are appended to every row. The first 22 fields of a row are kept,
+    thus the trailing comma of 3dfier's output is dropped.
+
+    Parameters
+    ----------
+    f_in : file object
+        The CSV opened for reading in text mode
+    ahn_file_date : str
+    ahn_version : int
+    tile : str
+        Values to add to every row
+    """
+    nr_fields = 22
+
+    def __init__(self, f_in, ahn_file_date, ahn_version, tile):
+        self.f_in = f_in
+        self.suffix = ",%s,%s,%s\n" % (ahn_file_date, ahn_version, tile)
+        self.buffer = ""
+        next(self.f_in, None) # skip header
+
+    def readline(self, size=-1):
+        line = self.f_in.readline()
+        if not line:
+            return ""
+        fields = line.rstrip("\r\n").split(",")[:self.nr_fields]
+        return ",".join(fields) + self.suffix
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            line = self.readline()
+            if not line:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = "".join(chunks)
+        if size < 0:
+            self.buffer = ""
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+
+def copy_csv(conn, copy_q, path, ahn_file_date, ahn_version, tile, retries=1,
+             delete_q=None):
+    """COPY a CSV-BUILDINGS-MULTIPLE file into the heights table
     
-    Note
-    ----
-    Only for 3dfier's CSV-BUILDINGS-MULTIPLE output. 
-    Only Linux.
-    Alter the CSV files by adding the ahn_file_date, ahn_version fields and values.
+    The file is copied in a single transaction, thus a failed file leaves no
+    rows behind and it is retried from the start on a new connection.
+    
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection, if it has a pool, a connection is checked out for
+        every attempt
+    copy_q : :py:class:`psycopg2.sql.Composable`
+        The COPY ... FROM STDIN statement
+    path : str
+        Path to the CSV file
+    ahn_file_date, ahn_version, tile :
+        See :py:class:`HeightsCSV`
+    retries : int
+        Number of retries after a failed attempt
+    delete_q : :py:class:`psycopg2.sql.Composable`
+        If provided, it is executed with the tile as parameter in the same
+        transaction before the COPY, eg. for deleting the rows of the tile
+        that were imported already
+    
+    Returns
+    -------
+    bool
+        True on success
+    """
+    for attempt in range(retries + 1):
+        try:
+            start = perf_counter()
+            with conn.checkout() as worker_conn:
+                with worker_conn.conn:
+                    with worker_conn.conn.cursor() as cur, open(path, "r") as f_in:
+                        if delete_q is not None:
+                            cur.execute(delete_q, (tile,))
+                        stream = HeightsCSV(f_in, ahn_file_date, ahn_version, tile)
+                        cur.copy_expert(copy_q, stream)
+                        rows = cur.rowcount
+            report.record_db(perf_counter() - start, rows)
+            return True
+        except (psycopg2.Error, OSError):
+            logger.exception("Failed to import %s (attempt %s of %s)", path,
+                             attempt + 1, retries + 1)
+    return False
+
+
+def get_ahn_attributes(conn, cfg):
+    """Get the file date and AHN version of every tile in the elevation tile index
     
     Parameters
     ----------
@@ -102,97 +201,243 @@ def csv2db(conn, cfg, out_paths):
         Open connection
     cfg: dict
         batch3dfier YAML config as returned by :meth:`bag3d.config.args.parse_config`
-    out_paths: list of strings
-        Paths of the CSV files
+    
+    Returns
+    -------
+    dict
+        {unit_name: (file_date, ahn_version)}
+    """
+    query = sql.SQL("""SELECT {unit_name}, file_date, ahn_version
+                        FROM {schema}.{table};
+                    """).format(
+        schema=sql.Identifier(cfg['tile_index']['elevation']['schema']),
+        table=sql.Identifier(cfg['tile_index']['elevation']['table']),
+        unit_name=sql.Identifier(cfg['tile_index']['elevation']['fields']['unit_name']))
+    logger.debug(conn.print_query(query))
+    return {r[0]: (r[1], r[2]) for r in conn.getQuery(query)}
+
+
+def cap_import_threads(nr_threads, import_threads, free_connections):
+    """The number of import threads that fit in the free database connections
+    
+    Next to the import threads, every 3dfier process connects to the
+    database and every 3dfier worker checks out a connection for its queries.
+    
+    Parameters
+    ----------
+    nr_threads : int
+        Number of 3dfier workers
+    import_threads : int
+        Requested number of import threads
+    free_connections : int
+        See :py:meth:`bag3d.config.db.db.free_connections`
+    
+    Returns
+    -------
+    int
+        At least 1
+    """
+    available = free_connections - 2 * nr_threads
+    if available < 1:
+        logger.warning("%s threads need more than the %s free database connections, "
+                       "use fewer threads or increase max_connections",
+                       nr_threads, free_connections)
+        return 1
+    if import_threads > available:
+        logger.warning("Importing with %s instead of %s threads, because there are "
+                       "%s free database connections", available, import_threads,
+                       free_connections)
+        return available
+    return import_threads
+
+
+class ImportWorkers(object):
+    """The threads and pooled connections that import the CSV files
+    
+    The workers can be shared by several :py:class:`StreamingImporter`, thus
+    the tile groups are imported over nr_threads connections together.
+    
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection, its connection parameters are used for the pool
+    nr_threads : int
+        Number of threads and connections
     """
-    schema_pc_q = sql.Identifier(cfg['tile_index']['elevation']['schema'])
-    table_pc_q = sql.Identifier(cfg['tile_index']['elevation']['table'])
-    field_pc_unit_q = sql.Identifier(cfg['tile_index']['elevation']['fields']['unit_name'])
-    
-    schema_out_q = sql.Identifier(cfg["output"]["staging"]["schema"])
-    table_out_q = sql.Identifier(cfg["output"]["staging"]["heights_table"])
-    
-    table_idx = sql.Identifier(cfg["output"]["staging"]["schema"] + "_id_idx")
-
-    a = create_heights_table(conn, cfg["output"]["staging"]["schema"], cfg["output"]["staging"]["heights_table"])
-
-    if a:
-        s = '"' + cfg["output"]["staging"]["schema"] + '"' # expecting here that the yaml parser took care of stripping the " and ' from the name
-        t = '"' + cfg["output"]["staging"]["heights_table"] + '"'
-        tbl = ".".join([s, t])
-
-        is_gawk = which("gawk")
-        is_sed = which("sed")
-        if is_gawk is None:
-            logger.error("'gawk' not found")
-            exit(1)
-        if is_sed is None:
-            logger.error("'sed' not found")
-            exit(1)
-
-        with conn.conn.cursor() as cur:
-            for path in out_paths:
-                csv_file = os.path.split(path)[1]
-                fname = os.path.splitext(csv_file)[0]
-                tile = fname.replace(cfg['input_polygons']['tile_prefix'], '', 1)
-                tile_q = sql.Literal(tile)
-                
-                query = sql.SQL("""SELECT file_date, ahn_version
-                                    FROM {schema}.{table}
-                                    WHERE {unit_name} = {tile};
-                                """).format(schema=schema_pc_q,
-                                           table=table_pc_q,
-                                           unit_name=field_pc_unit_q,
-                                           tile=tile_q)
-                logger.debug(conn.print_query(query))
-                resultset = conn.getQuery(query)
-                logger.debug(resultset)
-                # the AHN3 file creation date that is stored in the tile index
-                try:
-                    ahn_file_date = resultset[0][0].isoformat()
-                    ahn_version = resultset[0][1]
-                except (IndexError, AttributeError) as e:
-                    ahn_file_date = -99.99
-                    ahn_version = -99.99
-                    logger.error(e)
-                
-                # Need to do some linux text-fu so that the whole csv file can
-                # be imported with COPY instead of row-wise edit and import
-                # in python (suuuper slow)
-                # Watch out for trailing commas from the CSV (until #58 is fixed in 3dfier)
-                cmd_add_ahn = "gawk -i inplace -F',' 'BEGIN { OFS = \",\" } {$23=\"%s,%s,%s\"; print}' %s" % (
-                    ahn_file_date, 
-                    ahn_version,
-                    tile,
-                    path)
-                run(cmd_add_ahn, shell=True)
-                cmd_header = "sed -i '1s/.*/id,ground-0.00,ground-0.10,ground-0.20,\
-ground-0.30,ground-0.40,ground-0.50,\
-roof-0.25,rmse-0.25,roof-0.50,rmse-0.50,roof-0.75,rmse-0.75,roof-0.90,rmse-0.90,\
-roof-0.95,rmse-0.95,roof-0.99,rmse-0.99,roof_flat,nr_ground_pts,nr_roof_pts,\
-ahn_file_date,ahn_version,tile_id/' %s" % path
-                run(cmd_header, shell=True)
-                
-                with open(path, "r") as f_in:
-                    next(f_in) # skip header
-                    logger.debug(f_in)
-                    cur.copy_from(f_in, tbl, sep=',', null='-99.99')
-                        
-        conn.sendQuery(
+    
+    def __init__(self, conn, nr_threads):
+        # A separate pool, so that it does not interfere with the pool of
+        # the 3dfier workers
+        self.pool_conn = db.db(conn.dbname, conn.host, conn.port, conn.user,
+                               password=conn.password, conn=conn.conn)
+        self.pool_conn.create_pool(1, nr_threads)
+        self.executor = ThreadPoolExecutor(max_workers=nr_threads,
+                                           thread_name_prefix="Import")
+    
+    def close(self):
+        """Wait for the queued files and close the connections"""
+        self.executor.shutdown(wait=True)
+        self.pool_conn.pool.closeall()
+        self.pool_conn.pool = None
+
+
+class StreamingImporter(object):
+    """Import the CSV files of the tiles while the other tiles are being processed
+    
+    The files are imported by the :py:class:`ImportWorkers`, by default
+    config:import_threads threads (defaults to config:threads) over their
+    own pooled connections, each file in its own transaction, see
+    :py:func:`copy_csv`. The AHN attributes of the tiles
+    are loaded up front with :py:func:`get_ahn_attributes`, so there are no
+    queries per file. Thus :py:meth:`submit` can be
+    passed to :py:func:`bag3d.batch3dfier.process.run` as on_tile_done.
+    The files of a resumed run are submitted with replace=True, so that the
+    rows of a tile that was imported but not recorded as imported are not
+    duplicated.
+    
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection, its connection parameters are used for the pool
+    cfg: dict
+        batch3dfier YAML config as returned by :meth:`bag3d.config.args.parse_config`
+    remove : bool
+        Delete the CSV files after they were imported
+    workers : :py:class:`ImportWorkers`
+        If provided, the files are imported by these shared workers, and they
+        are not closed by :py:meth:`finish`
+    """
+    
+    def __init__(self, conn, cfg, remove=False, workers=None):
+        self.conn = conn
+        self.cfg = cfg
+        self.remove = remove
+        self.schema_out_q = sql.Identifier(cfg["output"]["staging"]["schema"])
+        self.table_out_q = sql.Identifier(cfg["output"]["staging"]["heights_table"])
+        self.copy_q = sql.SQL("""COPY {schema}.{table} FROM STDIN
+                         WITH (FORMAT text, DELIMITER ',', NULL '-99.99');
+                         """).format(schema=self.schema_out_q, table=self.table_out_q)
+        self.delete_q = sql.SQL("DELETE FROM {schema}.{table} WHERE tile_id = %s;").format(
+            schema=self.schema_out_q, table=self.table_out_q)
+        self.nr_threads = cfg['config'].get('import_threads') or \
+            cfg['config'].get('threads', 1)
+        self.retries = cfg['config'].get('import_retries', 1)
+        self.ok = create_heights_table(conn, cfg["output"]["staging"]["schema"],
+                                       cfg["output"]["staging"]["heights_table"],
+                                       unlogged=cfg['config'].get('fast_load', False))
+        self.futures = {}
+        self.workers = workers
+        self.own_workers = workers is None
+        if self.ok:
+            self.ahn_attributes = get_ahn_attributes(conn, cfg)
+            if self.own_workers:
+                self.workers = ImportWorkers(conn, self.nr_threads)
+        else:
+            logger.error("csv2db: exit because create_heights_table returned False")
+    
+    def submit(self, path, on_imported=None, replace=False):
+        """Queue a CSV file for import
+        
+        Parameters
+        ----------
+        path : str
+            Path to the CSV file
+        on_imported : callable
+            If provided, it is called without arguments after the file was
+            imported
+        replace : bool
+            Delete the rows of the tile before importing the file
+        """
+        if self.ok:
+            future = self.workers.executor.submit(self.import_file, path,
+                                          on_imported=on_imported,
+                                          replace=replace)
+            self.futures[future] = path
+    
+    def import_file(self, path, on_imported=None, replace=False):
+        csv_file = os.path.split(path)[1]
+        fname = os.path.splitext(csv_file)[0]
+        tile = fname.replace(self.cfg['input_polygons']['tile_prefix'], '', 1)
+        # the AHN3 file creation date that is stored in the tile index
+        try:
+            ahn_file_date, ahn_version = self.ahn_attributes[tile]
+            ahn_file_date = ahn_file_date.isoformat()
+        except (KeyError, AttributeError):
+            ahn_file_date = -99.99
+            ahn_version = -99.99
+            logger.error("No AHN file date or version for tile %s", tile)
+        success = copy_csv(self.workers.pool_conn, self.copy_q, path, ahn_file_date,
+                           ahn_version, tile, retries=self.retries,
+                           delete_q=self.delete_q if replace else None)
+        if success and on_imported is not None:
+            on_imported()
+        if success and self.remove:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.error(e)
+        return success
+    
+    def finish(self):
+        """Wait for the queued files, then index the heights table
+        
+        Returns
+        -------
+        int
+            Number of imported files
+        """
+        if not self.ok:
+            return 0
+        if self.own_workers:
+            self.workers.close()
+        else:
+            wait(self.futures)
+        failed = [p for f, p in self.futures.items() if not f.result()]
+        if failed:
+            logger.error("Failed to import %s CSV files: %s", len(failed), failed)
+        nr_imported = len(self.futures) - len(failed)
+        logger.info("Imported %s CSV files", nr_imported)
+        
+        table_idx = sql.Identifier(self.cfg["output"]["staging"]["schema"] + "_id_idx")
+        self.conn.sendQuery(
             sql.SQL("""CREATE INDEX IF NOT EXISTS {table}
                     ON {out_schema_q}.{table_q} (id);
-                    """).format(out_schema_q=schema_out_q,
-                                table_q=table_out_q,
+                    """).format(out_schema_q=self.schema_out_q,
+                                table_q=self.table_out_q,
                                 table=table_idx)
         )
-        conn.sendQuery(
+        self.conn.sendQuery(
             sql.SQL("""COMMENT ON TABLE {out_schema}.{table} IS
                     'Building heights generated with 3dfier.';
-                    """).format(out_schema=schema_out_q,
-                               table=table_out_q)
+                    """).format(out_schema=self.schema_out_q,
+                               table=self.table_out_q)
         )
-    else:
-        logger.error("csv2db: exit because create_heights_table returned False")
+        return nr_imported
+
+
+def csv2db(conn, cfg, out_paths):
+    """Create a table with multiple height info per BAG building footprint
+    
+    Note
+    ----
+    Only for 3dfier's CSV-BUILDINGS-MULTIPLE output. 
+    The ahn_file_date, ahn_version and tile_id fields are added to the rows
+    while the CSV files are streamed into the database, see :py:class:`HeightsCSV`.
+    The files are imported in parallel, see :py:class:`StreamingImporter`.
+    
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    cfg: dict
+        batch3dfier YAML config as returned by :meth:`bag3d.config.args.parse_config`
+    out_paths: list of strings
+        Paths of the CSV files
+    """
+    streaming = StreamingImporter(conn, cfg)
+    for path in out_paths:
+        streaming.submit(path)
+    streaming.finish()
 
 
 def create_bag3d_relations(conn, cfg):
@@ -218,7 +463,7 @@ def create_bag3d_relations(conn, cfg):
     conn.sendQuery(drop_q)
     
     query = sql.SQL("""
-    CREATE TABLE {out_schema}.{bag3d} AS
+    CREATE {unlogged}TABLE {out_schema}.{bag3d} AS
     SELECT
         p.gid,
         p.identificatie,
@@ -269,7 +514,8 @@ def create_bag3d_relations(conn, cfg):
     FROM {bag_schema}.{bag} p
     INNER JOIN {out_schema}.{heights} h ON p.{uniqueid} = h.id;
     """).format(bag=bag_table_q, uniqueid=uniqueid_q,bag_schema=bag_schema_q,
-                bag3d=bag3d_table_q, out_schema=output_schema_q, heights=heights_table_q)
+                bag3d=bag3d_table_q, out_schema=output_schema_q, heights=heights_table_q,
+                unlogged=unlogged_q(cfg['config'].get('fast_load', False)))
     # the type of bagactueel.pand.identificatie can change between different 
     # BAG extracts (numeric or varchar)
     conn.sendQuery(query)
@@ -414,7 +660,7 @@ def unite_border_tiles(conn, schema, border_ahn2, border_ahn3):
         raise
 
 
-def create_bag3d_table(conn, schema, name):
+def create_bag3d_table(conn, schema, name, unlogged=False, nr_threads=1):
     """Unite the border tiles with the rest
     
     Note
@@ -432,6 +678,11 @@ def create_bag3d_table(conn, schema, name):
         Value from output:schema
     name : str
         Name of the new table
+    unlogged : bool
+        Create an UNLOGGED table, it is converted to a logged table by
+        :py:func:`bag3d.exporter.migrate`
+    nr_threads : int
+        Number of indexes to build at the same time
     
     Raises
     ------
@@ -450,7 +701,7 @@ def create_bag3d_table(conn, schema, name):
         schema=sql.Identifier(schema))
     
     query_t = sql.SQL("""
-    CREATE TABLE {schema}.{bag3d} AS
+    CREATE {unlogged}TABLE {schema}.{bag3d} AS
     SELECT *
     FROM {schema}.{bag3d_rest}
     WHERE ahn_version IS NOT NULL
@@ -460,24 +711,40 @@ def create_bag3d_table(conn, schema, name):
     WHERE ahn_version IS NOT NULL;
     """).format(schema=sql.Identifier(schema), 
                 bag3d=sql.Identifier(name),
-                bag3d_rest=sql.Identifier(name+"_rest"))
+                bag3d_rest=sql.Identifier(name+"_rest"),
+                unlogged=unlogged_q(unlogged))
     
+    # The primary key is built as a unique index, so that it can be built
+    # together with the other index
     idx_name = name + "_geom_idx"
-    query_i = sql.SQL("""
-    CREATE INDEX {idx_name} ON {schema}.{bag3d} USING gist (geovlak);
-    ALTER TABLE {schema}.{bag3d} ADD PRIMARY KEY (gid);
+    query_i = [
+        sql.SQL("""
+        CREATE INDEX {idx_name} ON {schema}.{bag3d} USING gist (geovlak);
+        """).format(schema=sql.Identifier(schema),
+                    bag3d=sql.Identifier(name),
+                    idx_name=sql.Identifier(idx_name)),
+        sql.SQL("""
+        CREATE UNIQUE INDEX {pkey} ON {schema}.{bag3d} (gid);
+        """).format(schema=sql.Identifier(schema),
+                    bag3d=sql.Identifier(name),
+                    pkey=sql.Identifier(name + "_pkey"))]
+    query_pk = sql.SQL("""
+    ALTER TABLE {schema}.{bag3d} ADD PRIMARY KEY USING INDEX {pkey};
     COMMENT ON TABLE {schema}.{bag3d} IS 'The 3D BAG';
     """).format(schema=sql.Identifier(schema),
                 bag3d=sql.Identifier(name),
-                idx_name=sql.Identifier(idx_name))
+                pkey=sql.Identifier(name + "_pkey"))
     
     try:
         logger.debug(conn.print_query(drop_q))
         conn.sendQuery(drop_q)
         logger.debug(conn.print_query(query_t))
         conn.sendQuery(query_t)
-        logger.debug(conn.print_query(query_i))
-        conn.sendQuery(query_i)
+        for q in query_i:
+            logger.debug(conn.print_query(q))
+        conn.send_parallel(query_i, nr_threads)
+        logger.debug(conn.print_query(query_pk))
+        conn.sendQuery(query_pk)
     except psycopg2.IntegrityError as e:
         logger.exception("There are overlapping footprints in the border and non-border tiles, possibly because some tiles were processed in a batch where they do not belong.")
         logger.exception(e)
@@ -498,6 +765,16 @@ def drop_border_view(conn, schema):
         logger.exception(e)
         raise
 
+def drop_heights_table(conn, cfg):
+    """Drop the heights table, eg. the partial import of an interrupted run"""
+    query_d = sql.SQL("""
+    DROP TABLE IF EXISTS {schema}.{table};
+    """).format(schema=sql.Identifier(cfg["output"]["staging"]["schema"]),
+                table=sql.Identifier(cfg["output"]["staging"]["heights_table"]))
+    logger.debug(conn.print_query(query_d))
+    conn.sendQuery(query_d)
+
+
 def drop_border_table(conn, cfg):
     query_d = sql.SQL("""
     DROP TABLE IF EXISTS {schema}.{table};
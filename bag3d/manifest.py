@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+"""The manifest of a run, for resuming an interrupted run"""
+
+import os
+import json
+import threading
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class RunManifest(object):
+    """A JSON file of the completed stages and tiles of a run
+
+    The manifest is written after every change, atomically, so it is
+    consistent after a crash. The tiles are recorded when 3dfier processed
+    them and again when their output was imported, because the output is
+    deleted after the import with --remove-csv.
+
+    Parameters
+    ----------
+    path : str
+        Path to the JSON file
+    resume : bool
+        Continue the run recorded in the file. If False or the file does not
+        exist, a new run is started and the file is overwritten.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.content = None
+        if resume:
+            try:
+                with open(path, "r") as f_in:
+                    self.content = json.load(f_in)
+                logger.info("Resuming the run started at %s, completed stages: %s",
+                            self.content['started'], self.content['stages'])
+            except (OSError, ValueError, KeyError):
+                logger.warning("Cannot read the run manifest %s, starting a new run", path)
+                self.content = None
+        if self.content is None:
+            self.content = {'started': datetime.now().isoformat(),
+                            'stages': [],
+                            'tiles': {},
+                            'imported': {}}
+            self.save()
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f_out:
+            json.dump(self.content, f_out)
+        os.replace(tmp, self.path)
+
+    def is_done(self, stage):
+        """Is the stage completed?"""
+        with self.lock:
+            return stage in self.content['stages']
+
+    def todo(self, stage):
+        """Is the stage not completed yet? Logs the skipped stages."""
+        if self.is_done(stage):
+            logger.info("Skipping the completed stage %s", stage)
+            return False
+        return True
+
+    @contextmanager
+    def stage(self, name, report=None):
+        """Record the stage as completed when the with block finishes
+
+        Parameters
+        ----------
+        name : str
+        report : :py:class:`bag3d.report.RunReport`
+            If provided, the stage is timed in the report
+        """
+        if report is None:
+            yield
+        else:
+            with report.stage(name):
+                yield
+        self.stage_done(name)
+
+    def stage_done(self, stage):
+        """Record a completed stage"""
+        with self.lock:
+            if stage not in self.content['stages']:
+                self.content['stages'].append(stage)
+                self.save()
+        logger.debug("Completed stage %s", stage)
+
+    def tile_done(self, group, tile, out_path):
+        """Record a processed tile and its output"""
+        with self.lock:
+            self.content['tiles'].setdefault(group, {})[tile] = out_path
+            self.save()
+
+    def tile_imported(self, group, tile):
+        """Record a tile whose output was imported"""
+        with self.lock:
+            imported = self.content.setdefault('imported', {}).setdefault(group, [])
+            if tile not in imported:
+                imported.append(tile)
+                self.save()
+
+    def imported_tiles(self, group):
+        """The tiles of a tile group whose output was imported
+
+        Returns
+        -------
+        set
+        """
+        with self.lock:
+            return set(self.content.get('imported', {}).get(group, []))
+
+    def done_tiles(self, group):
+        """The processed, not imported tiles of a tile group whose output
+        still exists
+
+        Returns
+        -------
+        dict
+            {tile: output path}
+        """
+        imported = self.imported_tiles(group)
+        with self.lock:
+            tiles = dict(self.content['tiles'].get(group, {}))
+        return {t: p for t, p in tiles.items()
+                if t not in imported and p and os.path.exists(p)}
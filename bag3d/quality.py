@@ -244,6 +244,15 @@ def get_counts(conn, config):
         logger.exception(e)
         raise
 
+def tile_assignment_exists(conn, config):
+    """Does the tile assignment of the footprints exist?"""
+    name = '"%s"."%s"' % (config['input_polygons']['footprints']['schema'],
+                          config['input_polygons']['footprints']['tile_assignment'])
+    query = sql.SQL("SELECT to_regclass({name}) IS NOT NULL;").format(
+        name=sql.Literal(name))
+    return conn.getQuery(query)[0][0]
+
+
 def buildings_per_tile(conn, config):
     """Count the number of buildings in the BAG and the 3D BAG per tile"""
     schema = sql.Identifier(config['input_polygons']['footprints']['schema'])
@@ -253,8 +262,19 @@ def buildings_per_tile(conn, config):
     field_idx_unit_q = sql.Identifier(config['tile_index']['polygons']['fields']['unit_name'])
     field_idx_geom_q = sql.Identifier(config['tile_index']['polygons']['fields']['geometry'])
 
-    query = sql.SQL("""
-    WITH bag_tiles AS (
+    table_asg = config['input_polygons']['footprints'].get('tile_assignment')
+    use_asg = config['config'].get('tile_partitioning') == 'table'
+    if use_asg and not tile_assignment_exists(conn, config):
+        logger.warning("The tile assignment %s does not exist, joining the "
+                       "footprints with the tiles instead", table_asg)
+        use_asg = False
+    if use_asg:
+        # The tile assignment of the footprints is computed already
+        bag_tiles = sql.SQL("""
+    SELECT gid, {field_idx}
+    FROM {schema}.{table_asg}""")
+    else:
+        bag_tiles = sql.SQL("""
     SELECT
         {table_bag}.gid,
         {table_idx}.{field_idx}
@@ -265,7 +285,17 @@ def buildings_per_tile(conn, config):
         {schema_idx}.{table_idx}
     WHERE
         st_containsproperly({table_idx}.{field_idx_geom}, pand_centroid.geom)
-        OR st_contains({table_idx}.geom_border, pand_centroid.geom)
+        OR st_contains({table_idx}.geom_border, pand_centroid.geom)""")
+    bag_tiles = bag_tiles.format(schema=schema,
+                                 table_bag=table_bag_q,
+                                 table_asg=sql.Identifier(table_asg or ""),
+                                 schema_idx=schema_idx_q,
+                                 table_idx=table_idx_q,
+                                 field_idx=field_idx_unit_q,
+                                 field_idx_geom=field_idx_geom_q)
+
+    query = sql.SQL("""
+    WITH bag_tiles AS ({bag_tiles}
     ),
     bag_tiles_cnt AS (
         SELECT {field_idx} AS tile_id, count(*) AS bag_cnt
@@ -286,12 +316,8 @@ def buildings_per_tile(conn, config):
     FROM counts;
     """).format(bag3d=sql.Identifier(config['output']['production']['bag3d_table']),
                 out_schema=sql.Identifier(config['output']['production']['schema']),
-                schema=schema,
-                table_bag=table_bag_q,
-                schema_idx=schema_idx_q,
-                table_idx=table_idx_q,
-                field_idx=field_idx_unit_q,
-                field_idx_geom=field_idx_geom_q
+                bag_tiles=bag_tiles,
+                field_idx=field_idx_unit_q
                 )
     try:
         logger.debug(conn.print_query(query))
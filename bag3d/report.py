@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""Timing of the stages of a run and the run report"""
+
+import os
+import json
+import socket
+import threading
+import logging
+from time import perf_counter
+from datetime import datetime
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_counters = {'db_time': 0.0, 'db_queries': 0, 'rows': 0,
+             'subprocess_time': 0.0, 'subprocesses': 0}
+
+
+def record_db(seconds, rows=0):
+    """Count a database call, see :py:class:`bag3d.config.db.db`
+
+    Parameters
+    ----------
+    seconds : float
+        Duration of the call
+    rows : int
+        Number of rows affected or returned
+    """
+    with _lock:
+        _counters['db_time'] += seconds
+        _counters['db_queries'] += 1
+        _counters['rows'] += max(rows or 0, 0)
+
+
+def record_subprocess(seconds):
+    """Count a subprocess, see :py:func:`bag3d.update.bag.run_subprocess`"""
+    with _lock:
+        _counters['subprocess_time'] += seconds
+        _counters['subprocesses'] += 1
+
+
+def counters():
+    """The database and subprocess counters of the process since its start"""
+    with _lock:
+        return dict(_counters)
+
+
+class RunReport(object):
+    """Record the duration and the resource use of the stages of a run
+
+    Every stage records its wall time, and the time spent in database calls
+    and in subprocesses, the number of database calls, subprocesses and rows
+    affected or returned while the stage ran. The database and subprocess
+    times are summed over the threads, thus they can exceed the wall time.
+    Stages can be nested, the counters of a sub-stage are included in its
+    parent stage too.
+
+    The report is written to `path` as JSON after every stage.
+
+    Parameters
+    ----------
+    path : str
+        Path to the JSON report
+    args : dict
+        The command line arguments, stored in the report
+    """
+
+    def __init__(self, path, args=None):
+        self.path = path
+        self.content = {'started': datetime.now().isoformat(),
+                        'finished': None,
+                        'host': socket.gethostname(),
+                        'args': args or {},
+                        'stages': []}
+        self.running = {}
+
+    def start(self, name):
+        """Start timing a stage"""
+        self.running[name] = (datetime.now().isoformat(), perf_counter(),
+                              counters())
+
+    def finish(self, name, status='ok'):
+        """Finish timing a stage and write the report"""
+        try:
+            started, start, before = self.running.pop(name)
+        except KeyError:
+            logger.debug("Stage %s was not started", name)
+            return
+        after = counters()
+        stage = {'name': name, 'status': status, 'started': started,
+                 'wall_time': perf_counter() - start}
+        stage.update((k, after[k] - before[k]) for k in after)
+        self.content['stages'].append(stage)
+        logger.debug("Stage %s: %s", name, stage)
+        self.write()
+
+    @contextmanager
+    def stage(self, name):
+        """Time the stage in the with block"""
+        self.start(name)
+        try:
+            yield
+        except BaseException:
+            self.finish(name, status='failed')
+            raise
+        self.finish(name)
+
+    def attach(self, name, data):
+        """Add a section to the report, eg. the query profile"""
+        self.content[name] = data
+
+    def close(self):
+        """Mark the unfinished stages as failed and write the report"""
+        for name in list(self.running):
+            self.finish(name, status='failed')
+        self.content['finished'] = datetime.now().isoformat()
+        self.write()
+        logger.info("Written the run report to %s", self.path)
+
+    def write(self):
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f_out:
+                json.dump(self.content, f_out, indent=2, default=str)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.error("Cannot write the run report %s: %s", self.path, e)
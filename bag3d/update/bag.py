@@ -3,11 +3,15 @@
 """Update the BAG database (2D) and tile index"""
 
 import os.path
+import sys
 from datetime import datetime, date
-from subprocess import PIPE
-from psutil import Popen, Process, NoSuchProcess, ZombieProcess, AccessDenied, swap_memory, virtual_memory
+from subprocess import PIPE, Popen
+from psutil import Process, NoSuchProcess, ZombieProcess, AccessDenied
 import locale
+import json
 from shutil import which
+from threading import Thread, Event
+from time import perf_counter
 
 # from memory_profiler import memory_usage
 
@@ -17,6 +21,7 @@ import urllib.request
 from psycopg2 import sql
 
 from bag3d.config import db
+from bag3d import report
 
 
 logger = logging.getLogger(__name__)
@@ -42,7 +47,160 @@ logger_perf = logging.getLogger('performance')
     #     return None
 
 
-def run_subprocess(command, shell=False, doexec=True, monitor=False, tile_id=None):
+class ResourceSampler(object):
+    """Sample the resource use of a process and its children in the background
+
+    Every sample records the resident memory, the CPU time (user + system)
+    and the bytes read and written by the process tree. The summary is
+    stored in `stats` while sampling, and if `tile_id` is provided every
+    sample is logged to the 'performance' logger as a JSON record. A child
+    that exits during a sample is left out of that sample, sampling stops
+    when the watched process is gone.
+
+    Parameters
+    ----------
+    proc : psutil.Process
+        The process to watch
+    stats : dict
+        The peak RSS in bytes is stored in stats['peak_rss'], the CPU time in
+        seconds, and the bytes read and written at the last sample in
+        stats['cpu_time'], stats['read_bytes'] and stats['write_bytes'], the
+        number of samples in stats['samples']. The CPU time and peak RSS
+        are corrected with the resource use of the reaped process in
+        :py:meth:`stop`.
+    interval : float
+        Sampling interval in seconds
+    tile_id : str
+        The tile of the process, for logging the samples
+    """
+
+    def __init__(self, proc, stats, interval=1.0, tile_id=None):
+        self.proc = proc
+        self.stats = stats
+        self.interval = interval
+        self.tile_id = tile_id
+        self.done = Event()
+        self.start_time = perf_counter()
+        self.thread = Thread(target=self.run, daemon=True)
+        for k in ('peak_rss', 'read_bytes', 'write_bytes', 'samples'):
+            stats.setdefault(k, 0)
+        stats.setdefault('cpu_time', 0.0)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self, rusage=None):
+        """Stop sampling and wait for the last sample
+
+        Parameters
+        ----------
+        rusage : resource.struct_rusage
+            The resource use of the reaped process and its waited-for
+            children, eg. from os.wait4(). The samples miss the CPU time
+            since the last sample and the children that ran between two
+            samples, the CPU time of rusage includes them.
+        """
+        self.done.set()
+        self.thread.join()
+        if rusage is not None:
+            stats = self.stats
+            stats['cpu_time'] = max(stats['cpu_time'],
+                                    rusage.ru_utime + rusage.ru_stime)
+            # ru_maxrss is the peak of the largest single process, in
+            # kilobytes on Linux and in bytes on macOS
+            maxrss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+            stats['peak_rss'] = max(stats['peak_rss'], maxrss)
+
+    def sample(self):
+        """Take a sample of the process tree
+
+        Returns
+        -------
+        dict
+            rss, cpu_time, read_bytes and write_bytes of the process tree
+
+        Raises
+        ------
+        psutil.NoSuchProcess, psutil.ZombieProcess, psutil.AccessDenied
+            If the watched process is gone or cannot be read
+        """
+        procs = [self.proc] + self.proc.children(recursive=True)
+        s = {'rss': 0, 'cpu_time': 0.0, 'read_bytes': 0, 'write_bytes': 0}
+        for p in procs:
+            try:
+                with p.oneshot():
+                    rss = p.memory_info().rss
+                    t = p.cpu_times()
+                    try:
+                        io = p.io_counters()
+                    except (AttributeError, AccessDenied):
+                        # not available on every platform
+                        io = None
+            except (NoSuchProcess, ZombieProcess, AccessDenied):
+                if p is self.proc:
+                    raise
+                # the child exited since children()
+                continue
+            s['rss'] += rss
+            s['cpu_time'] += t.user + t.system
+            if io is not None:
+                s['read_bytes'] += io.read_bytes
+                s['write_bytes'] += io.write_bytes
+        return s
+
+    def run(self):
+        stats = self.stats
+        while True:
+            try:
+                s = self.sample()
+            except (NoSuchProcess, ZombieProcess, AccessDenied):
+                break
+            stats['peak_rss'] = max(stats['peak_rss'], s['rss'])
+            for k in ('cpu_time', 'read_bytes', 'write_bytes'):
+                stats[k] = max(stats[k], s[k])
+            stats['samples'] += 1
+            if self.tile_id is not None:
+                s['event'] = 'sample'
+                s['tile'] = self.tile_id
+                s['elapsed'] = round(perf_counter() - self.start_time, 3)
+                logger_perf.debug(json.dumps(s))
+            if self.done.wait(self.interval):
+                break
+
+
+def _wait(popen):
+    """Read the output of the process and reap it
+
+    Like Popen.communicate(), but the process is reaped with os.wait4() where
+    it is available, to get its resource use.
+
+    Returns
+    -------
+    tuple
+        stdout, stderr and the resource.struct_rusage of the process, or None
+        if os.wait4() is not available
+    """
+    if not hasattr(os, 'wait4'):
+        stdout, stderr = popen.communicate()
+        return stdout, stderr, None
+    out = []
+    reader = Thread(target=lambda: out.append(popen.stdout.read()), daemon=True)
+    reader.start()
+    stderr = popen.stderr.read()
+    reader.join()
+    popen.stdout.close()
+    popen.stderr.close()
+    _, status, rusage = os.wait4(popen.pid, 0)
+    if os.WIFSIGNALED(status):
+        popen.returncode = -os.WTERMSIG(status)
+    else:
+        popen.returncode = os.WEXITSTATUS(status)
+    return out[0], stderr, rusage
+
+
+def run_subprocess(command, shell=False, doexec=True, monitor=False, tile_id=None,
+                   stats=None, pass_fds=(), sample_interval=1.0):
     """Subprocess runner
     
     If subrocess returns non-zero exit code, STDERR is sent to the logger.
@@ -55,50 +213,55 @@ def run_subprocess(command, shell=False, doexec=True, monitor=False, tile_id=Non
         Passed to subprocess.run()
     doexec : bool
         Execute the subprocess or just print out the concatenated command
+    monitor : bool
+        Log the resource use samples of the process to the 'performance'
+        logger, see :py:class:`ResourceSampler`
+    tile_id : str
+        The tile of the process, for logging
+    stats : dict
+        If provided, the peak RSS ('peak_rss'), CPU time ('cpu_time'), bytes
+        read and written ('read_bytes', 'write_bytes'), wall
+        time ('wall_time') and exit code ('returncode') of the process are
+        stored in it, and the end of STDERR ('stderr') if the process failed
+    pass_fds : sequence of int
+        File descriptors that are kept open in the subprocess, passed to
+        subprocess.Popen()
+    sample_interval : float
+        Seconds between the resource use samples
     
     Returns
     -------
-    nothing
-        nothing
+    bool
+        True if the process returned with zero exit code
     """
     if doexec:
         cmd = " ".join(command)
         if shell:
             command = cmd
         logger.debug(command)
-        popen = Popen(command, shell=shell, stderr=PIPE, stdout=PIPE)
+        start = perf_counter()
+        popen = Popen(command, shell=shell, stderr=PIPE, stdout=PIPE,
+                      pass_fds=pass_fds)
         pid = popen.pid
-        if monitor:
-            proc = Process(pid)
-            with proc.oneshot():
-                try:
-                    logger_perf.debug("%s;%s;%s" % (
-                        tile_id, virtual_memory().used, swap_memory().used))
-                except NoSuchProcess or ZombieProcess:
-                    logger.debug("%s is Zombie or NoSuchProcess" % tile_id)
-                except AccessDenied as e:
-                    logger_perf.exception(e)
-        # if monitor:
-        #     running = True
-        #     proc = Process(pid)
-        #     with proc.oneshot():
-        #         while running:
-        #             try:
-        #                 logger_perf.debug("%s - %s - %s - %s - %s" % (
-        #                 tile_id, proc.cpu_percent(), proc.cpu_times(), proc.memory_full_info(), swap_memory()))
-        #             except NoSuchProcess or ZombieProcess:
-        #                 logger.debug("%s is Zombie or NoSuchProcess" % tile_id)
-        #                 break
-        #             except AccessDenied as e:
-        #                 logger_perf.exception(e)
-        #                 break
-        #             running = proc.is_running()
-        #             logger.debug("%s is running: %s" % (tile_id, running))
-        #             sleep(1)
-        stdout, stderr = popen.communicate()
+        sampler = None
+        if stats is not None or monitor:
+            sampler = ResourceSampler(Process(pid),
+                                      stats if stats is not None else {},
+                                      interval=sample_interval,
+                                      tile_id=tile_id if monitor else None)
+            sampler.start()
+        stdout, stderr, rusage = _wait(popen)
         err = stderr.decode(locale.getpreferredencoding(do_setlocale=True))
-        popen.wait()
+        if sampler is not None:
+            sampler.stop(rusage)
+        wall_time = perf_counter() - start
+        report.record_subprocess(wall_time)
+        if stats is not None:
+            stats['wall_time'] = wall_time
+            stats['returncode'] = popen.returncode
         if popen.returncode != 0:
+            if stats is not None:
+                stats['stderr'] = err[-2000:]
             logger.debug("Process returned with non-zero exit code: %s", popen.returncode)
             logger.error(err)
             return False
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+"""Incremental update of the 3D BAG from the changed BAG footprints
+
+The state of the footprints that are in the production 3D BAG is kept in the
+table 'bag3d_state' in the staging schema. It stores the identificatie, the
+md5 hash of the geometry and the begindatumtijdvakgeldigheid of every
+footprint. Comparing the footprints with the state yields the new, changed
+and deleted footprints, which are stored in the table 'bag3d_changes'. Only
+the tiles of these footprints need to go through 3dfier, and only their rows
+are replaced in the production table.
+"""
+
+import logging
+
+from psycopg2 import sql
+
+logger = logging.getLogger(__name__)
+
+STATE_TABLE = "bag3d_state"
+CHANGES_TABLE = "bag3d_changes"
+
+
+def create_state_table(conn, cfg):
+    """Create the table of the last processed state of the footprints if not exists
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    cfg: dict
+        bag3d configuration
+    """
+    query = sql.SQL("""
+    CREATE SCHEMA IF NOT EXISTS {schema};
+    CREATE TABLE IF NOT EXISTS {schema}.{state} (
+        identificatie varchar PRIMARY KEY,
+        geom_md5 text,
+        begindatumtijdvakgeldigheid timestamp,
+        tile_id text
+        );
+    """).format(schema=sql.Identifier(cfg['output']['staging']['schema']),
+                state=sql.Identifier(STATE_TABLE))
+    logger.debug(conn.print_query(query))
+    conn.sendQuery(query)
+
+
+def find_changes(conn, cfg):
+    """Compare the footprints with the last processed state
+
+    The new, changed and deleted footprints are stored in the table
+    'bag3d_changes' in the staging schema, together with the tile they were
+    processed in the last time. If the state is empty, every footprint is new.
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    cfg: dict
+        bag3d configuration
+
+    Returns
+    -------
+    dict
+        Number of footprints per change type ('new', 'changed', 'deleted')
+    """
+    schema_q = sql.Identifier(cfg['output']['staging']['schema'])
+    changes_q = sql.Identifier(CHANGES_TABLE)
+    query = sql.SQL("""
+    DROP TABLE IF EXISTS {schema}.{changes};
+    CREATE TABLE {schema}.{changes} AS
+    SELECT
+        coalesce(n.identificatie, s.identificatie) AS identificatie,
+        CASE
+            WHEN s.identificatie IS NULL THEN 'new'
+            WHEN n.identificatie IS NULL THEN 'deleted'
+            ELSE 'changed'
+        END AS change,
+        s.tile_id
+    FROM (
+        SELECT
+            {uniqueid}::varchar AS identificatie,
+            md5(st_asbinary(geovlak)) AS geom_md5,
+            begindatumtijdvakgeldigheid
+        FROM {bag_schema}.{bag}
+    ) n
+    FULL OUTER JOIN {schema}.{state} s ON n.identificatie = s.identificatie
+    WHERE
+        s.identificatie IS NULL
+        OR n.identificatie IS NULL
+        OR n.geom_md5 <> s.geom_md5
+        OR n.begindatumtijdvakgeldigheid IS DISTINCT FROM s.begindatumtijdvakgeldigheid;
+    CREATE INDEX ON {schema}.{changes} (identificatie);
+    """).format(schema=schema_q, changes=changes_q,
+                state=sql.Identifier(STATE_TABLE),
+                bag_schema=sql.Identifier(cfg['input_polygons']['footprints']['schema']),
+                bag=sql.Identifier(cfg['input_polygons']['footprints']['table']),
+                uniqueid=sql.Identifier(cfg['input_polygons']['footprints']['fields']['uniqueid']))
+    logger.debug(conn.print_query(query))
+    conn.sendQuery(query)
+    query = sql.SQL("""
+    SELECT change, count(*) FROM {schema}.{changes} GROUP BY change;
+    """).format(schema=schema_q, changes=changes_q)
+    counts = dict(conn.getQuery(query))
+    logger.info("BAG footprints new: %s, changed: %s, deleted: %s",
+                counts.get('new', 0), counts.get('changed', 0),
+                counts.get('deleted', 0))
+    return counts
+
+
+def affected_tiles(conn, cfg):
+    """The tiles that contain a new, changed or deleted footprint
+
+    A tile is affected if it intersects the current geometry of a new or
+    changed footprint, or if a changed or deleted footprint was processed in
+    it the last time.
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    cfg: dict
+        bag3d configuration
+
+    Returns
+    -------
+    set of str
+        Names of the tiles as in tile_index:polygons:fields:unit_name
+    """
+    idx = cfg['tile_index']['polygons']
+    query = sql.SQL("""
+    SELECT DISTINCT i.{unit}::text
+    FROM {schema}.{changes} c
+    INNER JOIN {bag_schema}.{bag} p ON p.{uniqueid}::varchar = c.identificatie
+    INNER JOIN {idx_schema}.{idx_table} i ON st_intersects(i.{idx_geom}, p.geovlak)
+    WHERE c.change <> 'deleted'
+    UNION
+    SELECT DISTINCT tile_id
+    FROM {schema}.{changes}
+    WHERE tile_id IS NOT NULL;
+    """).format(schema=sql.Identifier(cfg['output']['staging']['schema']),
+                changes=sql.Identifier(CHANGES_TABLE),
+                bag_schema=sql.Identifier(cfg['input_polygons']['footprints']['schema']),
+                bag=sql.Identifier(cfg['input_polygons']['footprints']['table']),
+                uniqueid=sql.Identifier(cfg['input_polygons']['footprints']['fields']['uniqueid']),
+                idx_schema=sql.Identifier(idx['schema']),
+                idx_table=sql.Identifier(idx['table']),
+                idx_geom=sql.Identifier(idx['fields']['geometry']),
+                unit=sql.Identifier(idx['fields']['unit_name']))
+    logger.debug(conn.print_query(query))
+    tiles = {r[0] for r in conn.getQuery(query)}
+    logger.info("%s tiles are affected by the changes", len(tiles))
+    return tiles
+
+
+def filter_tiles(tiles, affected, prefix=None):
+    """Keep the tiles that are affected by the changes
+
+    Parameters
+    ----------
+    tiles : list of str
+        Tile names or tile view names
+    affected : set of str
+        Tile names, see :py:func:`affected_tiles`
+    prefix : str
+        The prefix of the tile view names
+
+    Returns
+    -------
+    list of str
+    """
+    prefix = prefix or ""
+    return [t for t in tiles if t in affected or
+            (t.startswith(prefix) and t[len(prefix):] in affected)]
+
+
+def production_exists(conn, cfg):
+    """Does the production table exist?"""
+    name = '"%s"."%s"' % (cfg['output']['production']['schema'],
+                          cfg['output']['production']['bag3d_table'])
+    query = sql.SQL("SELECT to_regclass({name}) IS NOT NULL;").format(
+        name=sql.Literal(name))
+    return conn.getQuery(query)[0][0]
+
+
+def upsert(conn, cfg):
+    """Replace the rows of the changed footprints in the production table
+
+    The rows of every footprint in 'bag3d_changes' are deleted from the
+    production table, the new ones included, so that the rows that a
+    previous, interrupted run inserted are not duplicated. Then the rows of
+    the new and changed footprints are inserted from the staging table. The
+    inserted rows get a new gid from the sequence of the production table.
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    cfg: dict
+        bag3d configuration
+    """
+    staging_schema_q = sql.Identifier(cfg['output']['staging']['schema'])
+    staging_table_q = sql.Identifier(cfg['output']['staging']['bag3d_table'])
+    prod_schema = cfg['output']['production']['schema']
+    prod_schema_q = sql.Identifier(prod_schema)
+    prod_table_q = sql.Identifier(cfg['output']['production']['bag3d_table'])
+    changes_q = sql.Identifier(CHANGES_TABLE)
+    query = sql.SQL("""
+    SELECT column_name FROM information_schema.columns
+    WHERE table_schema = {schema} AND table_name = {table}
+    ORDER BY ordinal_position;
+    """).format(schema=sql.Literal(prod_schema),
+                table=sql.Literal(cfg['output']['production']['bag3d_table']))
+    fields = [r[0] for r in conn.getQuery(query)]
+    fields_q = sql.SQL(", ").join(sql.Identifier(f) for f in fields if f != 'gid')
+    seq = sql.Literal('"%s".pand3d_gid_seq' % prod_schema)
+
+    query = sql.SQL("""
+    DELETE FROM {pr_s}.{pr_t} p
+    USING {st_s}.{changes} c
+    WHERE p.identificatie::varchar = c.identificatie;
+    SELECT setval({seq}, coalesce((SELECT max(gid) FROM {pr_s}.{pr_t}), 0) + 1, false);
+    INSERT INTO {pr_s}.{pr_t} ({fields})
+    SELECT {fields}
+    FROM {st_s}.{st_t} s
+    WHERE s.identificatie::varchar IN (
+        SELECT identificatie FROM {st_s}.{changes} WHERE change <> 'deleted'
+    );
+    """).format(pr_s=prod_schema_q, pr_t=prod_table_q, st_s=staging_schema_q,
+                st_t=staging_table_q, changes=changes_q, seq=seq,
+                fields=fields_q)
+    logger.debug(conn.print_query(query))
+    conn.sendQuery(query)
+
+
+def update_state(conn, cfg):
+    """Store the state of the footprints that are in the production table
+
+    Footprints without a row in the production table (eg. their tile failed)
+    are left out of the state, so they are processed again in the next run.
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    cfg: dict
+        bag3d configuration
+    """
+    query = sql.SQL("""
+    TRUNCATE {st_s}.{state};
+    INSERT INTO {st_s}.{state}
+    SELECT DISTINCT ON (p.{uniqueid})
+        p.{uniqueid}::varchar,
+        md5(st_asbinary(p.geovlak)),
+        p.begindatumtijdvakgeldigheid,
+        b.tile_id
+    FROM {bag_schema}.{bag} p
+    INNER JOIN {pr_s}.{pr_t} b ON p.{uniqueid}::varchar = b.identificatie::varchar;
+    """).format(st_s=sql.Identifier(cfg['output']['staging']['schema']),
+                state=sql.Identifier(STATE_TABLE),
+                bag_schema=sql.Identifier(cfg['input_polygons']['footprints']['schema']),
+                bag=sql.Identifier(cfg['input_polygons']['footprints']['table']),
+                uniqueid=sql.Identifier(cfg['input_polygons']['footprints']['fields']['uniqueid']),
+                pr_s=sql.Identifier(cfg['output']['production']['schema']),
+                pr_t=sql.Identifier(cfg['output']['production']['bag3d_table']))
+    logger.debug(conn.print_query(query))
+    conn.sendQuery(query)
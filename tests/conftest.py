@@ -1,5 +1,6 @@
 import pytest
 import os.path
+from contextlib import contextmanager
 
 from bag3d.config import db
 
@@ -16,6 +17,108 @@ def batch3dfier_db(request):
     return(dbs)
 
 
+#------------------------------------------------------------ DB without a DB
+class FakeConnection():
+    """A psycopg2 connection and cursor without a database
+
+    Records the executed queries and returns `resultset` to every fetch.
+    `on_execute(query)` and `on_copy(query, data)` are called before a query
+    is recorded, they can raise psycopg2 errors to simulate a failure.
+    """
+    closed = 0
+    autocommit = False
+
+    def __init__(self, resultset=None, rowcount=-1, on_execute=None,
+                 on_copy=None):
+        self.resultset = resultset if resultset is not None else []
+        self.rowcount = rowcount
+        self.on_execute = on_execute
+        self.on_copy = on_copy
+        self.queries = []
+        self.copied = []
+        self.copy_attempts = 0
+        self.rolled_back = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def cursor(self, **kwargs):
+        return self
+
+    def execute(self, query, vars=None):
+        if self.on_execute is not None:
+            self.on_execute(query)
+        self.queries.append(query)
+
+    def fetchall(self):
+        return list(self.resultset)
+
+    def copy_expert(self, query, f_in):
+        self.copy_attempts += 1
+        data = f_in.read()
+        if self.on_copy is not None:
+            self.on_copy(query, data)
+        self.copied.extend(data.splitlines())
+
+    def rollback(self):
+        self.rolled_back += 1
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeDB():
+    """A :py:class:`bag3d.config.db.db` without a database
+
+    Records the queries and returns `resultset` to every query.
+    `checked_out` is the number of connections checked out at the moment.
+    """
+    def __init__(self, resultset=None):
+        self.resultset = resultset if resultset is not None else []
+        self.queries = []
+        self.checked_out = 0
+
+    @contextmanager
+    def checkout(self):
+        self.checked_out += 1
+        try:
+            yield self
+        finally:
+            self.checked_out -= 1
+
+    def print_query(self, query):
+        return ""
+
+    def getQuery(self, query):
+        self.queries.append(query)
+        return self.resultset
+
+    def sendQuery(self, query):
+        self.queries.append(query)
+
+
+@pytest.fixture(scope="session")
+def fake_connection():
+    """The FakeConnection class, wrap it in a db instance with db.db(..., conn=)"""
+    return FakeConnection
+
+
+@pytest.fixture(scope="session")
+def fake_db():
+    """The FakeDB class"""
+    return FakeDB
+
+
+@pytest.fixture(scope="function")
+def fake_conn(fake_connection):
+    """A db instance on a FakeConnection"""
+    return db.db('batch3dfier_db', 'localhost', '5432', 'batch3dfier',
+                 conn=fake_connection())
+
+
 #-------------------------------------------------------------- data & folders
 @pytest.fixture(scope="session")
 def schema():
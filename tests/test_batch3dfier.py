@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+"""Testing config.batch3dfier"""
+
+import subprocess
+
+import pytest
+import psycopg2
+from psycopg2 import sql
+
+from bag3d.config import batch3dfier
+from bag3d.config import db
+
+
+@pytest.fixture(scope='module')
+def tile_index():
+    yield {'schema': 'tile_index', 'table': 'ahn_index',
+           'fields': {'unit_name': 'bladnr', 'geometry': 'geom'}}
+
+
+class TestFindPCTiles():
+    def test_identical(self, tile_index, fake_db):
+        conn = fake_db([('25gn1', '25GN1', 3), ('25gn2', '25GN2', None)])
+        r = batch3dfier.find_pc_tiles_all(conn, tile_index, tile_index['fields'],
+                                          True, ['t_25gn1', 't_25gn2'],
+                                          prefix_tile_footprint='t_')
+        assert r == {'t_25gn1': {'25gn1': 3}, 't_25gn2': {}}
+        assert len(conn.queries) == 1
+
+    def test_extent(self, tile_index, fake_db):
+        conn = fake_db([(None, '25GN1', 3), (None, '25GN2', 2)])
+        r = batch3dfier.find_pc_tiles_all(conn, tile_index, tile_index['fields'],
+                                          False, ['_clip3dfy_a', '_clip3dfy_b'],
+                                          extent_ewkb='0103')
+        assert r['_clip3dfy_a'] == r['_clip3dfy_b'] == {'25gn1': 3, '25gn2': 2}
+
+    def test_no_tiles(self, tile_index, fake_db):
+        assert batch3dfier.find_pc_tiles_all(fake_db([]), tile_index,
+                                             tile_index['fields'], True, []) == {}
+
+
+def test_pc_files():
+    pc_file_index = {'25gn1': ['/ahn3/c_25gn1.laz'], '25gn2': ['/ahn2/25gn2.laz']}
+    pc_path, ahn_version = batch3dfier.pc_files({'25gn1': 3, '37hn1': 3},
+                                                pc_file_index)
+    assert pc_path == ['/ahn3/c_25gn1.laz']
+    assert ahn_version == {3}
+
+
+class TestPCFileIndex():
+    @pytest.fixture(scope='function')
+    def pc_dirs(self, tmpdir):
+        ahn3 = tmpdir.mkdir('ahn3')
+        ahn2 = tmpdir.mkdir('ahn2')
+        for t in ['25gn1', '25gn2']:
+            ahn3.join('C_%s.LAZ' % t.upper()).write('')
+        for t in ['25gn2', '25gn3']:
+            ahn2.join('%s.laz' % t).write('')
+        yield batch3dfier.pc_name_dict([str(ahn3), str(ahn2)],
+                                       ['C_{tile}.LAZ', '{tile}.laz'])
+
+    def test_priority(self, pc_dirs):
+        idx = batch3dfier.pc_file_index(pc_dirs)
+        assert sorted(idx.keys()) == ['25gn1', '25gn2', '25gn3']
+        assert 'ahn3' in idx['25gn2'][0]
+
+    def test_cache(self, pc_dirs, tmpdir, monkeypatch):
+        cache = str(tmpdir.join('pc_index.json'))
+        idx = batch3dfier.pc_file_index(pc_dirs, cache=cache)
+
+        def fail(pc_dir, name):
+            raise AssertionError("%s should not be scanned" % pc_dir)
+        monkeypatch.setattr(batch3dfier, 'scan_pc_dir', fail)
+        assert batch3dfier.pc_file_index(pc_dirs, cache=cache) == idx
+        monkeypatch.undo()
+        # a new file in one directory triggers rescanning only that directory
+        tmpdir.join('ahn2', '25gn4.laz').write('')
+        assert '25gn4' in batch3dfier.pc_file_index(pc_dirs, cache=cache)
+
+
+class TestYaml():
+    def test_template(self):
+        template = batch3dfier.yaml_template('bag', 'localhost', 5432, 'bag3d',
+                                             'p{w}', 'bag_tiles', 'gid')
+        config = batch3dfier.render_yaml(template, bag_tile='t_1',
+                                         pc_path=['a.laz', 'b.laz'],
+                                         ahn_version={2, 3})
+        assert config == batch3dfier.yamlr('bag', 'localhost', 5432, 'bag3d',
+                                           'p{w}', 'bag_tiles', 't_1',
+                                           ['a.laz', 'b.laz'], 'gid', {2, 3})
+        assert "password=p{w} schemas=bag_tiles tables=t_1" in config
+        assert "use_LAS_classes: [1, 6]" in config
+        assert "- a.laz\n      - b.laz" in config
+
+    @pytest.mark.parametrize('mode', ['memfd', 'tmpfs', 'file'])
+    def test_config_file(self, mode, tmpdir):
+        with batch3dfier.config_file("a: 1\n", 't_1', str(tmpdir),
+                                     mode=mode) as (path, fds):
+            out = subprocess.run(" ".join(["cat", path]), shell=True,
+                                 stdout=subprocess.PIPE, pass_fds=fds)
+            assert out.stdout == b"a: 1\n"
+        if mode != 'memfd':
+            assert not tmpdir.join('t_1.yml').exists()
+
+
+def test_split_csv(tmpdir):
+    batch = tmpdir.join('t_1.batch')
+    batch.write("id,ground-0.00\n1,0.1\n2,0.2\n3,0.3\n")
+    out_paths = {'t_1': str(tmpdir.join('t_1.csv')),
+                 't_2': str(tmpdir.join('t_2.csv'))}
+    counts = batch3dfier.split_csv(str(batch), {'1': 't_1', '2': 't_2'},
+                                   out_paths, default='t_1')
+    assert counts == {'t_1': 2, 't_2': 1}
+    assert tmpdir.join('t_1.csv').read() == "id,ground-0.00\n1,0.1\n3,0.3\n"
+    assert tmpdir.join('t_2.csv').read() == "id,ground-0.00\n2,0.2\n"
+
+
+class TestFingerprint():
+    @pytest.fixture(scope='function')
+    def run(self, tmpdir, monkeypatch, fake_db):
+        """Run call_3dfier on one tile with a fake 3dfier"""
+        laz = tmpdir.join('c_25gn1.laz')
+        laz.write("")
+        calls = []
+        # the number of checked out connections while 3dfier runs
+        held = []
+        conn = fake_db([('d41d8cd98f00b204e9800998ecf8427e',)])
+
+        def run_subprocess(command, **kwargs):
+            calls.append(command)
+            held.append(conn.checked_out)
+            with open(command[-1], "w") as f_out:
+                f_out.write("id\n1\n")
+            return True
+        monkeypatch.setattr(batch3dfier.bag, 'run_subprocess', run_subprocess)
+
+        def call():
+            return batch3dfier.call_3dfier(
+                db=conn, tile='t_25gn1',
+                schema_tiles='bag_tiles', table_index_pc=None, fields_index_pc=None,
+                idx_identical=True, table_index_footprint=None,
+                fields_index_footprint=None, uniqueid='identificatie',
+                extent_ewkb=None, clip_prefix='_clip3dfy_',
+                prefix_tile_footprint='t_', yml_dir=str(tmpdir), tile_out=None,
+                output_format='CSV-BUILDINGS-MULTIPLE', output_dir=str(tmpdir),
+                path_3dfier='3dfier', thread='Thread_0',
+                pc_file_index={'25gn1': [str(laz)]}, tile_group='rest',
+                pc_tiles={'25gn1': 3}, yml_template='', fingerprint=True)
+        yield call, calls, laz, held
+
+    def test_reuse(self, run):
+        call, calls, laz, held = run
+        first = call()
+        assert first['tile_skipped'] is None
+        second = call()
+        assert len(calls) == 1
+        assert second['out_path'] == first['out_path']
+        assert second['stats']['reused']
+        assert second['stats']['footprint_count'] == 1
+
+    def test_changed_input(self, run):
+        call, calls, laz, held = run
+        call()
+        laz.write("changed")
+        call()
+        assert len(calls) == 2
+
+    def test_no_connection_held(self, run):
+        """The connection is checked out for the queries, not for 3dfier"""
+        call, calls, laz, held = run
+        assert call()['tile_skipped'] is None
+        assert held == [0]
+
+
+class TestDropViews():
+    def test_drop_all(self, monkeypatch, fake_conn):
+        """Every view is dropped, in chunks"""
+        monkeypatch.setattr(batch3dfier, 'DDL_CHUNK_SIZE', 2)
+        views = ["_clip3dfy_25gn1", "_clip3dfy_25gn2", "_clip3dfy_union"]
+        assert batch3dfier.drop_2Dtiles(fake_conn, 'public', views)
+        executed = fake_conn.conn.queries
+        assert len(executed) == 2
+
+        def identifiers(query):
+            if isinstance(query, sql.Composed):
+                return [i for q in query.seq for i in identifiers(q)]
+            if isinstance(query, sql.Identifier):
+                return [query.string]
+            return []
+        assert [i for q in executed for i in identifiers(q)] == \
+            ['public', views[0], 'public', views[1], 'public', views[2]]
+
+    def test_error(self, fake_connection):
+        """A database error is logged and reported as failure"""
+        def fail(query):
+            raise psycopg2.ProgrammingError("cannot drop view")
+        conn = db.db('batch3dfier_db', 'localhost', '5432', 'batch3dfier',
+                     conn=fake_connection(on_execute=fail))
+        assert not batch3dfier.drop_2Dtiles(conn, 'public', ["_clip3dfy_25gn1"])
+
+    def test_interrupt(self, fake_connection):
+        """An interrupt is not swallowed"""
+        def interrupt(query):
+            raise KeyboardInterrupt
+        conn = db.db('batch3dfier_db', 'localhost', '5432', 'batch3dfier',
+                     conn=fake_connection(on_execute=interrupt))
+        with pytest.raises(KeyboardInterrupt):
+            batch3dfier.drop_2Dtiles(conn, 'public', ["_clip3dfy_25gn1"])
@@ -2,6 +2,7 @@ import pytest
 import os
 
 import yaml
+import psycopg2
 import pykwalify.errors
 
 from bag3d.config import args
@@ -48,7 +49,7 @@ def invalid_config(request):
     request.addfinalizer(del_conf)
     return fname
 
-@pytest.fixture('module')
+@pytest.fixture(scope='module')
 def empty_db():
     yield {'dbname': "testdb", 'user': "batch3dfier", 'pw': None,
            'port': 5432, 'host': 'localhost'}
@@ -72,6 +73,12 @@ class TestArgs():
         with pytest.raises(FileNotFoundError):
             args.validate_config(config, schema)
 
+    def test_config_mode(self):
+        """The 3dfier configuration is a file unless asked otherwise"""
+        assert args.parse_console_args(['bag3d_config.yml'])['config_mode'] == 'file'
+        assert args.parse_console_args(
+            ['bag3d_config.yml', '--3dfier-config', 'memfd'])['config_mode'] == 'memfd'
+
 
 class TestDB():
     """Testing config.db"""
@@ -93,6 +100,107 @@ class TestDB():
             # invalid password
             db.db(dbname='batch3dfier_db', host='localhost', port=5432, user='batch3dfier', password='invalid')
 
+    def test_send_parallel(self, monkeypatch, fake_connection):
+        """The queries run on pooled connections"""
+        sent = []
+
+        class FakePool():
+            def __init__(self, minconn, maxconn, **kwargs):
+                self.maxconn = maxconn
+                self.closed = False
+
+            def getconn(self):
+                return fake_connection(on_execute=sent.append)
+
+            def putconn(self, c, close=False):
+                pass
+
+            def closeall(self):
+                self.closed = True
+
+        monkeypatch.setattr(db.pool, 'ThreadedConnectionPool', FakePool)
+        conn = db.db('batch3dfier_db', 'localhost', 5432, 'batch3dfier',
+                     conn=fake_connection())
+        conn.send_parallel(['a', 'b', 'c'], 2)
+        assert sorted(sent) == ['a', 'b', 'c']
+        assert conn.pool is None
+
+    def test_profiler(self, monkeypatch, fake_connection):
+        """The slow queries are explained after they ran, and rolled back"""
+        tables = set()
+
+        def on_execute(query):
+            """Fails like PostgreSQL on creating an existing table"""
+            explain = query.startswith("EXPLAIN")
+            for statement in db.split_statements(query):
+                words = statement.replace("EXPLAIN (ANALYZE, BUFFERS) ", "").split()
+                if words[:2] == ["CREATE", "TABLE"]:
+                    if words[2] in tables:
+                        raise psycopg2.ProgrammingError(
+                            'relation "%s" already exists' % words[2])
+                    if not explain:
+                        tables.add(words[2])
+                elif words[:2] == ["DROP", "TABLE"] and not explain:
+                    tables.discard(words[-1])
+
+        monkeypatch.setattr(db.db, 'profiler', None)
+        profiler = db.db.enable_profiling(threshold=-1.0, max_explain=10)
+        c = fake_connection(resultset=[("Seq Scan on pand",)], rowcount=1,
+                            on_execute=on_execute)
+        conn = db.db('batch3dfier_db', 'localhost', 5432, 'batch3dfier', conn=c)
+        for query in ["CREATE TABLE a AS SELECT 1;",
+                      "DROP TABLE a; CREATE TABLE a AS SELECT ';' FROM b WITH NO DATA;"
+                      " CREATE INDEX ON a (id);",
+                      "CREATE INDEX ON a (id);"]:
+            conn.sendQuery(query)
+        assert [q for q in c.queries if q.startswith("EXPLAIN")] == [
+            "EXPLAIN (ANALYZE, BUFFERS) SELECT 1",
+            "EXPLAIN (ANALYZE, BUFFERS) SELECT ';' FROM b"]
+        assert c.rolled_back == 2
+        site, = profiler.summary().values()
+        assert site['count'] == 3
+        assert site['explained'] == 3
+        assert sum(site['histogram']) == 3
+        c.autocommit = True
+        assert conn.explain("SELECT 1") is None
+
+    def test_explain_after_vacuum(self, fake_connection):
+        """VACUUM leaves the connection in its previous mode"""
+        c = fake_connection(resultset=[("Seq Scan on pand",)])
+        conn = db.db('batch3dfier_db', 'localhost', 5432, 'batch3dfier', conn=c)
+        conn.vacuum('public', 'pand')
+        assert not c.autocommit
+        assert conn.explain("SELECT 1") == [
+            {'statement': "SELECT 1", 'plan': ["Seq Scan on pand"]}]
+
+    def test_explain(self, batch3dfier_db):
+        """The query of a CREATE TABLE AS is explained after the table is created"""
+        query = """
+        DROP TABLE IF EXISTS public.test_explain;
+        CREATE TABLE public.test_explain AS SELECT generate_series(1, 10) AS i;
+        """
+        try:
+            batch3dfier_db.sendQuery(query)
+            plans = batch3dfier_db.explain(query)
+            assert len(plans) == 1
+            assert plans[0]['statement'].startswith("CREATE TABLE")
+            assert plans[0]['plan']
+        finally:
+            batch3dfier_db.sendQuery("DROP TABLE IF EXISTS public.test_explain;")
+
+    def test_vacuum_explain(self, batch3dfier_db):
+        """The queries can be explained after a VACUUM"""
+        batch3dfier_db.sendQuery("""
+        DROP TABLE IF EXISTS public.test_vacuum;
+        CREATE TABLE public.test_vacuum AS SELECT generate_series(1, 10) AS i;
+        """)
+        try:
+            batch3dfier_db.vacuum('public', 'test_vacuum')
+            assert not batch3dfier_db.conn.autocommit
+            assert batch3dfier_db.explain("SELECT * FROM public.test_vacuum;")
+        finally:
+            batch3dfier_db.sendQuery("DROP TABLE IF EXISTS public.test_vacuum;")
+
 #     def test_create_empty(self, empty_db):
 #         dbname=empty_db['dbname']
 #         user=empty_db['user']
@@ -110,4 +218,19 @@ class TestDB():
 #             raise
     
     
-        
\ No newline at end of file
+        
+    def test_statement_batch(self, fake_db):
+        """The statements are sent in transactions of chunk_size statements"""
+        conn = fake_db()
+        batch = db.StatementBatch(conn, chunk_size=2)
+        for t in "abcde":
+            batch.add("DROP VIEW %s" % t)
+        assert len(batch) == 5
+        assert batch.send() == 3
+        assert [q.as_string(None) for q in conn.queries] == ["DROP VIEW a;\nDROP VIEW b;",
+                             "DROP VIEW c;\nDROP VIEW d;", "DROP VIEW e;"]
+        assert len(batch) == 0
+        batch.chunk_size = None
+        batch.add("DROP VIEW a")
+        batch.add("DROP VIEW b")
+        assert batch.send() == 1
@@ -4,17 +4,17 @@ import yaml
 from bag3d.config import footprints
 
 
-@pytest.fixture('module')
+@pytest.fixture(scope='module')
 def tile_index(config):
     with open(config, 'r', encoding='utf-8') as f_in:
         j = yaml.load(f_in)
     return j["tile_index"]
 
-@pytest.fixture('module')
+@pytest.fixture(scope='module')
 def bag_index(tile_index):
     return [tile_index["polygons"]["schema"], tile_index["polygons"]["table"]]
 
-@pytest.fixture('module')
+@pytest.fixture(scope='module')
 def bag_fields(tile_index):
     return [tile_index['polygons']["fields"]["primary_key"], 
             tile_index['polygons']["fields"]["geometry"], 
@@ -77,3 +77,48 @@ def test_partition(batch3dfier_db, bag_index, bag_fields):
         table_footprint=table_footprint,
         fields_footprint=fields_footprint,
         prefix_tiles=prefix_tiles) is None
+
+def test_tile_assignment(batch3dfier_db, bag_index, bag_fields):
+    """The views on the tile assignment select the same footprints as the
+    views with the spatial join"""
+    table_footprint = ['bag', 'pand']
+    table_centroid = ['bag', 'test_pand_centroid']
+    table_assignment = ['bag', 'test_pand_tile']
+    fields_footprint = ['gid', 'geom']
+    fields_centroid = ['gid', 'geom']
+    schemas = {'test_tiles_join': None, 'test_tiles_asg': table_assignment}
+    try:
+        footprints.update_tile_index(batch3dfier_db, bag_index, bag_fields)
+        footprints.create_centroids(batch3dfier_db, table_centroid,
+                                    table_footprint, fields_footprint)
+        footprints.create_tile_assignment(batch3dfier_db, table_assignment,
+                                          bag_index, bag_fields,
+                                          table_centroid, fields_centroid)
+        # running it again replaces the content
+        footprints.create_tile_assignment(batch3dfier_db, table_assignment,
+                                          bag_index, bag_fields,
+                                          table_centroid, fields_centroid)
+        for schema, asg in schemas.items():
+            footprints.create_views(batch3dfier_db, schema, bag_index,
+                                    bag_fields, table_centroid,
+                                    fields_centroid, table_footprint,
+                                    fields_footprint, prefix_tiles='t_',
+                                    table_assignment=asg)
+        views = batch3dfier_db.getQuery("""
+            SELECT table_name FROM information_schema.views
+            WHERE table_schema = 'test_tiles_asg';""")
+        assert len(views) > 0
+        total = 0
+        for view, in views:
+            query = "SELECT array_agg(gid ORDER BY gid) FROM %s.%s;"
+            footprints_join = batch3dfier_db.getQuery(query % ('test_tiles_join', view))
+            footprints_asg = batch3dfier_db.getQuery(query % ('test_tiles_asg', view))
+            assert footprints_asg == footprints_join
+            total += len(footprints_asg[0][0] or [])
+        res = batch3dfier_db.getQuery("SELECT count(*) FROM bag.test_pand_tile;")
+        assert res[0][0] == total
+    finally:
+        for schema in schemas:
+            batch3dfier_db.sendQuery("DROP SCHEMA IF EXISTS %s CASCADE;" % schema)
+        batch3dfier_db.sendQuery("DROP TABLE IF EXISTS bag.test_pand_tile CASCADE;")
+        batch3dfier_db.sendQuery("DROP TABLE IF EXISTS bag.test_pand_centroid CASCADE;")
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+"""Testing batch3dfier.history"""
+
+import pytest
+
+from bag3d.batch3dfier import history
+
+
+@pytest.fixture(scope='function')
+def tile_history(tmpdir):
+    h = history.TileHistory(str(tmpdir.join('history.sqlite')))
+    yield h
+    h.close()
+
+
+class TestTileHistory():
+    def test_runtimes(self, tile_history):
+        tile_history.record('rest', 't_1', {'wall_time': 10.0, 'returncode': 0})
+        tile_history.record('rest', 't_1', {'wall_time': 20.0, 'returncode': 0})
+        tile_history.record('rest', 't_2', {'wall_time': 5.0, 'returncode': 1})
+        tile_history.record('border_ahn2', 't_3', {'wall_time': 5.0, 'returncode': 0})
+        assert tile_history.runtimes('rest') == {'t_1': 15.0}
+
+    def test_memory_use(self, tile_history):
+        tile_history.record('rest', 't_1', {'pc_size': 100, 'peak_rss': 1000,
+                                            'read_bytes': 10, 'returncode': 0})
+        tile_history.record('rest', 't_2', {'pc_size': 100, 'peak_rss': 2000,
+                                            'returncode': 1})
+        assert tile_history.memory_use() == [(100, 1000)]
+
+
+class TestProgressReporter():
+    def test_eta(self):
+        p = history.ProgressReporter(['a', 'b', 'c', 'd'],
+                                     {'a': 40.0, 'b': 20.0, 'c': None, 'd': None}, 2)
+        assert p.eta() == (40 + 20 + 30 + 30) / 2
+        p.done('a', 60.0)
+        # the unknown tiles count with the mean runtime of the finished tiles
+        assert p.eta() == (20 + 60 + 60) / 2
+
+    def test_eta_unknown(self):
+        p = history.ProgressReporter(['a'], {'a': None}, 2)
+        assert p.eta() is None
+
@@ -1,3 +1,124 @@
 # -*- coding: utf-8 -*-
 
-"""Module description"""
\ No newline at end of file
+"""Testing importer"""
+
+import io
+
+import psycopg2
+
+from bag3d import importer
+from bag3d.config import db
+
+
+class TestHeightsCSV():
+    def csv(self):
+        return io.StringIO("id,ground-0.00\n" +
+                           "1," + ",".join(["0.1"] * 21) + ",\n" +
+                           "2," + ",".join(["-99.99"] * 21) + ",\n")
+
+    def test_rows(self):
+        stream = importer.HeightsCSV(self.csv(), "2019-01-01T00:00:00", 3, "37fz2")
+        lines = stream.read().splitlines()
+        assert len(lines) == 2
+        fields = lines[0].split(",")
+        assert len(fields) == 25
+        assert fields[0] == "1"
+        assert fields[-3:] == ["2019-01-01T00:00:00", "3", "37fz2"]
+        assert stream.read() == ""
+
+    def test_chunks(self):
+        expected = importer.HeightsCSV(self.csv(), -99.99, -99.99, "t").read()
+        stream = importer.HeightsCSV(self.csv(), -99.99, -99.99, "t")
+        chunks = []
+        chunk = stream.read(7)
+        while chunk:
+            assert len(chunk) <= 7
+            chunks.append(chunk)
+            chunk = stream.read(7)
+        assert "".join(chunks) == expected
+
+
+class TestCopyCSV():
+    def test_retry(self, tmpdir, fake_connection):
+        """The first COPY fails, the second is committed"""
+        path = tmpdir.join('t_1.csv')
+        path.write("id\n1\n2\n")
+
+        def on_copy(query, data):
+            if fake.copy_attempts == 1:
+                raise psycopg2.OperationalError("connection lost")
+        fake = fake_connection(on_copy=on_copy)
+        conn = db.db('batch3dfier_db', 'localhost', '5432', 'batch3dfier',
+                     conn=fake)
+        assert importer.copy_csv(conn, "COPY", str(path), -99.99, -99.99, 't_1')
+        assert fake.copy_attempts == 2
+        assert fake.copied == ["1,-99.99,-99.99,t_1", "2,-99.99,-99.99,t_1"]
+
+    def test_replace(self, tmpdir, fake_conn):
+        """The rows of the tile are deleted in the transaction of the COPY"""
+        path = tmpdir.join('t_1.csv')
+        path.write("id\n1\n")
+        assert importer.copy_csv(fake_conn, "COPY", str(path), -99.99, -99.99,
+                                 't_1', delete_q="DELETE")
+        assert fake_conn.conn.queries == ["DELETE"]
+        assert fake_conn.conn.copied == ["1,-99.99,-99.99,t_1"]
+
+    def test_fail(self, tmpdir, fake_conn):
+        assert not importer.copy_csv(fake_conn, "COPY", str(tmpdir.join('nope.csv')),
+                                     -99.99, -99.99, 't_1', retries=0)
+
+
+def test_cap_import_threads():
+    assert importer.cap_import_threads(32, 32, 97) == 32
+    assert importer.cap_import_threads(32, 32, 90) == 26
+    assert importer.cap_import_threads(32, 32, 60) == 1
+
+
+def test_shared_workers(tmpdir, monkeypatch, fake_connection):
+    """The tile groups are imported over the connections of one pool"""
+    pools = []
+
+    class FakePool():
+        def __init__(self, minconn, maxconn, **kwargs):
+            self.maxconn = maxconn
+            pools.append(self)
+
+        def getconn(self):
+            return fake_connection()
+
+        def putconn(self, c, close=False):
+            pass
+
+        def closeall(self):
+            pass
+
+    monkeypatch.setattr(db.pool, 'ThreadedConnectionPool', FakePool)
+    monkeypatch.setattr(importer, 'create_heights_table', lambda *args, **kwargs: True)
+    monkeypatch.setattr(importer, 'get_ahn_attributes', lambda conn, cfg: {})
+    conn = db.db('batch3dfier_db', 'localhost', '5432', 'batch3dfier',
+                 conn=fake_connection())
+    monkeypatch.setattr(conn, 'sendQuery', lambda query: None)
+    workers = importer.ImportWorkers(conn, 2)
+    imported = []
+    streaming = []
+    for group in ['rest', 'border_ahn2']:
+        cfg = {'output': {'staging': {'schema': 'bag3d', 'heights_table': group}},
+               'config': {'threads': 4, 'import_threads': 4},
+               'input_polygons': {'tile_prefix': 't_'}}
+        streaming.append(importer.StreamingImporter(conn, cfg, workers=workers))
+        path = tmpdir.join(group + '.csv')
+        path.write("id\n1\n")
+        streaming[-1].submit(str(path), on_imported=lambda g=group: imported.append(g))
+    assert [s.finish() for s in streaming] == [1, 1]
+    workers.close()
+    assert sorted(imported) == ['border_ahn2', 'rest']
+    assert [p.maxconn for p in pools] == [2]
+
+
+def test_get_ahn_attributes(fake_db):
+    cfg = {'tile_index': {'elevation': {'schema': 'tile_index',
+                                        'table': 'ahn_index',
+                                        'fields': {'unit_name': 'bladnr'}}}}
+    assert importer.get_ahn_attributes(
+        fake_db([('37fz2', 'date', 3), ('37fz1', None, 2)]), cfg) == {
+        '37fz2': ('date', 3), '37fz1': (None, 2)}
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+"""Testing update.incremental"""
+
+import pytest
+
+from bag3d.update import incremental
+
+
+def test_filter_tiles():
+    tiles = ['25gn1', '25gn2', 't_25gn3', 't_25gn4']
+    affected = {'25gn2', '25gn3'}
+    assert incremental.filter_tiles(tiles, affected, prefix='t_') == ['25gn2', 't_25gn3']
+    assert incremental.filter_tiles(tiles, set(), prefix='t_') == []
+
+
+SCHEMA = "test_incremental"
+
+
+def box(x):
+    """A 2x2 square at x, in one of the 10x10 tiles t1 (0-10), t2 (10-20), t3 (20-30)"""
+    return "st_makeenvelope(%s, 4, %s, 6, 28992)" % (x, x + 2)
+
+
+@pytest.fixture(scope='function')
+def cfg():
+    yield {'output': {'staging': {'schema': SCHEMA, 'bag3d_table': 'pand3d_staging'},
+                      'production': {'schema': SCHEMA, 'bag3d_table': 'pand3d'}},
+           'input_polygons': {'footprints': {'schema': SCHEMA, 'table': 'pand',
+                                             'fields': {'uniqueid': 'identificatie'}}},
+           'tile_index': {'polygons': {'schema': SCHEMA, 'table': 'tiles',
+                                       'fields': {'geometry': 'geom',
+                                                  'unit_name': 'unit'}}}}
+
+
+@pytest.fixture(scope='function')
+def inc_db(batch3dfier_db, cfg):
+    """The footprints a, b in tile t1, c in t2 and e in t3 are in production,
+    and the state is up to date"""
+    conn = batch3dfier_db
+    conn.sendQuery("""
+    DROP SCHEMA IF EXISTS {s} CASCADE;
+    CREATE SCHEMA {s};
+    CREATE TABLE {s}.tiles (gid serial, unit varchar, geom geometry(Polygon, 28992));
+    INSERT INTO {s}.tiles (unit, geom) VALUES
+        ('t1', st_makeenvelope(0, 0, 10, 10, 28992)),
+        ('t2', st_makeenvelope(10, 0, 20, 10, 28992)),
+        ('t3', st_makeenvelope(20, 0, 30, 10, 28992));
+    CREATE TABLE {s}.pand (gid serial, identificatie varchar,
+                           geovlak geometry(Polygon, 28992),
+                           begindatumtijdvakgeldigheid timestamp);
+    INSERT INTO {s}.pand (identificatie, geovlak, begindatumtijdvakgeldigheid) VALUES
+        ('a', {a}, '2019-01-01'),
+        ('b', {b}, '2019-01-01'),
+        ('c', {c}, '2019-01-01'),
+        ('e', {e}, '2019-01-01');
+    CREATE TABLE {s}.pand3d (gid serial, identificatie varchar, tile_id text,
+                             height real);
+    CREATE TABLE {s}.pand3d_staging (gid int, identificatie varchar, tile_id text,
+                                     height real);
+    INSERT INTO {s}.pand3d_staging (gid, identificatie, tile_id, height) VALUES
+        (1, 'a', 't1', 1), (2, 'b', 't1', 1), (3, 'c', 't2', 1), (4, 'e', 't3', 1);
+    """.format(s=SCHEMA, a=box(1), b=box(5), c=box(15), e=box(25)))
+    incremental.create_state_table(conn, cfg)
+    incremental.find_changes(conn, cfg)
+    incremental.upsert(conn, cfg)
+    incremental.update_state(conn, cfg)
+    # the next run: b moved to t2, c deleted, d new in t1
+    conn.sendQuery("""
+    UPDATE {s}.pand SET geovlak = {b} WHERE identificatie = 'b';
+    DELETE FROM {s}.pand WHERE identificatie = 'c';
+    INSERT INTO {s}.pand (identificatie, geovlak, begindatumtijdvakgeldigheid)
+        VALUES ('d', {d}, '2020-01-01');
+    """.format(s=SCHEMA, b=box(12), d=box(7)))
+    yield conn
+    conn.sendQuery("DROP SCHEMA IF EXISTS %s CASCADE;" % SCHEMA)
+
+
+def production(conn):
+    return conn.getQuery("""
+    SELECT identificatie, tile_id, height FROM %s.pand3d
+    ORDER BY identificatie;""" % SCHEMA)
+
+
+class TestIncremental():
+    def test_first_run(self, inc_db, cfg):
+        """Every footprint is new in an empty state"""
+        assert production(inc_db) == [('a', 't1', 1), ('b', 't1', 1),
+                                      ('c', 't2', 1), ('e', 't3', 1)]
+        state = inc_db.getQuery(
+            "SELECT identificatie, tile_id FROM %s.bag3d_state ORDER BY 1;" % SCHEMA)
+        assert state == [('a', 't1'), ('b', 't1'), ('c', 't2'), ('e', 't3')]
+
+    def test_find_changes(self, inc_db, cfg):
+        assert incremental.find_changes(inc_db, cfg) == {
+            'new': 1, 'changed': 1, 'deleted': 1}
+        changes = inc_db.getQuery("""
+        SELECT identificatie, change, tile_id FROM %s.bag3d_changes
+        ORDER BY 1;""" % SCHEMA)
+        assert changes == [('b', 'changed', 't1'), ('c', 'deleted', 't2'),
+                           ('d', 'new', None)]
+
+    def test_affected_tiles(self, inc_db, cfg):
+        """The new and current tiles of the changes, and the tiles they were in"""
+        incremental.find_changes(inc_db, cfg)
+        assert incremental.affected_tiles(inc_db, cfg) == {'t1', 't2'}
+
+    def test_upsert(self, inc_db, cfg):
+        """The changed footprints are replaced, the deleted ones removed,
+        the rest is kept"""
+        incremental.find_changes(inc_db, cfg)
+        inc_db.sendQuery("""
+        TRUNCATE {s}.pand3d_staging;
+        INSERT INTO {s}.pand3d_staging (identificatie, tile_id, height) VALUES
+            ('a', 't1', 2), ('b', 't2', 2), ('d', 't1', 2);
+        -- a new footprint that is in production already, eg. from a run that
+        -- failed before updating the state
+        INSERT INTO {s}.pand3d (identificatie, tile_id, height) VALUES ('d', 't1', 1);
+        """.format(s=SCHEMA))
+        incremental.upsert(inc_db, cfg)
+        assert production(inc_db) == [('a', 't1', 1), ('b', 't2', 2),
+                                      ('d', 't1', 2), ('e', 't3', 1)]
+        gids = inc_db.getQuery("SELECT gid FROM %s.pand3d;" % SCHEMA)
+        assert len(set(gids)) == 4
+
+    def test_update_state(self, inc_db, cfg):
+        """After the update there are no changes, except the footprints that
+        are not in production"""
+        incremental.find_changes(inc_db, cfg)
+        inc_db.sendQuery("""
+        TRUNCATE {s}.pand3d_staging;
+        INSERT INTO {s}.pand3d_staging (identificatie, tile_id, height) VALUES
+            ('a', 't1', 2), ('b', 't2', 2);
+        """.format(s=SCHEMA))
+        incremental.upsert(inc_db, cfg)
+        incremental.update_state(inc_db, cfg)
+        state = inc_db.getQuery(
+            "SELECT identificatie, tile_id FROM %s.bag3d_state ORDER BY 1;" % SCHEMA)
+        assert state == [('a', 't1'), ('b', 't2'), ('e', 't3')]
+        # d failed, it is processed again in the next run
+        assert incremental.find_changes(inc_db, cfg) == {'new': 1}
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""Testing the run manifest"""
+
+import pytest
+
+from bag3d.manifest import RunManifest
+from bag3d.report import RunReport
+
+
+class TestRunManifest():
+    def test_resume(self, tmpdir):
+        path = str(tmpdir.join('manifest.json'))
+        out = tmpdir.join('t_1.csv')
+        out.write("")
+        m = RunManifest(path)
+        m.stage_done('update_bag')
+        m.tile_done('rest', 't_1', str(out))
+        m.tile_done('rest', 't_2', str(tmpdir.join('t_2.csv')))
+
+        m = RunManifest(path, resume=True)
+        assert m.is_done('update_bag')
+        assert not m.is_done('run_3dfier')
+        # the output of t_2 does not exist
+        assert m.done_tiles('rest') == {'t_1': str(out)}
+        assert m.done_tiles('border_ahn2') == {}
+
+    def test_new_run(self, tmpdir):
+        path = str(tmpdir.join('manifest.json'))
+        RunManifest(path).stage_done('update_bag')
+        assert not RunManifest(path).is_done('update_bag')
+
+    def test_unreadable(self, tmpdir):
+        path = tmpdir.join('manifest.json')
+        path.write("{")
+        assert not RunManifest(str(path), resume=True).is_done('update_bag')
+
+    def test_imported(self, tmpdir):
+        """The imported tiles are not done again after their output was removed"""
+        path = str(tmpdir.join('manifest.json'))
+        out = tmpdir.join('t_1.csv')
+        out.write("")
+        m = RunManifest(path)
+        m.tile_done('rest', 't_1', str(out))
+        m.tile_imported('rest', 't_1')
+        out.remove()
+
+        m = RunManifest(path, resume=True)
+        assert m.imported_tiles('rest') == {'t_1'}
+        assert m.done_tiles('rest') == {}
+        assert m.imported_tiles('border_ahn2') == set()
+
+    def test_stage(self, tmpdir):
+        path = str(tmpdir.join('manifest.json'))
+        report = RunReport(str(tmpdir.join('report.json')))
+        m = RunManifest(path)
+        with m.stage('update_bag', report):
+            pass
+        with pytest.raises(RuntimeError):
+            with m.stage('update_ahn', report):
+                raise RuntimeError
+        assert not m.todo('update_bag')
+        assert m.todo('update_ahn')
+        assert [(s['name'], s['status']) for s in report.content['stages']] == \
+            [('update_bag', 'ok'), ('update_ahn', 'failed')]
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""Testing batch3dfier.process"""
+
+import json
+import threading
+import time
+
+import pytest
+
+from bag3d.batch3dfier import process
+from bag3d.config import batch3dfier
+from bag3d.config import db
+
+
+@pytest.fixture(scope='function')
+def conn(fake_conn):
+    """A db instance without a database, there is no pool, thus checkout() yields itself"""
+    fake_conn.create_pool = lambda minconn, maxconn: None
+    yield fake_conn
+
+
+@pytest.fixture(scope='function')
+def cfg(tmpdir):
+    yield {'config': {'in': str(tmpdir.join('cfg_rest', 'bag3d_cfg_rest.yml')),
+                      'threads': 3, 'retry_backoff': 0},
+           'input_polygons': {'tile_list': ['t_%s' % i for i in range(10)],
+                              'user_schema': 'bag_tiles',
+                              'tile_prefix': 't_',
+                              'footprints': {'fields': {'uniqueid': 'identificatie'}}},
+           'input_elevation': {'dataset_dir': [str(tmpdir)],
+                               'dataset_name': ['c_{tile}.laz']},
+           'tile_index': {'elevation': {'fields': {}},
+                          'polygons': {'fields': {}},
+                          'identical': True},
+           'extent_ewkb': None,
+           'clip_prefix': '_clip3dfy_',
+           'tile_out': None,
+           'output': {'staging': {'dir': str(tmpdir)}},
+           'path_3dfier': '3dfier'}
+
+
+@pytest.fixture(scope='function')
+def fake_3dfier(monkeypatch):
+    """Replace call_3dfier with a function that records the concurrency"""
+    state = {'running': 0, 'max_running': 0, 'lock': threading.Lock(),
+             'batches': [], 'calls': {}}
+
+    def call_3dfier(db, tile, **kwargs):
+        assert db is not None
+        if isinstance(tile, list):
+            state['batches'].append(tile)
+            return [{'tile_skipped': None, 'out_path': t + '.csv'} for t in tile]
+        if not tile.endswith('3') and kwargs.get('on_start'):
+            # 3dfier starts, unless the point cloud is missing
+            kwargs['on_start']()
+        with state['lock']:
+            state['calls'][tile] = state['calls'].get(tile, 0) + 1
+            state['running'] += 1
+            state['max_running'] = max(state['max_running'], state['running'])
+        time.sleep(0.01)
+        with state['lock']:
+            state['running'] -= 1
+        if tile.endswith('3'):
+            return {'tile_skipped': tile, 'out_path': None,
+                    'stats': {'missing_input': True}}
+        elif tile.endswith('5'):
+            raise RuntimeError("3dfier crashed")
+        elif tile.endswith('7') and state['calls'][tile] == 1:
+            return {'tile_skipped': tile, 'out_path': None,
+                    'stats': {'returncode': -9}}
+        return {'tile_skipped': None, 'out_path': tile + '.csv'}
+
+    monkeypatch.setattr(batch3dfier, 'call_3dfier', call_3dfier)
+    monkeypatch.setattr(batch3dfier, 'pc_file_index', lambda pc_name_map, cache=None: {})
+    monkeypatch.setattr(batch3dfier, 'find_pc_tiles_all',
+                        lambda conn, tiles_footprint, **kwargs: {
+                            t: {'ahn_%s' % (int(t[2:]) // 2): 3}
+                            for t in tiles_footprint})
+    yield state
+
+
+class TestRun():
+    def test_failed_tiles(self, conn, cfg, fake_3dfier):
+        res = process.run(conn, cfg)
+        assert res == {'t_3', 't_5'}
+
+    def test_retries(self, conn, cfg, fake_3dfier):
+        cfg['config']['retries'] = 2
+        process.run(conn, cfg)
+        # missing input is not retried, the crash and the OOM are
+        assert fake_3dfier['calls']['t_3'] == 1
+        assert fake_3dfier['calls']['t_5'] == 3
+        assert fake_3dfier['calls']['t_7'] == 2
+        assert fake_3dfier['calls']['t_1'] == 1
+
+    def test_bounded_workers(self, conn, cfg, fake_3dfier):
+        process.run(conn, cfg)
+        assert 0 < fake_3dfier['max_running'] <= cfg['config']['threads']
+
+    def test_empty_tile_list(self, conn, cfg, fake_3dfier):
+        cfg['input_polygons']['tile_list'] = None
+        assert process.run(conn, cfg) is None
+
+    def test_batches(self, conn, cfg, fake_3dfier):
+        cfg['config']['batch_size'] = 2
+        cfg['config']['tile_order'] = 'none'
+        res = process.run(conn, cfg)
+        assert res == set()
+        assert sorted(sorted(b) for b in fake_3dfier['batches']) == \
+            [['t_%s' % i, 't_%s' % (i + 1)] for i in range(0, 10, 2)]
+
+    def test_on_tile_done(self, conn, cfg, fake_3dfier):
+        done = []
+        process.run(conn, cfg, on_tile_done=lambda tile, path: done.append((tile, path)))
+        assert sorted(done) == [('t_%s' % i, 't_%s.csv' % i) for i in range(10)
+                                if i not in (3, 5)]
+
+    def test_run_groups(self, conn, cfg, fake_3dfier, tmpdir):
+        border = dict(cfg)
+        border['config'] = {'in': str(tmpdir.join('cfg_ahn2', 'bag3d_cfg_border_ahn2.yml')),
+                            'threads': 3}
+        border['input_polygons'] = dict(cfg['input_polygons'],
+                                        tile_list=['t_11', 't_13'])
+        done = {'rest': [], 'border': []}
+        res = process.run_groups(
+            conn, [cfg, border],
+            on_tile_done=[lambda tile, path: done['rest'].append(tile),
+                          lambda tile, path: done['border'].append(tile)])
+        assert res == [{'t_3', 't_5'}, {'t_13'}]
+        assert sorted(done['border']) == ['t_11']
+        assert len(done['rest']) == 8
+        assert 0 < fake_3dfier['max_running'] <= cfg['config']['threads']
+
+    def test_status_file(self, conn, cfg, fake_3dfier, tmpdir):
+        cfg['config']['status_file'] = str(tmpdir.join('status.json'))
+        process.run(conn, cfg)
+        with open(cfg['config']['status_file']) as f_in:
+            res = json.load(f_in)
+        assert (res['queued'], res['running'], res['done'], res['failed']) == (0, 0, 8, 2)
+
+    def test_running_after_admit(self, conn, cfg, fake_3dfier, monkeypatch, tmpdir):
+        """A tile is running only after the memory gate admitted it"""
+        path = str(tmpdir.join('status.json'))
+        cfg['config']['status_file'] = path
+        cfg['config']['threads'] = 1
+        cfg['input_polygons']['tile_list'] = ['t_0', 't_1']
+        seen = []
+
+        def running():
+            with open(path) as f_in:
+                return json.load(f_in)['running']
+
+        def call_3dfier(db, tile, on_start=None, **kwargs):
+            # waiting for the memory gate
+            seen.append(running())
+            on_start()
+            seen.append(running())
+            return {'tile_skipped': None, 'out_path': tile + '.csv'}
+
+        monkeypatch.setattr(batch3dfier, 'call_3dfier', call_3dfier)
+        process.run(conn, cfg)
+        assert seen == [0, 1, 0, 1]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+"""Testing the run report"""
+
+import json
+
+import pytest
+
+from bag3d import report
+
+
+class TestRunReport():
+    def test_stages(self, tmpdir):
+        path = str(tmpdir.join('report.json'))
+        r = report.RunReport(path, args={'run_3dfier': True})
+        r.start('run_3dfier')
+        with r.stage('run_3dfier.import'):
+            report.record_db(2.0, rows=10)
+            report.record_subprocess(1.0)
+        with pytest.raises(RuntimeError):
+            with r.stage('run_3dfier.union'):
+                raise RuntimeError
+        r.close()
+        with open(path) as f_in:
+            res = json.load(f_in)
+        stages = {s['name']: s for s in res['stages']}
+        assert stages['run_3dfier.import']['status'] == 'ok'
+        assert stages['run_3dfier.import']['db_time'] == pytest.approx(2.0)
+        assert stages['run_3dfier.import']['rows'] == 10
+        assert stages['run_3dfier.import']['subprocesses'] == 1
+        assert stages['run_3dfier.union']['status'] == 'failed'
+        # the unfinished stage is closed as failed, including its sub-stages
+        assert stages['run_3dfier']['status'] == 'failed'
+        assert stages['run_3dfier']['rows'] == 10
+        assert res['finished'] is not None
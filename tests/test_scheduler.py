@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""Testing batch3dfier.scheduler"""
+
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from bag3d.batch3dfier import scheduler
+
+
+@pytest.fixture(scope='function')
+def gate():
+    yield scheduler.MemoryGate(reserve=0, budget=1000, ratio=10.0, poll=0.01)
+
+
+class TestMemoryGate():
+    def test_predict_default_ratio(self, gate):
+        assert gate.predict(50) == 500
+
+    def test_predict_similar_tiles(self, gate):
+        gate.observe(10, 50)
+        gate.observe(100, 2000)
+        # the closest observations in size dominate the prediction
+        gate.nr_similar = 1
+        assert gate.predict(12) == 60
+        assert gate.predict(90) == 1800
+
+    def test_observe_ignores_missing(self, gate):
+        gate.observe(10, None)
+        gate.observe(0, 100)
+        assert len(gate.observations) == 0
+
+    def test_admit_over_budget(self, gate):
+        started = threading.Event()
+
+        def run_b():
+            with gate.admit('b', 60):
+                started.set()
+
+        with gate.admit('a', 60):
+            assert gate.committed == 600
+            t = threading.Thread(target=run_b)
+            t.start()
+            # 'b' does not fit while 'a' is running
+            assert not started.wait(0.1)
+        t.join(1)
+        assert started.is_set()
+
+    def test_admit_single_large_tile(self, gate):
+        # a tile is always admitted if nothing else is running
+        with gate.admit('a', 1000) as predicted:
+            assert predicted > gate.budget
+        assert gate.running == 0
+        assert gate.committed == 0
+
+    def test_budget_follows_memory(self, monkeypatch):
+        """Without a fixed budget, the available memory is checked every time"""
+        memory = {'available': 5000}
+        child = SimpleNamespace(memory_info=lambda: SimpleNamespace(rss=1000))
+        monkeypatch.setattr(scheduler.psutil, 'virtual_memory',
+                            lambda: SimpleNamespace(available=memory['available']))
+        monkeypatch.setattr(scheduler.psutil, 'Process',
+                            lambda: SimpleNamespace(children=lambda recursive: [child]))
+        gate = scheduler.MemoryGate(reserve=100, ratio=10.0)
+        # the running child uses 1000 of the budget of 5000 + 1000 - 100
+        assert gate.current_budget() == 5900
+        gate.running = 1
+        gate.committed = 1000
+        assert gate.fits(4000)
+        # the machine got busy
+        memory['available'] = 2000
+        assert gate.current_budget() == 2900
+        assert not gate.fits(4000)
+
+
+class TestOrderTiles():
+    def test_lpt_sizes(self):
+        sizes = {'a': 10, 'b': 30, 'c': 20}
+        assert scheduler.order_tiles(['a', 'b', 'c', 'd'], sizes) == ['b', 'c', 'a', 'd']
+
+    def test_lpt_runtimes(self):
+        sizes = {'a': 10, 'b': 30, 'c': 20}
+        # 'a' was slow in the previous run, 'c' is estimated as 20 * 160 / 40 s
+        runtimes = {'a': 100, 'b': 60}
+        assert scheduler.order_tiles(['a', 'b', 'c'], sizes, runtimes) == ['a', 'c', 'b']
+
+    def test_none(self):
+        assert scheduler.order_tiles(['a', 'b'], {'b': 1}, strategy='none') == ['a', 'b']
+
+    def test_unknown_strategy(self):
+        with pytest.raises(ValueError):
+            scheduler.order_tiles(['a'], {}, strategy='fifo')
+
+
+class TestBatchTiles():
+    def test_shared(self):
+        pc_tiles = {'a': {'p1': 3, 'p2': 3}, 'b': {'p3': 3},
+                    'c': {'p2': 3, 'p1': 3}, 'd': {'p2': 3}, 'e': {}}
+        batches = scheduler.batch_tiles(['a', 'b', 'c', 'd', 'e'], pc_tiles, 2)
+        assert batches == [['a', 'c'], ['b'], ['d'], ['e']]
+
+    def test_versions(self):
+        pc_tiles = {'a': {'p1': 2}, 'b': {'p1': 3}}
+        assert scheduler.batch_tiles(['a', 'b'], pc_tiles, 5) == [['a'], ['b']]
+
+    def test_no_batching(self):
+        assert scheduler.batch_tiles(['a', 'b'], {}, 1) == [['a'], ['b']]
+
+
+class TestRetry():
+    def test_classify_failure(self):
+        assert scheduler.classify_failure({'missing_input': True}) == scheduler.MISSING_INPUT
+        assert scheduler.classify_failure({'returncode': -9}) == scheduler.OOM
+        assert scheduler.classify_failure(
+            {'returncode': 1, 'stderr': "terminate called after throwing an instance of 'std::bad_alloc'"}) == scheduler.OOM
+        assert scheduler.classify_failure(
+            {'returncode': 1, 'stderr': "ERROR: cannot open /data/c_25gn1.laz"}) == scheduler.MISSING_INPUT
+        assert scheduler.classify_failure({'returncode': -11}) == scheduler.CRASH
+
+    def test_policy(self):
+        policy = scheduler.RetryPolicy(retries=2, backoff=10)
+        failures = {'a': scheduler.CRASH, 'b': scheduler.MISSING_INPUT,
+                    'c': scheduler.OOM}
+        assert sorted(policy.retryable(failures, 1)) == ['a', 'c']
+        assert policy.retryable(failures, 3) == []
+        assert policy.delay(2) == 20
+        assert policy.threads(8, failures, 2) == 2
+        assert policy.threads(8, {'a': scheduler.CRASH}, 2) == 8
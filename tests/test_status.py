@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+"""Testing batch3dfier.status"""
+
+import json
+import urllib.request
+
+from bag3d.batch3dfier import status
+
+
+class TestRunStatus():
+    def test_counters(self, tmpdir):
+        path = str(tmpdir.join('status.json'))
+        s = status.RunStatus(3, path=path)
+        s.start(2)
+        s.finish(10.0)
+        s.finish(failed=True)
+        s.retry(1)
+        with open(path) as f_in:
+            res = json.load(f_in)
+        assert (res['queued'], res['running'], res['done'], res['failed']) == (2, 0, 1, 0)
+        assert res['avg_tile_seconds'] == 10.0
+        assert res['failed_total'] == 1
+        metrics = s.prometheus()
+        assert "# TYPE bag3d_tiles_done_total counter\nbag3d_tiles_done_total 1\n" in metrics
+        assert "# TYPE bag3d_tiles_failed_total counter\nbag3d_tiles_failed_total 1\n" in metrics
+        assert "bag3d_tiles_failed 0\n" in metrics
+
+    def test_not_started(self):
+        """A tile that 3dfier did not run on goes from queued to done"""
+        s = status.RunStatus(2)
+        s.finish(started=False)
+        s.finish(failed=True, started=False)
+        res = s.snapshot()
+        assert (res['queued'], res['running'], res['done'], res['failed']) == (0, 0, 1, 1)
+
+    def test_server(self):
+        s = status.RunStatus(1)
+        server = status.StatusServer(s, 0).start()
+        try:
+            port = server.server.server_address[1]
+            with urllib.request.urlopen("http://127.0.0.1:%s/metrics" % port) as r:
+                assert "bag3d_tiles_queued 1" in r.read().decode()
+        finally:
+            server.stop()
@@ -1,16 +1,21 @@
 from datetime import date
 import os.path
 
+import sys
+from contextlib import contextmanager
+from types import SimpleNamespace
+
 import pytest
 import logging
+import psutil
 
 from bag3d.update import bag
 
-@pytest.fixture('module')
+@pytest.fixture(scope='module')
 def bag_url():
     yield 'http://data.nlextract.nl/bag/postgis/'
 
-@pytest.fixture('module')
+@pytest.fixture(scope='module')
 def dbname():
     yield {
     'dbname': 'batch3dfier_db',
@@ -47,4 +52,64 @@ class TestBAG():
                              'tile_index', 
                              'localhost', 
                              '5432', 
-                             'batch3dfier', doexec)
\ No newline at end of file
+                             'batch3dfier', doexec)
+
+class TestResourceSampler():
+    def test_run_subprocess_stats(self):
+        stats = {}
+        assert bag.run_subprocess(['sleep', '0.3'], stats=stats,
+                                  sample_interval=0.05)
+        assert stats['returncode'] == 0
+        assert stats['samples'] > 1
+        assert stats['peak_rss'] > 0
+        assert stats['wall_time'] >= 0.3
+
+    def test_cpu_time_after_last_sample(self):
+        """The CPU time is taken from the reaped process, not the samples"""
+        stats = {}
+        assert bag.run_subprocess([sys.executable, '-c', 'sum(range(10**7))'],
+                                  stats=stats, sample_interval=60)
+        assert stats['samples'] == 1
+        assert stats['cpu_time'] > 0.05
+
+    def test_returncode(self):
+        stats = {}
+        assert not bag.run_subprocess(['sh', '-c', 'echo failed >&2; exit 3'],
+                                      stats=stats)
+        assert stats['returncode'] == 3
+        assert stats['stderr'].strip() == "failed"
+
+    def test_child_exits(self):
+        """A child that exits during a sample is left out, the root is not"""
+        class FakeProcess():
+            def __init__(self, rss, gone=False, children=()):
+                self.rss = rss
+                self.gone = gone
+                self._children = list(children)
+
+            def children(self, recursive=False):
+                return self._children
+
+            @contextmanager
+            def oneshot(self):
+                yield
+
+            def memory_info(self):
+                if self.gone:
+                    raise psutil.NoSuchProcess(1)
+                return SimpleNamespace(rss=self.rss)
+
+            def cpu_times(self):
+                return SimpleNamespace(user=1.0, system=0.5)
+
+            def io_counters(self):
+                return SimpleNamespace(read_bytes=10, write_bytes=20)
+
+        root = FakeProcess(100, children=[FakeProcess(50, gone=True),
+                                          FakeProcess(30)])
+        sampler = bag.ResourceSampler(root, {})
+        assert sampler.sample() == {'rss': 130, 'cpu_time': 3.0,
+                                    'read_bytes': 20, 'write_bytes': 40}
+        root.gone = True
+        with pytest.raises(psutil.NoSuchProcess):
+            sampler.sample()